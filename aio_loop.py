@@ -0,0 +1,96 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+logger = logging.getLogger("ai-damage-backend")
+
+# aiortc needs a running asyncio loop, while Flask-SocketIO handlers run under
+# eventlet (or plain threads) where no loop runs. AioLoop owns one event loop
+# on a dedicated daemon thread; handlers hand coroutines to it with
+# run_coroutine_threadsafe and either fire and forget (``submit``) or wait for
+# the result without stalling the eventlet hub (``call`` with
+# sleep=socketio.sleep). Everything touching peer connections, tracks and the
+# inference scheduler's asyncio state should run on this loop.
+
+
+class AioLoop:
+    """An asyncio event loop running on its own thread, started on first use."""
+
+    def __init__(self, name="aio-loop", heartbeat=1.0):
+        self.name = name
+        self.heartbeat = heartbeat
+        self.lag = 0.0  # how late the last heartbeat woke up, seconds
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None:
+                ready = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(ready,), name=self.name, daemon=True)
+                self._thread.start()
+                ready.wait()
+            return self._loop
+
+    def _run(self, ready):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self._loop = loop
+        loop.create_task(self._heartbeat())
+        ready.set()
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    async def _heartbeat(self):
+        # A loop blocked by slow callbacks shows up as lag here
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.heartbeat)
+            self.lag = loop.time() - start - self.heartbeat
+
+    def submit(self, coro, what=None):
+        """Schedule ``coro`` on the loop; returns a concurrent.futures.Future.
+
+        Failures are logged (with ``what`` as context) so fire-and-forget
+        calls don't disappear silently.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if what is not None:
+            future.add_done_callback(lambda f: self._log_failure(f, what))
+        return future
+
+    @staticmethod
+    def _log_failure(future, what):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"{what} failed: {future.exception()}")
+
+    def call(self, coro, timeout=None, sleep=None, poll=0.005):
+        """Run ``coro`` on the loop and return its result.
+
+        Without ``sleep`` the calling thread blocks. With ``sleep`` (e.g.
+        ``socketio.sleep``) the wait polls and yields between checks, so an
+        eventlet hub keeps serving other clients meanwhile. Raises
+        concurrent.futures.TimeoutError after ``timeout`` seconds and cancels
+        the coroutine.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if sleep is None:
+            try:
+                return future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                raise
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not future.done():
+            if deadline is not None and time.monotonic() >= deadline:
+                future.cancel()
+                raise concurrent.futures.TimeoutError(f"No result after {timeout}s")
+            sleep(poll)
+        return future.result()
@@ -1,6 +1,6 @@
 import streamlit as st
-from car_pipeline import car_damage_pipeline  # Import your pipeline function
-from PIL import Image
+from car_pipeline import car_damage_pipeline_bytes, TWO_PASS  # Import your pipeline function
+from result_cache import ResultCache
 import os
 import time
 
@@ -49,14 +49,24 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
-# ---------- FOLDERS & LAYOUT ----------
-os.makedirs("static", exist_ok=True)
+# ---------- RESULT CACHE ----------
+# Shared by all sessions; re-uploaded photos are answered from the cache.
+# The SQLite tier keeps results across restarts (set RESULT_CACHE_DB="" to disable).
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(max_entries=512, disk_path=os.environ.get("RESULT_CACHE_DB", ".cache/damage_results.sqlite"))
+
+result_cache = get_result_cache()
 
 # --- SIDEBAR: File Uploader ---
 with st.sidebar:
     st.title("Vehicle Damage Uploader")
     st.write("Upload a car image to detect damages:")
     uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"])
+    two_pass = st.checkbox("High-resolution mode", value=TWO_PASS,
+                           help="Find damaged regions on a downscaled copy, then re-check them at full resolution. Better for small scratches on large photos.")
+    cache_stats = result_cache.stats()
+    st.caption(f"Result cache: {cache_stats['hits'] + cache_stats['disk_hits']} hits, {cache_stats['misses']} misses")
 
 # --- MAIN PAGE TITLE ---
 st.title("Vehicle Damage Detection & Repair Cost Estimation")
@@ -67,15 +77,13 @@ st.write(
 
 # ---------- MAIN LOGIC ----------
 if uploaded_file is not None:
-    # Save the uploaded image
-    image_path = "static/uploaded_image.jpg"
-    with open(image_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
+    # Keep the upload in memory; nothing is written to disk
+    image_bytes = uploaded_file.getvalue()
 
     # Show spinner/animation while processing
     with st.spinner("Analyzing damage..."):
         time.sleep(1)  # A short delay so spinner is visible
-        results = car_damage_pipeline(image_path)
+        results = car_damage_pipeline_bytes(image_bytes, cache=result_cache, two_pass=two_pass)
 
     # Lay out results in two columns
     col1, col2 = st.columns(2, gap="large")
@@ -83,13 +91,15 @@ if uploaded_file is not None:
     # Original image
     with col1:
         st.subheader("Uploaded Image")
-        st.image(image_path, caption="Original", use_container_width=True)
+        st.image(image_bytes, caption="Original", use_container_width=True)
 
     # Annotated image
-    annotated_image_path = results["annotated_image_path"]
     with col2:
         st.subheader("Predicted Damage")
-        st.image(annotated_image_path, caption="Annotated", use_container_width=True)
+        st.image(results["annotated_image"], caption="Annotated", use_container_width=True)
+        if "roi" in results:
+            timings = " · ".join(f"{k[:-3]} {v:.0f} ms" for k, v in results["roi"]["timings"].items())
+            st.caption(f"{len(results['roi']['rois'])} regions re-checked at full resolution ({timings})")
 
     # --- Display cost estimation ---
     st.markdown("---")
@@ -101,11 +111,5 @@ if uploaded_file is not None:
         for cost in results["cost_breakdown"]:
             st.write(f"- **{cost['type'].capitalize()}**: AED {cost['estimated_cost']:.2f}")
 
-    # Cleanup the temporary files (optional)
-    if os.path.exists(image_path):
-        os.remove(image_path)
-    if os.path.exists(annotated_image_path):
-        os.remove(annotated_image_path)
-
 else:
     st.info("Please upload an image in the sidebar to proceed.")
@@ -0,0 +1,296 @@
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+from detections import Detections, box_iou
+from model_registry import DEFAULT_WEIGHTS, DEFAULT_IMGSZ, weights_sha256, get_model
+
+logger = logging.getLogger("ai-damage-backend")
+
+# CPU inference backends. "torch" runs the .pt weights through PyTorch eager;
+# the others run an artifact exported once from those weights and cached next
+# to them. Ultralytics loads every format behind the same YOLO/Results API,
+# so callers get identical Detections whatever the backend.
+BACKENDS = ("torch", "onnx", "openvino")
+PRECISIONS = ("fp32", "int8")
+
+# Selected by config
+DEFAULT_BACKEND = os.environ.get("DAMAGE_BACKEND", "torch")
+DEFAULT_PRECISION = os.environ.get("DAMAGE_PRECISION", "fp32")
+CALIBRATION_DIR = os.environ.get("DAMAGE_CALIBRATION_DIR")
+# torch backend: load a checkpoint that was fused once instead of fusing on every start
+FUSED_ARTIFACT = os.environ.get("DAMAGE_FUSED_ARTIFACT", "1") == "1"
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+_export_lock = threading.Lock()
+
+
+def resolve(backend=None, precision=None):
+    """Fill in configured defaults and validate a backend/precision pair."""
+    backend = backend or DEFAULT_BACKEND
+    precision = precision or DEFAULT_PRECISION
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend!r}, expected one of {BACKENDS}")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    if backend == "torch" and precision != "fp32":
+        raise ValueError("The torch backend only runs fp32; export to onnx or openvino for int8")
+    return backend, precision
+
+
+def letterbox(image, imgsz, color=114):
+    """Resize keeping aspect ratio and pad to a square imgsz canvas.
+
+    Returns the padded image, the scale factor and the (left, top) padding,
+    matching what Ultralytics does before inference.
+    """
+    h, w = image.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    nh, nw = int(round(h * r)), int(round(w * r))
+    resized = cv2.resize(image, (nw, nh), interpolation=cv2.INTER_LINEAR) if (nh, nw) != (h, w) else image
+    top, left = (imgsz - nh) // 2, (imgsz - nw) // 2
+    out = np.full((imgsz, imgsz, 3), color, dtype=np.uint8)
+    out[top:top + nh, left:left + nw] = resized
+    return out, r, (left, top)
+
+
+def artifact_path(weights, backend, precision, imgsz):
+    stem = os.path.splitext(os.path.abspath(weights))[0]
+    if backend == "onnx":
+        return f"{stem}_{imgsz}_{precision}.onnx"
+    if backend == "openvino":
+        # Ultralytics recognises OpenVINO models by the _openvino_model suffix
+        return f"{stem}_{imgsz}_{precision}_openvino_model"
+    # Conv+BN fusion does not depend on imgsz, so one fused checkpoint serves every size
+    return f"{stem}_fused.pt"
+
+
+def _artifact_is_current(path, digest):
+    sidecar = path + ".sha256"
+    if not os.path.exists(path) or not os.path.exists(sidecar):
+        return False
+    with open(sidecar) as f:
+        return f.read().strip() == digest
+
+
+def _list_images(folder, limit=200):
+    paths = sorted(p for p in glob.glob(os.path.join(folder, "**", "*"), recursive=True)
+                   if p.lower().endswith(IMAGE_EXTENSIONS))
+    if not paths:
+        raise ValueError(f"No images found in {folder}")
+    return paths[:limit]
+
+
+def _calibration_images(calibration_dir):
+    if not calibration_dir or not os.path.isdir(calibration_dir):
+        raise ValueError("INT8 export needs a calibration folder of sample images (DAMAGE_CALIBRATION_DIR)")
+    return _list_images(calibration_dir)
+
+
+def _calibration_yaml(calibration_dir, workdir):
+    # Ultralytics' OpenVINO INT8 export reads calibration images from a dataset yaml
+    from damage_costs import damage_cost_map
+
+    _calibration_images(calibration_dir)
+    path = os.path.join(workdir, "calibration.yaml")
+    with open(path, "w") as f:
+        f.write(f"path: {os.path.abspath(calibration_dir)}\ntrain: .\nval: .\nnames:\n")
+        for class_id, (name, _, _) in sorted(damage_cost_map.items()):
+            f.write(f"  {class_id}: {name}\n")
+    return path
+
+
+def _quantize_onnx(fp32_path, int8_path, calibration_dir, imgsz):
+    """Static post-training INT8 quantization with ONNX Runtime."""
+    import onnxruntime
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    input_name = onnxruntime.InferenceSession(fp32_path, providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    paths = _calibration_images(calibration_dir)
+
+    class _Reader(CalibrationDataReader):
+        def __init__(self):
+            self._paths = iter(paths)
+
+        def get_next(self):
+            path = next(self._paths, None)
+            if path is None:
+                return None
+            img = cv2.cvtColor(cv2.imread(path), cv2.COLOR_BGR2RGB)
+            padded, _, _ = letterbox(img, imgsz)
+            tensor = padded.transpose(2, 0, 1)[None].astype(np.float32) / 255.0
+            return {input_name: tensor}
+
+    quantize_static(fp32_path, int8_path, _Reader(), quant_format=QuantFormat.QDQ,
+                    per_channel=True, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+
+def export_fused(weights, path):
+    """Save ``weights`` with Conv+BN already fused, as a regular Ultralytics checkpoint.
+
+    YOLO(path) then loads the fused graph directly: the BatchNorm folding
+    that fuse() otherwise redoes in every new process is skipped, and the
+    checkpoint drops the EMA and optimizer state that a fresh load unpickles
+    for nothing. Written to a temporary file first so concurrent workers
+    never see half a checkpoint.
+    """
+    import torch
+    from ultralytics import YOLO
+    from ultralytics.nn.tasks import torch_safe_load
+
+    ckpt, _ = torch_safe_load(weights)
+    model = YOLO(weights)
+    model.fuse()
+    ckpt = {k: v for k, v in ckpt.items() if k not in ("ema", "optimizer", "updates")}
+    ckpt["model"] = model.model.float().eval()
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    os.close(fd)
+    try:
+        torch.save(ckpt, tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def export_artifact(weights=DEFAULT_WEIGHTS, backend=None, precision=None, imgsz=DEFAULT_IMGSZ,
+                    calibration_dir=None):
+    """Export ``weights`` for a backend once and return the cached artifact path.
+
+    The artifact sits next to the weights, named after backend, precision
+    and imgsz (torch: a pre-fused checkpoint). A .sha256 sidecar records which
+    weights it came from, and the export is redone when the weights change.
+    """
+    backend, precision = resolve(backend, precision)
+    if backend == "torch":
+        if not FUSED_ARTIFACT:
+            return os.path.abspath(weights)
+        path = artifact_path(weights, backend, precision, imgsz)
+        digest = weights_sha256(weights)
+        with _export_lock:
+            if _artifact_is_current(path, digest):
+                return path
+            try:
+                logger.info(f"Saving fused checkpoint of {os.path.basename(weights)}")
+                export_fused(weights, path)
+            except OSError as e:
+                # Read-only model directory: fall back to fusing at load time
+                logger.warning(f"Could not write {path}: {e}; loading the raw weights")
+                return os.path.abspath(weights)
+            with open(path + ".sha256", "w") as f:
+                f.write(digest)
+        return path
+
+    calibration_dir = calibration_dir or CALIBRATION_DIR
+    path = artifact_path(weights, backend, precision, imgsz)
+    digest = weights_sha256(weights)
+    with _export_lock:
+        if _artifact_is_current(path, digest):
+            return path
+
+        from ultralytics import YOLO
+
+        logger.info(f"Exporting {os.path.basename(weights)} to {backend}/{precision} (imgsz={imgsz})")
+        with tempfile.TemporaryDirectory() as workdir:
+            # Export from a private copy so Ultralytics' output lands in workdir
+            local_weights = os.path.join(workdir, os.path.basename(weights))
+            shutil.copy2(weights, local_weights)
+            model = YOLO(local_weights)
+
+            if backend == "onnx":
+                exported = model.export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+                if precision == "int8":
+                    _quantize_onnx(exported, path, calibration_dir, imgsz)
+                else:
+                    shutil.move(exported, path)
+            else:
+                kwargs = {}
+                if precision == "int8":
+                    kwargs = {"int8": True, "data": _calibration_yaml(calibration_dir, workdir)}
+                exported = model.export(format="openvino", imgsz=imgsz, dynamic=True, **kwargs)
+                shutil.rmtree(path, ignore_errors=True)
+                shutil.move(exported, path)
+
+        with open(path + ".sha256", "w") as f:
+            f.write(digest)
+    return path
+
+
+def parity_check(images, backend, precision="fp32", weights=DEFAULT_WEIGHTS, imgsz=DEFAULT_IMGSZ,
+                 iou_threshold=0.5):
+    """Compare a backend's detections with PyTorch fp32 on the same images.
+
+    Boxes are matched greedily by IoU within the same class. Returns recall
+    and precision against the PyTorch boxes plus the largest confidence
+    difference among matches.
+    """
+    reference = get_model(weights, device="cpu", imgsz=imgsz, backend="torch", precision="fp32")
+    candidate = get_model(weights, device="cpu", imgsz=imgsz, backend=backend, precision=precision)
+
+    ref_total = test_total = matched = 0
+    max_conf_delta, ious = 0.0, []
+    for image in images:
+        ref = Detections.from_result(reference(image, imgsz=imgsz, device="cpu", verbose=False)[0])
+        test = Detections.from_result(candidate(image, imgsz=imgsz, device="cpu", verbose=False)[0])
+        ref_total += len(ref)
+        test_total += len(test)
+
+        iou = box_iou(ref.xyxy, test.xyxy)
+        iou[ref.cls[:, None] != test.cls[None, :]] = 0.0
+        while iou.size and iou.max() >= iou_threshold:
+            i, j = np.unravel_index(np.argmax(iou), iou.shape)
+            matched += 1
+            ious.append(float(iou[i, j]))
+            max_conf_delta = max(max_conf_delta, abs(float(ref.conf[i]) - float(test.conf[j])))
+            iou[i, :] = 0.0
+            iou[:, j] = 0.0
+
+    return {
+        "backend": backend,
+        "precision": precision,
+        "images": len(images),
+        "reference_boxes": ref_total,
+        "backend_boxes": test_total,
+        "matched": matched,
+        "recall": matched / ref_total if ref_total else 1.0,
+        "precision_vs_reference": matched / test_total if test_total else 1.0,
+        "mean_iou": float(np.mean(ious)) if ious else None,
+        "max_conf_delta": max_conf_delta,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and check CPU inference backends.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name in ("export", "parity"):
+        p = sub.add_parser(name)
+        p.add_argument("--weights", default=DEFAULT_WEIGHTS)
+        p.add_argument("--backend", choices=BACKENDS, default=DEFAULT_BACKEND)
+        p.add_argument("--precision", choices=PRECISIONS, default=DEFAULT_PRECISION)
+        p.add_argument("--imgsz", type=int, default=DEFAULT_IMGSZ)
+        p.add_argument("--calibration", default=CALIBRATION_DIR, help="folder of sample images for INT8")
+    sub.choices["parity"].add_argument("--images", required=True, help="folder of images to compare on")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "export":
+        print(export_artifact(args.weights, args.backend, args.precision, args.imgsz, args.calibration))
+    else:
+        if args.calibration:
+            export_artifact(args.weights, args.backend, args.precision, args.imgsz, args.calibration)
+        images = [cv2.cvtColor(cv2.imread(p), cv2.COLOR_BGR2RGB)
+                  for p in _list_images(args.images)]
+        print(json.dumps(parity_check(images, args.backend, args.precision, args.weights, args.imgsz), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+import argparse
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from backends import IMAGE_EXTENSIONS
+from car_pipeline import WEIGHTS, annotate_image, detect_damages_batch, estimate_cost_batch
+from model_registry import weights_sha256
+
+logger = logging.getLogger("ai-damage-backend")
+
+# Bulk re-scoring of claim photo archives. Images (a directory tree or a
+# manifest of paths) are split into fixed shards in a stable order that is
+# saved with the job. A thread pool reads and decodes ahead of the model
+# (cv2.imdecode releases the GIL), batches go through detect_damages_batch,
+# and every finished shard is written atomically as one JSONL or Parquet file
+# before it is recorded in job.json. A crashed or interrupted run started
+# again with the same output directory redoes at most the shard it was in.
+
+FORMATS = ("jsonl", "parquet")
+SHARD_SIZE = int(os.environ.get("BATCH_SHARD_SIZE", "1000"))
+DECODE_WORKERS = int(os.environ.get("BATCH_DECODE_WORKERS", "4"))
+REPORT_SECONDS = 10.0
+
+STATE_FILE = "job.json"
+MANIFEST_FILE = "manifest.txt"
+
+
+def list_inputs(source):
+    """Image paths under a directory (sorted), or the lines of a manifest file.
+
+    Manifest paths may be relative to the manifest; blank lines and lines
+    starting with # are skipped.
+    """
+    if os.path.isdir(source):
+        paths = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            paths.extend(os.path.join(root, f) for f in sorted(files) if f.lower().endswith(IMAGE_EXTENSIONS))
+        return [os.path.abspath(p) for p in paths]
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source) as f:
+        lines = [line.strip() for line in f]
+    return [os.path.join(base, line) for line in lines if line and not line.startswith("#")]
+
+
+def _decode(path):
+    # Same pixels as car_pipeline.load_image (RGB, EXIF orientation not applied)
+    bgr = cv2.imdecode(np.fromfile(path, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if bgr is None:
+        raise ValueError("Not a decodable image")
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+
+def _read(path):
+    try:
+        return _decode(path), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def _write_atomic(path, write):
+    tmp = path + ".tmp"
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def _write_text(path, text):
+    def write(tmp):
+        with open(tmp, "w") as f:
+            f.write(text)
+    _write_atomic(path, write)
+
+
+def _write_jsonl(path, records):
+    def write(tmp):
+        with open(tmp, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    _write_atomic(path, write)
+
+
+def _parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("index", pa.int64()),
+        ("path", pa.string()),
+        ("width", pa.int32()),
+        ("height", pa.int32()),
+        ("total_cost", pa.float64()),
+        ("cost_breakdown", pa.list_(pa.struct([("type", pa.string()), ("estimated_cost", pa.float64())]))),
+        ("detections", pa.struct([
+            ("xyxy", pa.list_(pa.list_(pa.float32(), 4))),
+            ("conf", pa.list_(pa.float32())),
+            ("cls", pa.list_(pa.int32())),
+        ])),
+        ("annotated_path", pa.string()),
+        ("error", pa.string()),
+        ("weights_sha256", pa.string()),
+    ])
+
+
+def _write_parquet(path, records):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet output needs pyarrow (pip install pyarrow)") from None
+    # Explicit schema: shards whose images have no detections still get the same column types
+    table = pa.Table.from_pylist(records, schema=_parquet_schema())
+    _write_atomic(path, lambda tmp: pq.write_table(table, tmp, compression="zstd"))
+
+
+def _eta(seconds):
+    if seconds is None:
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class BatchJob:
+    """Resumable scoring of many images into JSONL or Parquet shards.
+
+    ``source`` is a directory or a manifest file and is only read on the
+    first run; later runs with the same ``output_dir`` pick up the saved
+    manifest and skip finished shards. Resuming with different weights,
+    format or shard size raises ValueError: use a new output directory.
+    With ``annotate`` the annotated JPEGs go to ``output_dir/annotated``.
+    """
+
+    def __init__(self, source, output_dir, fmt="jsonl", shard_size=SHARD_SIZE, batch_size=8,
+                 decode_workers=DECODE_WORKERS, prefetch=None, annotate=False):
+        if fmt not in FORMATS:
+            raise ValueError(f"format must be one of {FORMATS}")
+        self.source = source
+        self.output_dir = output_dir
+        self.fmt = fmt
+        self.shard_size = shard_size
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        # Decoded images waiting for the model; bounds memory for large photos
+        self.prefetch = prefetch or max(2 * batch_size, 4 * decode_workers)
+        self.annotate = annotate
+        self.weights_sha256 = weights_sha256(WEIGHTS)
+        self.paths = []
+        self.completed = set()
+        self.processed = 0  # images scored by this run
+        self.failed = 0
+        self._state_path = os.path.join(output_dir, STATE_FILE)
+
+    # --- job state ---
+
+    def _load_or_create(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        manifest = os.path.join(self.output_dir, MANIFEST_FILE)
+        if os.path.exists(self._state_path):
+            with open(self._state_path) as f:
+                state = json.load(f)
+            for key, value in (("weights_sha256", self.weights_sha256), ("format", self.fmt),
+                               ("shard_size", self.shard_size)):
+                if state[key] != value:
+                    raise ValueError(f"{self.output_dir} holds a job with {key}={state[key]!r}, not {value!r}")
+            with open(manifest) as f:
+                self.paths = f.read().splitlines()
+            self.completed = set(state["completed"])
+            logger.info(f"Resuming batch job: {len(self.completed)}/{self.shards} shards already done")
+        else:
+            self.paths = list_inputs(self.source)
+            _write_text(manifest, "".join(p + "\n" for p in self.paths))
+            self._save_state()
+        if self.annotate:
+            os.makedirs(os.path.join(self.output_dir, "annotated"), exist_ok=True)
+
+    def _save_state(self):
+        state = {
+            "source": os.path.abspath(self.source),
+            "weights_sha256": self.weights_sha256,
+            "format": self.fmt,
+            "shard_size": self.shard_size,
+            "total": len(self.paths),
+            "completed": sorted(self.completed),
+        }
+        _write_text(self._state_path, json.dumps(state, indent=2))
+
+    @property
+    def shards(self):
+        return (len(self.paths) + self.shard_size - 1) // self.shard_size
+
+    def shard_path(self, shard):
+        return os.path.join(self.output_dir, f"shard-{shard:05d}.{self.fmt}")
+
+    # --- scoring ---
+
+    def _record(self, index, image, error):
+        return {
+            "index": index,
+            "path": self.paths[index],
+            "width": image.shape[1] if image is not None else None,
+            "height": image.shape[0] if image is not None else None,
+            "total_cost": None,
+            "cost_breakdown": [],
+            "detections": {"xyxy": [], "conf": [], "cls": []},
+            "annotated_path": None,
+            "error": error,
+            "weights_sha256": self.weights_sha256,
+        }
+
+    def _save_annotated(self, image, path):
+        Image.fromarray(image).save(path, quality=90)
+
+    def _score(self, batch, records, pool, pending_writes):
+        images = [image for _, image, _ in batch]
+        _, batch_detections = detect_damages_batch(images, batch_size=self.batch_size)
+        for (index, image, _), detections, (total_cost, cost_breakdown) in zip(
+                batch, batch_detections, estimate_cost_batch(batch_detections)):
+            record = self._record(index, image, None)
+            record.update(total_cost=total_cost, cost_breakdown=cost_breakdown, detections=detections.to_dict())
+            if self.annotate:
+                name = os.path.splitext(os.path.basename(self.paths[index]))[0]
+                path = os.path.join(self.output_dir, "annotated", f"{index:07d}_{name}.jpg")
+                # The decoded image is not used again, so it is drawn on directly
+                pending_writes.append(pool.submit(self._save_annotated, annotate_image(image, detections), path))
+                record["annotated_path"] = path
+            records.append(record)
+
+    def _finish_shard(self, shard, records, pending_writes):
+        for future in pending_writes:
+            future.result()
+        pending_writes.clear()
+        records.sort(key=lambda r: r["index"])
+        (_write_parquet if self.fmt == "parquet" else _write_jsonl)(self.shard_path(shard), records)
+        # Only now is the shard safe to skip on resume
+        self.completed.add(shard)
+        self._save_state()
+
+    def run(self):
+        """Score every pending shard; returns a summary dict."""
+        self._load_or_create()
+        pending = [s for s in range(self.shards) if s not in self.completed]
+        todo = sum(min(self.shard_size, len(self.paths) - s * self.shard_size) for s in pending)
+        already = len(self.paths) - todo
+        start = last_report = time.perf_counter()
+
+        def report(final=False):
+            elapsed = time.perf_counter() - start
+            rate = self.processed / elapsed if elapsed > 0 else 0.0
+            eta = (todo - self.processed) / rate if rate > 0 else None
+            logger.info(f"{'Finished' if final else 'Progress'}: {already + self.processed}/{len(self.paths)} images, "
+                        f"{rate:.1f} img/s, ETA {_eta(0 if final else eta)}, {self.failed} failed")
+            return rate
+
+        with ThreadPoolExecutor(self.decode_workers, thread_name_prefix="batch-decode") as pool:
+            items = ((i, path) for s in pending
+                     for i, path in enumerate(self.paths[s * self.shard_size:(s + 1) * self.shard_size],
+                                              s * self.shard_size))
+            reads = deque()  # decode futures in input order
+            shard, records, batch, pending_writes = None, [], [], []
+
+            def fill():
+                while len(reads) < self.prefetch:
+                    item = next(items, None)
+                    if item is None:
+                        return
+                    reads.append((item[0], pool.submit(_read, item[1])))
+
+            fill()
+            while reads:
+                index, future = reads.popleft()
+                fill()
+                image, error = future.result()
+                item_shard = index // self.shard_size
+                if item_shard != shard:
+                    if batch:
+                        self._score(batch, records, pool, pending_writes)
+                        batch = []
+                    if shard is not None:
+                        self._finish_shard(shard, records, pending_writes)
+                        records = []
+                    shard = item_shard
+                self.processed += 1
+                if error is not None:
+                    self.failed += 1
+                    logger.warning(f"Skipping {self.paths[index]}: {error}")
+                    records.append(self._record(index, None, error))
+                else:
+                    batch.append((index, image, error))
+                    if len(batch) >= self.batch_size:
+                        self._score(batch, records, pool, pending_writes)
+                        batch = []
+                if time.perf_counter() - last_report >= REPORT_SECONDS:
+                    report()
+                    last_report = time.perf_counter()
+            if batch:
+                self._score(batch, records, pool, pending_writes)
+            if shard is not None:
+                self._finish_shard(shard, records, pending_writes)
+
+        rate = report(final=True)
+        return {
+            "images": len(self.paths),
+            "scored_this_run": self.processed,
+            "skipped_from_previous_runs": already,
+            "failed": self.failed,
+            "shards": self.shards,
+            "seconds": time.perf_counter() - start,
+            "images_per_second": rate,
+            "output_dir": os.path.abspath(self.output_dir),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-score a photo archive into resumable JSONL/Parquet shards.")
+    parser.add_argument("source", help="directory of images or manifest file (one path per line)")
+    parser.add_argument("output_dir", help="shards, job state and manifest; run again with the same one to resume")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--decode-workers", type=int, default=DECODE_WORKERS)
+    parser.add_argument("--prefetch", type=int, help="decoded images held ahead of the model")
+    parser.add_argument("--annotate", action="store_true", help="also save annotated JPEGs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    job = BatchJob(args.source, args.output_dir, fmt=args.format, shard_size=args.shard_size,
+                   batch_size=args.batch_size, decode_workers=args.decode_workers, prefetch=args.prefetch,
+                   annotate=args.annotate)
+    print(json.dumps(job.run()))
+
+
+if __name__ == "__main__":
+    main()
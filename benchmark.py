@@ -0,0 +1,242 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from backends import letterbox
+from car_pipeline import load_image, annotate_image, estimate_cost, damage_cost_map
+from detections import Detections
+from overlay import TextSlot
+
+# Stage-level benchmark of the image/frame path. Every stage is timed on its
+# own over a sweep of inference sizes, batch sizes and detections per frame,
+# and the results are written as JSON so runs can be compared across commits.
+# With --model stub (the default) a deterministic stand-in replaces YOLO, so
+# the suite runs without the weights; --model real uses the registry model.
+
+IMGSZ_SWEEP = (320, 480, 640)
+BATCH_SWEEP = (1, 4, 8)
+DETECTIONS_SWEEP = (0, 10, 50)
+
+
+class _StubTensor:
+    """Just enough of torch.Tensor for Detections.from_boxes."""
+
+    def __init__(self, array):
+        self._array = array
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self._array
+
+
+class _StubBoxes:
+    def __init__(self, data):
+        self.data = _StubTensor(data)
+
+    def __len__(self):
+        return len(self.data.numpy())
+
+
+class _StubResult:
+    def __init__(self, orig_img, data):
+        self.orig_img = orig_img
+        self.boxes = _StubBoxes(data)
+
+    def plot(self, img=None):
+        # Same kind of work as Results.plot(): copy the frame, draw boxes and labels
+        out = (self.orig_img if img is None else img).copy()
+        for x1, y1, x2, y2, conf, cls in self.boxes.data.numpy().tolist():
+            cv2.rectangle(out, (int(x1), int(y1)), (int(x2), int(y2)), (255, 0, 0), 2)
+            cv2.putText(out, f"{damage_cost_map[int(cls)][0]} {conf:.2f}", (int(x1), int(y1) - 4),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+        return out
+
+
+class StubModel:
+    """Deterministic stand-in for an Ultralytics YOLO model.
+
+    Does the real letterbox/normalise work and a fixed amount of compute that
+    scales with imgsz and batch size, then returns ``detections`` seeded
+    pseudo-random boxes per image.
+    """
+
+    def __init__(self, detections=10, seed=0):
+        self.detections = detections
+        self.seed = seed
+
+    def _boxes(self, index, height, width):
+        rng = np.random.default_rng(self.seed + index)
+        n = self.detections
+        xy = rng.uniform(0, 0.8, size=(n, 2)) * (width, height)
+        wh = rng.uniform(0.05, 0.2, size=(n, 2)) * (width, height)
+        conf = rng.uniform(0.25, 0.95, size=(n, 1))
+        cls = rng.integers(0, len(damage_cost_map), size=(n, 1))
+        return np.hstack([xy, xy + wh, conf, cls]).astype(np.float32)
+
+    def __call__(self, images, imgsz=640, **kwargs):
+        if isinstance(images, np.ndarray):
+            images = [images]
+        batch = np.stack([letterbox(img, imgsz)[0] for img in images])
+        tensor = batch.transpose(0, 3, 1, 2).astype(np.float32) / 255.0
+        # Stand-in for the network: a few separable filters over the whole batch
+        for _ in range(4):
+            tensor = (tensor + np.roll(tensor, 1, axis=2) + np.roll(tensor, 1, axis=3)) / 3.0
+        return [_StubResult(img, self._boxes(i, *img.shape[:2])) for i, img in enumerate(images)]
+
+
+def _annotate_puttext(image, detections):
+    # The per-box rectangle + putText drawing used before the sprite overlay
+    for (x_min, y_min, x_max, y_max), class_id, confidence in zip(
+            detections.xyxy.astype(int).tolist(), detections.cls.tolist(), detections.conf.tolist()):
+        label = f"{damage_cost_map[class_id][0]} ({confidence:.2f})"
+        cv2.rectangle(image, (x_min, y_min), (x_max, y_max), (255, 0, 0), 2)
+        cv2.rectangle(image, (x_min, y_min - 20), (x_max, y_min), (255, 255, 255), -1)
+        cv2.putText(image, label, (x_min, y_min - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 1)
+    return image
+
+
+def _banner_puttext(image, text):
+    cv2.rectangle(image, (0, 0), (430, 46), (245, 245, 245), -1)
+    cv2.putText(image, text, (10, 32), cv2.FONT_HERSHEY_SIMPLEX, 0.88, (0, 60, 230), 2)
+    return image
+
+
+def _time(fn, repeats):
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    samples.sort()
+    return {
+        "median_ms": statistics.median(samples),
+        "p90_ms": samples[min(len(samples) - 1, int(0.9 * len(samples)))],
+        "mean_ms": statistics.fmean(samples),
+        "repeats": repeats,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _synthetic_frame(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 255, size=(height // 8, width // 8, 3), dtype=np.uint8)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+
+
+def run(model="stub", imgsz_sweep=IMGSZ_SWEEP, batch_sweep=BATCH_SWEEP, detections_sweep=DETECTIONS_SWEEP,
+        repeats=20, width=1280, height=720):
+    """Run the sweep and return a JSON-able report."""
+    try:
+        import av
+    except ImportError:
+        av = None
+
+    frame = _synthetic_frame(width, height)
+    records = []
+
+    def record(stage, config, timing, per=1):
+        timing = dict(timing)
+        for k in ("median_ms", "p90_ms", "mean_ms"):
+            timing[k + "_per_image"] = timing[k] / per
+        records.append({"stage": stage, **config, **timing})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Decode: load_image on a JPEG of the synthetic frame
+        path = os.path.join(tmp, "frame.jpg")
+        Image.fromarray(frame).save(path, quality=90)
+        record("decode", {"width": width, "height": height}, _time(lambda: load_image(path), repeats))
+
+    for imgsz in imgsz_sweep:
+        record("preprocess", {"imgsz": imgsz}, _time(
+            lambda: letterbox(frame, imgsz)[0].transpose(2, 0, 1).astype(np.float32) / 255.0, repeats))
+
+    # A real model decides its own detection count, so there is nothing to sweep
+    for n_dets in (detections_sweep if model == "stub" else (None,)):
+        if model == "stub":
+            net = StubModel(detections=n_dets)
+        else:
+            from model_registry import get_model
+            net = get_model()
+
+        for imgsz, batch_size in itertools.product(imgsz_sweep, batch_sweep):
+            batch = [frame] * batch_size
+            config = {"imgsz": imgsz, "batch": batch_size, "detections": n_dets}
+            record("inference", config, _time(lambda: net(batch, imgsz=imgsz, verbose=False), repeats), per=batch_size)
+
+        results = net([frame], imgsz=imgsz_sweep[0], verbose=False)
+        dets = Detections.from_result(results[0])
+        config = {"detections": len(dets)}
+        record("extract", config, _time(lambda: Detections.from_result(results[0]), repeats))
+        record("cost", config, _time(lambda: estimate_cost(dets), repeats))
+        # Both draw in place on one output buffer; plot() copies the frame itself
+        canvas = frame.copy()
+        record("annotate_puttext", config, _time(lambda: _annotate_puttext(canvas, dets), repeats))
+        record("annotate_overlay", config, _time(lambda: annotate_image(canvas, dets), repeats))
+        record("annotate_plot", config, _time(lambda: results[0].plot(), repeats))
+
+    # Cost banner with unchanged text, as on most live frames
+    canvas = frame.copy()
+    banner = TextSlot(scale=0.88, color=(0, 60, 230), thickness=2, background=(245, 245, 245),
+                      pad_left=10, min_width=430, height=46)
+    record("banner_puttext", {}, _time(lambda: _banner_puttext(canvas, "Repair: AED 1234.50"), repeats))
+    record("banner_overlay", {}, _time(lambda: banner.draw(canvas, "Repair: AED 1234.50", 0, 0), repeats))
+
+    annotated = annotate_image(frame.copy(), dets)
+    record("encode_jpeg", {}, _time(lambda: cv2.imencode(".jpg", annotated), repeats))
+    if av is not None:
+        record("encode_videoframe", {}, _time(lambda: av.VideoFrame.from_ndarray(annotated, format="bgr24"), repeats))
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "model": model,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "frame": [width, height],
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": records,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stage-level benchmark of the damage detection path.")
+    parser.add_argument("--model", choices=("stub", "real"), default="stub")
+    parser.add_argument("--imgsz", type=int, nargs="+", default=list(IMGSZ_SWEEP))
+    parser.add_argument("--batch", type=int, nargs="+", default=list(BATCH_SWEEP))
+    parser.add_argument("--detections", type=int, nargs="+", default=list(DETECTIONS_SWEEP))
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--output", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    report = run(args.model, args.imgsz, args.batch, args.detections, args.repeats)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    for r in report["results"]:
+        config = ", ".join(f"{k}={r[k]}" for k in ("imgsz", "batch", "detections") if k in r)
+        print(f"{r['stage']:<18} {config:<36} {r['median_ms_per_image']:8.3f} ms/image")
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
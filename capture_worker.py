@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+from collections import deque, namedtuple
+
+import cv2
+
+import metrics
+from car_pipeline import estimate_cost, annotate_image
+from cpu_resources import get_resource_manager
+from damage_aggregator import DamageAggregator
+from detections import Detections
+from model_registry import get_model
+from quality_controller import QualityController, fit, warm_models
+from tracking import DetectThenTrack
+
+logger = logging.getLogger("ai-damage-backend")
+
+# Background webcam worker shared by every session of a Streamlit app. One
+# thread owns the capture device and the detect/track loop and publishes each
+# annotated frame with its cost into a small ring buffer; sessions only read
+# from it, so ten open tabs still mean one camera and one model loop. The
+# camera is opened when the first session subscribes and released once no
+# session has polled for IDLE_TIMEOUT seconds (a closed tab never says
+# goodbye, so subscriptions expire instead).
+
+CAMERA_SOURCE = os.environ.get("CAMERA_SOURCE", "0")  # device index, file or stream URL
+RING_SIZE = int(os.environ.get("CAPTURE_RING_SIZE", "8"))
+IDLE_TIMEOUT = float(os.environ.get("CAPTURE_IDLE_TIMEOUT", "10"))
+POLL_SECONDS = float(os.environ.get("CAPTURE_POLL_SECONDS", "0.1"))  # how often the UI picks up a new frame
+RETRY_SECONDS = 2.0
+
+# One published frame; ``image`` is RGB and is never written to again
+Snapshot = namedtuple("Snapshot", "seq timestamp image total_cost cost_breakdown claim_cost claim_damages label fps")
+
+
+def _source(value):
+    return int(value) if str(value).isdigit() else value
+
+
+class CaptureWorker:
+    """Owns the camera and the inference loop; sessions subscribe and poll.
+
+    ``subscribe(token)`` starts the loop if needed, ``poll(token)`` returns
+    the newest Snapshot (or None before the first frame) and keeps the
+    subscription alive, ``unsubscribe(token)`` leaves. ``snapshots(since)``
+    returns the buffered frames newer than a sequence number.
+    """
+
+    def __init__(self, source=CAMERA_SOURCE, ring_size=RING_SIZE, idle_timeout=IDLE_TIMEOUT):
+        self.source = _source(source)
+        self.idle_timeout = idle_timeout
+        self.error = None
+        self.frames = 0
+        self.captures_opened = 0
+        self.claim = DamageAggregator()  # unique damages since the camera was last opened
+        self._ring = deque(maxlen=ring_size)
+        self._subscribers = {}  # token -> last poll (monotonic)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._fps = metrics.RateMeter()
+        self._thread = None
+
+    # --- session side ---
+
+    def subscribe(self, token):
+        with self._lock:
+            self._subscribers[token] = time.monotonic()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="capture-worker", daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def is_subscribed(self, token):
+        with self._lock:
+            return token in self._subscribers
+
+    def poll(self, token):
+        with self._lock:
+            if token in self._subscribers:
+                self._subscribers[token] = time.monotonic()
+            return self._ring[-1] if self._ring else None
+
+    def snapshots(self, since=0):
+        with self._lock:
+            return [snapshot for snapshot in self._ring if snapshot.seq > since]
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    @property
+    def fps(self):
+        return self._fps.rate
+
+    # --- worker thread ---
+
+    def _active(self):
+        with self._lock:
+            now = time.monotonic()
+            for token, seen in list(self._subscribers.items()):
+                if now - seen > self.idle_timeout:
+                    del self._subscribers[token]
+            return bool(self._subscribers)
+
+    def _run(self):
+        while True:
+            if not self._active():
+                with self._lock:
+                    self._ring.clear()
+                self._wake.clear()
+                self._wake.wait(timeout=1.0)
+                continue
+            cap = cv2.VideoCapture(self.source)
+            self.captures_opened += 1
+            try:
+                if not cap.isOpened():
+                    self.error = f"Could not open camera {self.source!r}."
+                    time.sleep(RETRY_SECONDS)
+                    continue
+                logger.info(f"Capture worker: camera {self.source!r} opened")
+                self.error = None
+                self._stream(cap)
+            except Exception as e:
+                logger.error(f"Capture worker error: {e}")
+                self.error = str(e)
+                time.sleep(RETRY_SECONDS)
+            finally:
+                cap.release()
+
+    def _stream(self, cap):
+        quality = QualityController()
+        warm_models()  # once per process, in the background
+        claim = self.claim = DamageAggregator()
+
+        resources = get_resource_manager()
+        scale = 1.0  # working frame / camera frame, follows the quality level
+
+        def detect(img):
+            with resources.worker() as slot:
+                net = get_model(imgsz=quality.imgsz, precision=quality.precision, replica=slot)
+                detections = Detections.from_result(net(img, imgsz=quality.imgsz, verbose=False)[0])
+            # The claim keeps boxes in camera-frame coordinates, so a quality
+            # change does not make every damage look new
+            full = Detections(detections.xyxy / scale, detections.conf, detections.cls)
+            claim.update(full, img, scale)
+            return detections
+
+        tracker = DetectThenTrack(detect)
+        while self._active():
+            ret, frame = cap.read()
+            if not ret:
+                self.error = "Failed to get frame from webcam."
+                time.sleep(RETRY_SECONDS)
+                return
+            start = time.perf_counter()
+            # Working resolution follows the quality controller; the UI scales it for display
+            frame_resized = fit(frame, quality.imgsz)
+            scale = frame_resized.shape[1] / frame.shape[1]
+            # YOLO on keyframes, optical flow tracking in between
+            tracker.keyframe_interval = quality.keyframe_interval
+            detections = tracker(frame_resized)
+            annotate_image(frame_resized, detections)
+            total_cost, cost_breakdown = estimate_cost(detections)
+            image = cv2.cvtColor(frame_resized, cv2.COLOR_BGR2RGB)
+            self._fps.tick()
+            self._publish(image, float(total_cost), cost_breakdown, claim, quality.label())
+            # Feed the frame's real latency back, then pace to the target FPS
+            time_elapsed = time.perf_counter() - start
+            quality.observe(time_elapsed)
+            if time_elapsed < quality.frame_budget:
+                time.sleep(quality.frame_budget - time_elapsed)
+        logger.info(f"Capture worker: no subscribers left, releasing camera {self.source!r}")
+
+    def _publish(self, image, total_cost, cost_breakdown, claim, label):
+        self.frames += 1
+        snapshot = Snapshot(self.frames, time.time(), image, total_cost, cost_breakdown,
+                            claim.total_cost, claim.confirmed, label, self.fps)
+        with self._lock:
+            self._ring.append(snapshot)
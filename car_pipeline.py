@@ -1,11 +1,30 @@
-from ultralytics import YOLO
-import cv2
+import io
 from PIL import Image
 import numpy as np
 import os
+import time
+from model_registry import get_model, weights_sha256, DEFAULT_WEIGHTS
+from detections import Detections, nms
+# Cost estimation lives in the import-light damage_costs module; re-exported here
+from damage_costs import damage_cost_map, estimate_costs, estimate_cost, estimate_cost_batch
 
-# Load the pre-trained YOLOv8 model
-model = YOLO('best (6).pt')  # Replace with your trained YOLOv8 model path
+# Pre-trained YOLOv8 weights and inference size; the model itself is loaded
+# lazily (once per process) by the model registry
+WEIGHTS = DEFAULT_WEIGHTS  # Replace with your trained YOLOv8 model path
+IMGSZ = 640
+CONF = 0.25
+
+# Two-pass ROI inference for high-resolution stills: a coarse pass over the
+# whole photo at ROI_COARSE_IMGSZ proposes regions (with the lower ROI_CONF
+# so faint damage is not missed), then up to ROI_MAX crops of at least
+# ROI_SIZE native pixels around them are re-run at ROI_IMGSZ
+TWO_PASS = os.environ.get("DAMAGE_TWO_PASS", "0") == "1"
+ROI_COARSE_IMGSZ = 640
+ROI_IMGSZ = 640
+ROI_SIZE = 640
+ROI_MAX = 8
+ROI_CONF = 0.1
+ROI_MARGIN = 0.5  # context around a candidate box, as a fraction of its size
 
 # Helper function to load an image
 def load_image(image_path):
@@ -13,83 +32,232 @@ def load_image(image_path):
     img = img.convert('RGB')
     return np.array(img)
 
+# Helper functions to decode/encode images in memory (RGB arrays)
+def decode_image(data):
+    img = Image.open(io.BytesIO(data))
+    img = img.convert('RGB')
+    return np.array(img)
+
+def encode_image(image, output_format="JPEG", quality=90):
+    buffer = io.BytesIO()
+    if output_format.upper() in ("JPEG", "JPG"):
+        Image.fromarray(image).save(buffer, format="JPEG", quality=quality)
+    else:
+        Image.fromarray(image).save(buffer, format=output_format)
+    return buffer.getvalue()
+
 # Function to detect damages
 def detect_damages(image):
-    results = model(image)
-    damage_info = []
-
-    for detection in results[0].boxes:
-        class_id = int(detection.cls.cpu().numpy())
-        confidence = float(detection.conf.cpu().numpy())
-        bbox = detection.xyxy.cpu().numpy()
-
-        damage_info.append({
-            "class_id": class_id,
-            "confidence": confidence,
-            "bbox": bbox.flatten()
-        })
+    model = get_model(WEIGHTS, imgsz=IMGSZ)
+    results = model(image, imgsz=IMGSZ, conf=CONF)
+    return results, Detections.from_result(results[0])
 
-    return results, damage_info
-
-# Function to estimate repair costs
-damage_cost_map = {
-    0: ('crack_and_hole', 500, 2500),           # AED
-    1: ('medium_deformation', 400, 600),       # AED
-    2: ('severe_deformation', 1000, 3000),     # AED
-    3: ('severe_scratch', 700, 2000),          # AED (per panel)
-    4: ('slight_deformation', 200, 400),       # AED
-    5: ('slight_scratch', 100, 250),           # AED (per panel)
-    6: ('windshield_damage', 200, 3000)        # AED (repair vs. replacement)
-}
-
-def estimate_cost(damage_info):
-    total_cost = 0
-    cost_breakdown = []
-
-    for damage in damage_info:
-        class_id = damage['class_id']
-        confidence = damage['confidence']
-        min_cost, max_cost = damage_cost_map[class_id][1:3]
-        estimated_cost = min_cost + (max_cost - min_cost) * confidence
-        total_cost += estimated_cost
-
-        cost_breakdown.append({
-            "type": damage_cost_map[class_id][0],
-            "estimated_cost": estimated_cost
-        })
+# Function to detect damages on a list of images with one forward pass per chunk.
+# Ultralytics letterboxes every image of a list to the same imgsz and stacks
+# them into a single batch tensor before running the model.
+def detect_damages_batch(images, batch_size=8):
+    model = get_model(WEIGHTS, imgsz=IMGSZ)
+    all_results, all_detections = [], []
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        results = model(chunk, imgsz=IMGSZ, conf=CONF, verbose=False)
+        all_results.extend(results)
+        all_detections.extend(Detections.from_result(r) for r in results)
+    return all_results, all_detections
 
-    return total_cost, cost_breakdown
+# Square crop windows (x1, y1, x2, y2) around the most confident candidates.
+# Candidates already inside a window don't get their own.
+def _roi_windows(candidates, shape, roi_size, margin, max_rois):
+    h, w = shape[:2]
+    windows = []
+    for i in np.argsort(-candidates.conf, kind="stable"):
+        x1, y1, x2, y2 = candidates.xyxy[i].tolist()
+        if any(wx1 <= x1 and wy1 <= y1 and x2 <= wx2 and y2 <= wy2 for wx1, wy1, wx2, wy2 in windows):
+            continue
+        side = max(roi_size, (x2 - x1) * (1 + margin), (y2 - y1) * (1 + margin))
+        wx1 = int(np.clip((x1 + x2 - side) / 2, 0, max(w - side, 0)))
+        wy1 = int(np.clip((y1 + y2 - side) / 2, 0, max(h - side, 0)))
+        windows.append((wx1, wy1, min(int(wx1 + side), w), min(int(wy1 + side), h)))
+        if len(windows) >= max_rois:
+            break
+    return windows
 
-# Main pipeline function to process an image and return JSON and annotated image path
-def car_damage_pipeline(image_path):
-    image = load_image(image_path)
-    image_copy = image.copy()
+# Two-pass detection for large photos: a low-resolution pass finds candidate
+# regions, the regions are cropped at native resolution and re-run as one
+# batch, and the boxes are merged back into image coordinates with NMS.
+# Returns (Detections, info) where info has the ROI windows and per-pass timings (ms).
+def detect_damages_roi(image, coarse_imgsz=ROI_COARSE_IMGSZ, roi_imgsz=ROI_IMGSZ, roi_size=ROI_SIZE,
+                       max_rois=ROI_MAX, roi_conf=ROI_CONF, margin=ROI_MARGIN, batch_size=8, iou_threshold=0.5):
+    h, w = image.shape[:2]
+    timings = {}
+
+    start = time.perf_counter()
+    model = get_model(WEIGHTS, imgsz=coarse_imgsz)
+    candidates = Detections.from_result(model(image, imgsz=coarse_imgsz, conf=roi_conf, verbose=False)[0])
+    timings["coarse_ms"] = (time.perf_counter() - start) * 1000.0
+
+    # Small photos are already seen at full resolution by the coarse pass
+    if max(h, w) <= coarse_imgsz or len(candidates) == 0 or max_rois <= 0:
+        return candidates[candidates.conf >= CONF], {"rois": [], "timings": timings}
 
+    start = time.perf_counter()
+    windows = _roi_windows(candidates, image.shape, roi_size, margin, max_rois)
+    crops = [image[y1:y2, x1:x2] for x1, y1, x2, y2 in windows]
+    timings["crop_ms"] = (time.perf_counter() - start) * 1000.0
+
+    start = time.perf_counter()
+    model = get_model(WEIGHTS, imgsz=roi_imgsz)
+    fine = []
+    for chunk_start in range(0, len(crops), batch_size):
+        chunk = crops[chunk_start:chunk_start + batch_size]
+        for (x1, y1, x2, y2), result in zip(windows[chunk_start:chunk_start + batch_size],
+                                            model(chunk, imgsz=roi_imgsz, conf=CONF, verbose=False)):
+            dets = Detections.from_result(result)
+            # Boxes cut off by a crop edge inside the image are left to the coarse pass
+            cut = np.zeros(len(dets), dtype=bool)
+            if x1 > 0:
+                cut |= dets.xyxy[:, 0] <= 1
+            if y1 > 0:
+                cut |= dets.xyxy[:, 1] <= 1
+            if x2 < w:
+                cut |= dets.xyxy[:, 2] >= x2 - x1 - 1
+            if y2 < h:
+                cut |= dets.xyxy[:, 3] >= y2 - y1 - 1
+            dets = dets[~cut]
+            fine.append(Detections(dets.xyxy + np.array([x1, y1, x1, y1], np.float32), dets.conf, dets.cls))
+    timings["fine_ms"] = (time.perf_counter() - start) * 1000.0
+
+    start = time.perf_counter()
+    merged = nms(Detections.concatenate([candidates[candidates.conf >= CONF]] + fine), iou_threshold)
+    timings["merge_ms"] = (time.perf_counter() - start) * 1000.0
+    return merged, {"rois": windows, "timings": timings}
+
+# Shared overlay renderer: the label sprites for every class and confidence
+# are rasterized once per process. Built on first use, so importing this
+# module does not load OpenCV
+_overlay = None
+
+# Draw bounding boxes and labels (blue text on white) on an image in place
+def annotate_image(image, detections):
+    global _overlay
+    if _overlay is None:
+        from overlay import OverlayRenderer
+        _overlay = OverlayRenderer({class_id: name for class_id, (name, *_) in damage_cost_map.items()})
+    return _overlay.draw_detections(image, detections)
+
+# In-memory pipeline: RGB array in, detections, costs and annotated array out.
+# The input is copied before drawing unless inplace=True. With two_pass (default
+# TWO_PASS) detection goes through detect_damages_roi and the result also has
+# "roi" with the ROI windows and per-pass timings.
+def car_damage_pipeline_array(image, inplace=False, two_pass=None):
     # Detect damages
-    results, damage_info = detect_damages(image)
-
-    # Draw bounding boxes on the image copy
-    for damage in damage_info:
-        x_min, y_min, x_max, y_max = map(int, damage['bbox'])
-        confidence = damage['confidence']
-        class_id = damage['class_id']
-        label = f"{damage_cost_map[class_id][0]} ({confidence:.2f})"
-        
-        # Draw the bounding box and add white background with blue text
-        cv2.rectangle(image_copy, (x_min, y_min), (x_max, y_max), (255, 0, 0), 2)
-        cv2.rectangle(image_copy, (x_min, y_min - 20), (x_max, y_min), (255, 255, 255), -1)
-        cv2.putText(image_copy, label, (x_min, y_min - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 1)
-    
-    # Save annotated image
-    annotated_image_path = "static/annotated_image.jpg"  # Save it in a static folder
-    Image.fromarray(image_copy).save(annotated_image_path)
+    roi_info = None
+    if TWO_PASS if two_pass is None else two_pass:
+        detections, roi_info = detect_damages_roi(image)
+    else:
+        results, detections = detect_damages(image)
+
+    # Draw bounding boxes
+    annotated_image = annotate_image(image if inplace else image.copy(), detections)
 
     # Estimate cost
-    total_cost, cost_breakdown = estimate_cost(damage_info)
+    total_cost, cost_breakdown = estimate_cost(detections)
 
-    # Return results along with the annotated image path
-    return {
+    result = {
         "total_cost": total_cost,
         "cost_breakdown": cost_breakdown,
+        "detections": detections,
+        "annotated_image": annotated_image
+    }
+    if roi_info is not None:
+        result["roi"] = roi_info
+    return result
+
+# In-memory pipeline for encoded images (e.g. an upload): bytes in, and the
+# annotated image comes back as encoded bytes too, so nothing touches the disk.
+# With a ResultCache, repeated uploads of the same bytes skip the model: the
+# cached detections and costs are reused and only the annotation is redrawn.
+def car_damage_pipeline_bytes(data, output_format="JPEG", cache=None, two_pass=None):
+    two_pass = TWO_PASS if two_pass is None else two_pass
+    key = None
+    if cache is not None:
+        from backends import resolve
+
+        # Results differ between backends/precisions, so they are part of the key
+        backend, precision = resolve()
+        params = {"imgsz": IMGSZ, "conf": CONF, "backend": backend, "precision": precision}
+        if two_pass:
+            params.update(two_pass=True, coarse_imgsz=ROI_COARSE_IMGSZ, roi_imgsz=ROI_IMGSZ, roi_size=ROI_SIZE,
+                          roi_max=ROI_MAX, roi_conf=ROI_CONF, roi_margin=ROI_MARGIN)
+        key = cache.make_key(data, weights_sha256(WEIGHTS), **params)
+        entry = cache.get(key)
+        if entry is not None:
+            detections = Detections.from_dict(entry["detections"])
+            return {
+                "total_cost": entry["total_cost"],
+                "cost_breakdown": entry["cost_breakdown"],
+                "detections": detections,
+                "annotated_image": render_annotation(data, detections, output_format)
+            }
+
+    result = car_damage_pipeline_array(decode_image(data), inplace=True, two_pass=two_pass)
+    result["annotated_image"] = encode_image(result["annotated_image"], output_format)
+    if cache is not None:
+        cache.put(key, {
+            "total_cost": result["total_cost"],
+            "cost_breakdown": result["cost_breakdown"],
+            "detections": result["detections"].to_dict()
+        })
+    return result
+
+# Redraw detections (e.g. from a cache entry) on an encoded image
+def render_annotation(data, detections, output_format="JPEG"):
+    return encode_image(annotate_image(decode_image(data), detections), output_format)
+
+# Main pipeline function to process an image and return JSON and annotated image path
+def car_damage_pipeline(image_path, two_pass=None):
+    result = car_damage_pipeline_array(load_image(image_path), inplace=True, two_pass=two_pass)
+
+    # Save annotated image
+    annotated_image_path = "static/annotated_image.jpg"  # Save it in a static folder
+    Image.fromarray(result["annotated_image"]).save(annotated_image_path)
+
+    # Return results along with the annotated image path
+    output = {
+        "total_cost": result["total_cost"],
+        "cost_breakdown": result["cost_breakdown"],
         "annotated_image_path": annotated_image_path
-    }
\ No newline at end of file
+    }
+    if "roi" in result:
+        output["roi"] = result["roi"]
+    return output
+
+# Batch pipeline: takes image paths (or RGB arrays) and returns one result dict
+# per image, in the same shape as car_damage_pipeline
+def car_damage_pipeline_batch(images, batch_size=8, output_dir="static"):
+    os.makedirs(output_dir, exist_ok=True)
+    arrays = [load_image(img) if isinstance(img, (str, os.PathLike)) else img for img in images]
+
+    # Detect damages for the whole batch
+    _, batch_detections = detect_damages_batch(arrays, batch_size=batch_size)
+    batch_costs = estimate_cost_batch(batch_detections)
+
+    outputs = []
+    for i, (image, detections, (total_cost, cost_breakdown)) in enumerate(zip(arrays, batch_detections, batch_costs)):
+        if isinstance(images[i], (str, os.PathLike)):
+            name = os.path.splitext(os.path.basename(images[i]))[0]
+        else:
+            name = str(i)
+        annotated_image_path = os.path.join(output_dir, f"annotated_{i}_{name}.jpg")
+        # Arrays that came from the caller are copied; freshly loaded ones are drawn on directly
+        if not isinstance(images[i], (str, os.PathLike)):
+            image = image.copy()
+        Image.fromarray(annotate_image(image, detections)).save(annotated_image_path)
+
+        outputs.append({
+            "total_cost": total_cost,
+            "cost_breakdown": cost_breakdown,
+            "annotated_image_path": annotated_image_path
+        })
+
+    return outputs
@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from model_registry import DEFAULT_WEIGHTS, DEFAULT_IMGSZ
+
+# Cold-start report: what a fresh worker process pays before it can serve its
+# first frame. Every measurement runs in a new interpreter, so nothing is
+# already imported or loaded; module import times include their dependencies.
+
+MODULES = ("numpy", "cv2", "av", "torch", "ultralytics", "aiortc",
+           "damage_costs", "car_pipeline", "capture_worker", "server")
+
+_IMPORT_SNIPPET = """
+import json, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start}}))
+"""
+
+_MODEL_SNIPPET = """
+import json, time
+start = time.perf_counter()
+import numpy as np
+from model_registry import get_model, load_times
+imported = time.perf_counter()
+model = get_model({weights!r}, device="cpu", imgsz={imgsz})
+loaded = time.perf_counter()
+frame = np.zeros(({imgsz}, {imgsz}, 3), dtype=np.uint8)
+model.predict(frame, imgsz={imgsz}, device="cpu", verbose=False)
+done = time.perf_counter()
+times = next(iter(load_times().values()))
+print(json.dumps({{
+    "import_s": imported - start,
+    "load_s": times["load_s"],
+    "warmup_s": times["warmup_s"],
+    "first_inference_s": done - loaded,
+    "first_frame_s": done - start,
+}}))
+"""
+
+
+def _run(snippet, env=None):
+    result = subprocess.run([sys.executable, "-c", snippet], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, **(env or {})})
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        return {"error": lines[-1] if lines else f"exit code {result.returncode}"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def import_times(modules=MODULES, repeats=3):
+    """Best-of-``repeats`` import time of each module in a fresh process."""
+    report = {}
+    for module in modules:
+        runs = [_run(_IMPORT_SNIPPET.format(module=module)) for _ in range(repeats)]
+        ok = [r["seconds"] for r in runs if "seconds" in r]
+        report[module] = {"seconds": min(ok)} if ok else runs[0]
+    return report
+
+
+def model_times(weights=DEFAULT_WEIGHTS, imgsz=DEFAULT_IMGSZ):
+    """Time to first frame with and without the pre-fused checkpoint.
+
+    The fused run goes last and after one untimed run that writes the
+    checkpoint, so it measures a worker starting from an existing artifact.
+    """
+    snippet = _MODEL_SNIPPET.format(weights=weights, imgsz=imgsz)
+    report = {"raw_weights": _run(snippet, {"DAMAGE_BACKEND": "torch", "DAMAGE_FUSED_ARTIFACT": "0"})}
+    _run(snippet, {"DAMAGE_BACKEND": "torch", "DAMAGE_FUSED_ARTIFACT": "1"})
+    report["fused_artifact"] = _run(snippet, {"DAMAGE_BACKEND": "torch", "DAMAGE_FUSED_ARTIFACT": "1"})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time and first-inference report for a fresh worker.")
+    parser.add_argument("--modules", nargs="+", default=list(MODULES))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--weights", default=DEFAULT_WEIGHTS)
+    parser.add_argument("--imgsz", type=int, default=DEFAULT_IMGSZ)
+    parser.add_argument("--no-model", action="store_true", help="only report import times")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = {"imports": import_times(args.modules, args.repeats)}
+    print(f"{'module':<16} {'import s':>9}")
+    for module, result in report["imports"].items():
+        value = f"{result['seconds']:>9.3f}" if "seconds" in result else f"  failed: {result['error']}"
+        print(f"{module:<16} {value}")
+
+    if not args.no_model:
+        report["model"] = model_times(args.weights, args.imgsz)
+        columns = ("import_s", "load_s", "warmup_s", "first_inference_s", "first_frame_s")
+        print(f"\n{'model':<16}" + "".join(f"{c:>18}" for c in columns))
+        for name, result in report["model"].items():
+            if "error" in result:
+                print(f"{name:<16}  failed: {result['error']}")
+            else:
+                print(f"{name:<16}" + "".join(f"{result[c]:>18.3f}" for c in columns))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
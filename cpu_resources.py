@@ -0,0 +1,371 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+import cv2
+
+import metrics
+
+logger = logging.getLogger("ai-damage-backend")
+
+# CPU budgets for live inference. Left alone, every concurrent model call
+# runs with torch's default intra-op pool (one thread per core), so a few
+# streams on a big host oversubscribe it and throughput collapses. The
+# resource manager splits the cores into a plan of N inference workers with
+# T threads each: one fat worker (lowest latency) for a stream or two, more
+# and thinner workers (highest throughput) as streams are added. Model calls
+# run inside ``resources.worker()``, which waits for a free worker slot and,
+# with CPU_PIN=1, pins the calling thread (Linux affinity is per thread) to
+# that slot's cores. Every worker in a plan gets the same thread count,
+# because torch's intra-op count (and MKL's) is process-wide: one value per
+# plan is the only budget that holds for all workers at once. Ultralytics
+# models are not thread-safe, so each slot predicts with its own model
+# replica: ``get_model(..., replica=slot)``. When the plan grows, the new
+# slots are handed out only once their replicas of the models already loaded
+# are warm, so a cold load never lands on a live frame. CPU_MAX_REPLICAS caps
+# the workers, and so the copies kept of each model.
+#
+# The split for a given number of streams comes from a table measured by
+# ``python cpu_resources.py --benchmark`` (CPU_PLAN_FILE) when there is one,
+# and from the CPU_STREAMS_PER_WORKER heuristic otherwise.
+
+CPU_PLAN = os.environ.get("CPU_PLAN", "auto")  # auto | fat | thin | <workers>x<threads>
+CPU_PIN = os.environ.get("CPU_PIN", "0") == "1"
+MIN_THREADS = int(os.environ.get("CPU_MIN_THREADS", "2"))  # thinnest worker
+STREAMS_PER_WORKER = int(os.environ.get("CPU_STREAMS_PER_WORKER", "2"))
+MAX_REPLICAS = int(os.environ.get("CPU_MAX_REPLICAS", "4"))  # most workers, i.e. copies of each model
+INTEROP_THREADS = int(os.environ.get("CPU_INTEROP_THREADS", "1"))
+CPU_PLAN_FILE = os.environ.get("CPU_PLAN_FILE",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), "cpu_plan.json"))
+
+# ``core_sets`` holds one tuple of ``threads`` core ids per worker
+WorkerPlan = namedtuple("WorkerPlan", "workers threads core_sets opencv_threads")
+
+
+def available_cores():
+    """Core ids this process may run on (cgroup/taskset aware on Linux)."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:  # not Linux
+        return list(range(os.cpu_count() or 1))
+
+
+def split_cores(cores, workers):
+    """Contiguous, equal core sets; leftover cores are not used."""
+    size = len(cores) // workers
+    return [tuple(cores[i * size:(i + 1) * size]) for i in range(workers)]
+
+
+def _parse_plan(value, cores):
+    workers, _, threads = value.partition("x")
+    workers = max(1, min(int(workers), len(cores)))
+    threads = max(1, min(int(threads or 0) or len(cores) // workers, len(cores) // workers))
+    return workers, threads
+
+
+def load_plan_table(path=CPU_PLAN_FILE):
+    """{streams: workers} measured by the benchmark, or None."""
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("cores") != len(available_cores()):
+        logger.warning(f"{path} was measured on {data.get('cores')} cores, not {len(available_cores())}; ignoring it")
+        return None
+    return {int(streams): entry["workers"] for streams, entry in data["best"].items()}
+
+
+class CpuResourceManager:
+    """Hands out inference worker slots according to the current plan.
+
+    ``set_active_streams(n)`` (or ``open_stream``/``close_stream``) tells it
+    how many live streams there are; ``with manager.worker() as slot:``
+    wraps each blocking model call. ``slot`` is the worker's index: use it
+    as the model replica and for per-worker buffers. Slots beyond the
+    first are only handed out once their replicas are warm (``warm_slot``,
+    model_registry.warm_replica by default).
+    """
+
+    def __init__(self, cores=None, mode=CPU_PLAN, pin=CPU_PIN, table=None, min_threads=MIN_THREADS,
+                 streams_per_worker=STREAMS_PER_WORKER, interop_threads=INTEROP_THREADS,
+                 max_replicas=MAX_REPLICAS, warm_slot=None):
+        self.cores = list(cores) if cores is not None else available_cores()
+        self.mode = mode
+        self.pin = pin
+        self.table = table if table is not None else load_plan_table()
+        self.min_threads = max(1, min_threads)
+        self.streams_per_worker = max(1, streams_per_worker)
+        self.interop_threads = interop_threads
+        self.max_workers = max(1, min(len(self.cores) // self.min_threads, max_replicas))
+        self.warm_slot = warm_slot
+        self.active_streams = 0
+        self.busy = 0
+        self.plan = self.plan_for(0)
+        self._cond = threading.Condition()
+        self._free = set(range(self.plan.workers))
+        self._held = set()
+        self._ready = 1  # slots [0, _ready) have warm replicas; replica 0 is warmed by the app
+        self._warming = False
+        self._local = threading.local()
+        self._process_setup = False
+
+    def plan_for(self, streams):
+        """The WorkerPlan for ``streams`` concurrent live streams."""
+        threads = None
+        if self.mode == "fat":
+            workers = 1
+        elif self.mode == "thin":
+            workers = self.max_workers
+        elif self.mode != "auto":
+            workers, threads = _parse_plan(self.mode, self.cores)
+            workers = min(workers, self.max_workers)
+        elif self.table:
+            # Measured split for the largest benchmarked stream count not above ours
+            known = [s for s in self.table if s <= max(streams, 1)]
+            workers = self.table[max(known)] if known else self.table[min(self.table)]
+        else:
+            workers = -(-max(streams, 1) // self.streams_per_worker)
+        if threads is None:
+            workers = max(1, min(workers, self.max_workers))
+            threads = len(self.cores) // workers
+        core_sets = split_cores(self.cores[:workers * threads], workers)
+        # OpenCV's pool is process-wide: let it use the cores only when one worker owns them all
+        return WorkerPlan(workers, threads, core_sets, threads if workers == 1 else 1)
+
+    def set_active_streams(self, streams):
+        with self._cond:
+            self.active_streams = max(0, streams)
+            plan = self.plan_for(self.active_streams)
+            if plan == self.plan:
+                return
+            self.plan = plan
+            # Slots still running under the old plan come back when they finish
+            self._free = set(range(plan.workers)) - self._held
+            self._cond.notify_all()
+            warm = plan.workers > self._ready and not self._warming
+            self._warming = self._warming or warm
+        if warm:
+            threading.Thread(target=self._warm_slots, name="replica-warmup", daemon=True).start()
+        cv2.setNumThreads(plan.opencv_threads)
+        logger.info(f"CPU plan for {streams} streams: {plan.workers} workers x {plan.threads} threads")
+
+    @property
+    def ready_workers(self):
+        """Workers of the current plan that can run a model call now."""
+        return min(self.plan.workers, self._ready)
+
+    def _warm_slots(self):
+        while True:
+            with self._cond:
+                if self._ready >= self.plan.workers:
+                    self._warming = False
+                    return
+                slot = self._ready
+            try:
+                if self.warm_slot is not None:
+                    self.warm_slot(slot)
+                else:
+                    from model_registry import warm_replica
+                    warm_replica(slot)
+            except Exception as e:
+                logger.error(f"Warming the models of worker {slot} failed: {e}")
+            with self._cond:
+                self._ready = slot + 1
+                self._cond.notify_all()
+
+    def open_stream(self):
+        self.set_active_streams(self.active_streams + 1)
+
+    def close_stream(self):
+        self.set_active_streams(self.active_streams - 1)
+
+    def _setup_process(self):
+        # Inter-op threads are process-wide and can only be set before torch first uses them
+        import torch
+        try:
+            torch.set_num_interop_threads(self.interop_threads)
+        except RuntimeError:
+            pass
+        cv2.setNumThreads(self.plan.opencv_threads)
+        self._process_setup = True
+
+    def _apply(self, threads, cores):
+        # The thread count is the same for every worker of a plan, so setting
+        # it from any of them is consistent. Another thread may have changed it
+        # for a newer plan since, so compare with torch's own value rather than
+        # remembering ours; only affinity is tracked per thread
+        import torch
+        if torch.get_num_threads() != threads:
+            torch.set_num_threads(threads)
+        if getattr(self._local, "cores", None) != cores:
+            if hasattr(os, "sched_setaffinity"):
+                os.sched_setaffinity(0, cores if self.pin else self.cores)
+            self._local.cores = cores
+
+    @contextmanager
+    def worker(self):
+        """Run the body as one inference worker of the current plan; yields the slot index."""
+        if not self._process_setup:
+            self._setup_process()
+        with self._cond:
+            while not any(s < self._ready for s in self._free):
+                self._cond.wait()
+            slot = min(s for s in self._free if s < self._ready)
+            self._free.discard(slot)
+            self._held.add(slot)
+            self.busy += 1
+            threads, cores = self.plan.threads, self.plan.core_sets[slot]
+        try:
+            self._apply(threads, cores)
+            yield slot
+        finally:
+            with self._cond:
+                self._held.discard(slot)
+                self.busy -= 1
+                if slot < self.plan.workers:
+                    self._free.add(slot)
+                self._cond.notify()
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_resource_manager():
+    """Process-wide CpuResourceManager (created on first use)."""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = CpuResourceManager()
+            metrics.register_gauge("cpu_plan_workers", lambda: _manager.plan.workers)
+            metrics.register_gauge("cpu_active_streams", lambda: _manager.active_streams)
+            metrics.register_gauge("inference_workers_busy", lambda: _manager.busy)
+            metrics.register_gauge("inference_workers_ready", lambda: _manager.ready_workers)
+            metrics.describe("cpu_plan_workers", "Inference workers the cores are currently split into")
+            metrics.describe("inference_workers_busy", "Inference workers running a model call right now")
+        return _manager
+
+
+def pin_process_threads(threads):
+    """Give a whole process a fixed thread budget (process-pool workers)."""
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # already set (torch was imported and used before us)
+    cv2.setNumThreads(1)
+
+
+# --- benchmark ---
+
+def _candidate_workers(cores, min_threads):
+    workers, candidates = 1, []
+    while len(cores) // workers >= min_threads:
+        candidates.append(workers)
+        workers *= 2
+    return candidates
+
+
+def _measure(manager, infer, streams, seconds):
+    """Run ``streams`` threads calling ``infer(slot)`` through ``manager``; frames/s and p95 latency."""
+    latencies, stop = [], time.perf_counter() + seconds
+    lock = threading.Lock()
+
+    def stream():
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            with manager.worker() as slot:
+                infer(slot)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=stream, daemon=True) for _ in range(streams)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "fps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000.0 if latencies else None,
+        "p95_ms": latencies[int(0.95 * (len(latencies) - 1))] * 1000.0 if latencies else None,
+    }
+
+
+def benchmark(streams_sweep=(1, 2, 4, 8, 16), seconds=10.0, imgsz=640, pin=CPU_PIN, min_threads=MIN_THREADS):
+    """Time every workers x threads split for each stream count on this host.
+
+    Each stream is a thread sending frames back to back, as a live track
+    with no frame budget would. The best split per stream count is the one
+    with the highest total frames/s.
+    """
+    import numpy as np
+    from model_registry import get_model
+
+    frame = np.random.default_rng(0).integers(0, 255, (imgsz, imgsz, 3), dtype=np.uint8)
+
+    def infer(slot):
+        model = get_model(device="cpu", imgsz=imgsz, replica=slot)
+        model.predict(frame, imgsz=imgsz, device="cpu", verbose=False)
+
+    cores = available_cores()
+    results, best = [], {}
+    for streams in streams_sweep:
+        for workers in _candidate_workers(cores, min_threads):
+            if workers > streams:
+                break  # extra workers would sit idle
+            manager = CpuResourceManager(cores, mode=f"{workers}x{len(cores) // workers}", pin=pin, table={},
+                                         max_replicas=len(cores), warm_slot=lambda slot: infer(slot))
+            manager.set_active_streams(streams)
+            with manager.worker() as slot:
+                infer(slot)  # settle thread pools at the new size
+            while manager.ready_workers < workers:  # replicas load in the background
+                time.sleep(0.1)
+            row = {"streams": streams, "workers": workers, "threads": len(cores) // workers,
+                   **_measure(manager, infer, streams, seconds)}
+            results.append(row)
+            logger.info(f"{streams:>3} streams, {workers:>2} x {row['threads']:>2} threads: "
+                        f"{row['fps']:6.1f} fps, p95 {row['p95_ms']:7.1f} ms")
+            if str(streams) not in best or row["fps"] > best[str(streams)]["fps"]:
+                best[str(streams)] = row
+    return {"cores": len(cores), "pin": pin, "imgsz": imgsz, "results": results, "best": best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or measure how inference workers split the CPU cores.")
+    parser.add_argument("--benchmark", action="store_true", help="measure every split and save the best per stream count")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument("--seconds", type=float, default=10.0, help="measurement time per split")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--output", default=CPU_PLAN_FILE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.benchmark:
+        report = benchmark(args.streams, args.seconds, args.imgsz)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {args.output}")
+        table = {int(s): entry["workers"] for s, entry in report["best"].items()}
+    else:
+        table = None
+    manager = CpuResourceManager(table=table)
+    print(f"{'streams':>7}  plan ({len(manager.cores)} cores, mode {manager.mode})")
+    for streams in args.streams:
+        plan = manager.plan_for(streams)
+        print(f"{streams:>7}  {plan.workers} workers x {plan.threads} threads")
+
+
+if __name__ == "__main__":
+    main()
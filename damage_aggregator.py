@@ -0,0 +1,227 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+import metrics
+from damage_costs import damage_cost_map, estimate_costs
+from detections import box_iou
+
+# Claim-level aggregation for live streams. Per-frame cost estimates count the
+# same dent again on every frame and jump as the camera moves; a
+# DamageAggregator instead folds each keyframe's detections into a bounded
+# set of unique damage instances. A detection is matched to an instance by
+# position (IoU with instances seen in the last few updates, same class) or,
+# once the damage has left the view and comes back, by an 8x8 average hash of
+# its patch. Every instance keeps running confidence statistics (Welford) and
+# the claim total is adjusted by the change of one instance's cost, so an
+# update costs the same on the first frame and after an hour; memory grows
+# with the number of distinct damages only, capped at MAX_INSTANCES.
+
+MAX_INSTANCES = int(os.environ.get("CLAIM_MAX_INSTANCES", "64"))
+MIN_HITS = int(os.environ.get("CLAIM_MIN_HITS", "3"))  # keyframes before a damage counts towards the claim
+
+
+def average_hash(patch):
+    """64-bit average hash of an image patch (BGR or grayscale)."""
+    import cv2  # only needed once there are frames, not at import
+    if patch.ndim == 3:
+        patch = cv2.cvtColor(patch, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(patch, (8, 8), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(small > small.mean()).tobytes(), "big")
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class DamageInstance:
+    """One physical damage seen over several frames."""
+    __slots__ = ("id", "cls", "box", "hash", "first_seen", "last_seen", "last_update",
+                 "hits", "conf_mean", "conf_m2", "conf_max", "cost")
+
+    def __init__(self, instance_id, cls, box, hash_, conf, update, now):
+        self.id = instance_id
+        self.cls = cls
+        self.box = box
+        self.hash = hash_
+        self.first_seen = self.last_seen = now
+        self.last_update = update
+        self.hits = 0
+        self.conf_mean = self.conf_m2 = self.conf_max = 0.0
+        self.cost = 0.0
+        self.observe(box, hash_, conf, update, now)
+
+    def observe(self, box, hash_, conf, update, now):
+        # Welford's running mean/variance of the confidence
+        self.hits += 1
+        delta = conf - self.conf_mean
+        self.conf_mean += delta / self.hits
+        self.conf_m2 += delta * (conf - self.conf_mean)
+        self.conf_max = max(self.conf_max, conf)
+        self.box = box
+        if hash_ is not None:
+            self.hash = hash_
+        self.last_seen = now
+        self.last_update = update
+
+    @property
+    def conf_std(self):
+        return (self.conf_m2 / (self.hits - 1)) ** 0.5 if self.hits > 1 else 0.0
+
+    def to_dict(self, start):
+        return {
+            "id": self.id,
+            "type": damage_cost_map[self.cls][0] if self.cls in damage_cost_map else None,
+            "class_id": self.cls,
+            "hits": self.hits,
+            "confidence_mean": self.conf_mean,
+            "confidence_std": self.conf_std,
+            "confidence_max": self.conf_max,
+            "estimated_cost": self.cost,
+            "first_seen_s": self.first_seen - start,
+            "last_seen_s": self.last_seen - start,
+        }
+
+
+class DamageAggregator:
+    """Running claim estimate for one stream or session.
+
+    Feed it fresh model detections with ``update(detections, image, scale)``
+    (keyframes only: tracked boxes between keyframes add no information).
+    ``image`` is the frame the boxes belong to, possibly downscaled by
+    ``scale``; it is used for the appearance hashes. A damage counts towards
+    the claim once it has been detected on ``min_hits`` keyframes, with its
+    cost priced at its mean confidence. ``estimate()`` returns ``(total,
+    breakdown)`` like estimate_cost, ``report()`` the full session summary.
+    Thread-safe, so a UI thread can read while the stream updates.
+    """
+
+    def __init__(self, max_instances=MAX_INSTANCES, min_hits=MIN_HITS, iou_threshold=0.3,
+                 hash_threshold=10, active_updates=3, name=None):
+        self.max_instances = max_instances
+        self.min_hits = min_hits
+        self.iou_threshold = iou_threshold
+        self.hash_threshold = hash_threshold
+        self.active_updates = active_updates
+        self.name = name
+        self.updates = 0
+        self.detections_seen = 0
+        self.evicted = 0
+        self.confirmed = 0  # damages that count towards the claim
+        self.total_cost = 0.0
+        self._instances = {}
+        self._next_id = 1
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def _patch_hash(self, image, box, scale):
+        if image is None:
+            return None
+        x0, y0, x1, y1 = (int(round(v * scale)) for v in box)
+        h, w = image.shape[:2]
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, w), min(y1, h)
+        if x1 - x0 < 4 or y1 - y0 < 4:
+            return None
+        return average_hash(image[y0:y1, x0:x1])
+
+    def _price(self, instance):
+        # Only confirmed instances are part of the claim; the total moves by this instance's change
+        cost = 0.0
+        if instance.hits == self.min_hits:
+            self.confirmed += 1
+        if instance.hits >= self.min_hits:
+            cost = float(estimate_costs([instance.cls], [instance.conf_mean])[0])
+            if cost != cost:  # NaN: class without a cost range
+                cost = 0.0
+        self.total_cost += cost - instance.cost
+        instance.cost = cost
+
+    def update(self, detections, image=None, scale=1.0):
+        """Fold one keyframe's detections into the claim; returns the claim total."""
+        now = time.time()
+        with self._lock:
+            self.updates += 1
+            self.detections_seen += len(detections)
+            instances = list(self._instances.values())
+            recent = [i for i in instances if self.updates - i.last_update <= self.active_updates]
+            iou = box_iou(detections.xyxy, np.array([i.box for i in recent], np.float32)) if recent else None
+            matched = set()
+
+            for d in np.argsort(-detections.conf).tolist():
+                cls = int(detections.cls[d])
+                box = detections.xyxy[d].tolist()
+                conf = float(detections.conf[d])
+                hash_ = self._patch_hash(image, box, scale)
+                instance = None
+
+                # Same place as a damage seen moments ago. Candidates were listed
+                # before this frame's additions, which may have evicted some of them
+                if iou is not None:
+                    best = 0.0
+                    for j, candidate in enumerate(recent):
+                        if (candidate.cls == cls and candidate.id not in matched and candidate.id in self._instances
+                                and iou[d, j] > max(best, self.iou_threshold)):
+                            best, instance = iou[d, j], candidate
+                # Out of view for a while: recognise it by its looks. Recently seen
+                # instances that did not overlap are elsewhere in the frame, so they are skipped
+                if instance is None and hash_ is not None:
+                    best = self.hash_threshold + 1
+                    for candidate in instances:
+                        if (candidate.cls == cls and candidate.hash is not None and candidate.id in self._instances
+                                and self.updates - candidate.last_update > self.active_updates):
+                            distance = hamming(hash_, candidate.hash)
+                            if distance < best:
+                                best, instance = distance, candidate
+
+                if instance is None:
+                    instance = self._add(cls, box, hash_, conf, now)
+                    if instance is None:
+                        continue
+                else:
+                    instance.observe(box, hash_, conf, self.updates, now)
+                matched.add(instance.id)
+                self._price(instance)
+
+            if self.name is not None:
+                metrics.set_gauge("claim_total_aed", self.total_cost, peer=self.name)
+                metrics.set_gauge("claim_damages", self.confirmed, peer=self.name)
+            return self.total_cost
+
+    def _add(self, cls, box, hash_, conf, now):
+        if len(self._instances) >= self.max_instances:
+            # Make room by dropping the weakest instance: unconfirmed ones first, then by hits and confidence
+            weakest = min(self._instances.values(),
+                          key=lambda i: (i.hits >= self.min_hits, i.hits, i.conf_mean))
+            if weakest.hits >= self.min_hits:
+                return None  # every slot holds a confirmed damage; keep them rather than a one-off
+            self.total_cost -= weakest.cost
+            del self._instances[weakest.id]
+            self.evicted += 1
+        instance = DamageInstance(self._next_id, cls, box, hash_, conf, self.updates, now)
+        self._instances[instance.id] = instance
+        self._next_id += 1
+        return instance
+
+    def estimate(self):
+        """``(total_cost, cost_breakdown)`` over the confirmed damages, like estimate_cost."""
+        with self._lock:
+            breakdown = [{"type": damage_cost_map[i.cls][0], "estimated_cost": i.cost}
+                         for i in self._instances.values() if i.hits >= self.min_hits and i.cls in damage_cost_map]
+            return self.total_cost, breakdown
+
+    def report(self):
+        """Session summary: claim total, confirmed damages and counters."""
+        with self._lock:
+            damages = sorted((i for i in self._instances.values() if i.hits >= self.min_hits),
+                             key=lambda i: -i.cost)
+            return {
+                "total_cost": self.total_cost,
+                "damages": [i.to_dict(self._start) for i in damages],
+                "candidates": len(self._instances) - len(damages),
+                "keyframes": self.updates,
+                "detections": self.detections_seen,
+                "evicted": self.evicted,
+                "duration_s": time.time() - self._start,
+            }
@@ -0,0 +1,71 @@
+import numpy as np
+
+from detections import Detections
+
+# Repair cost estimation. Deliberately import-light (NumPy only): code that
+# just prices detections, such as aggregators, reports or batch jobs, should
+# not pay for OpenCV, PIL or the model stack on import. car_pipeline
+# re-exports everything here.
+
+# Function to estimate repair costs
+damage_cost_map = {
+    0: ('crack_and_hole', 500, 2500),           # AED
+    1: ('medium_deformation', 400, 600),       # AED
+    2: ('severe_deformation', 1000, 3000),     # AED
+    3: ('severe_scratch', 700, 2000),          # AED (per panel)
+    4: ('slight_deformation', 200, 400),       # AED
+    5: ('slight_scratch', 100, 250),           # AED (per panel)
+    6: ('windshield_damage', 200, 3000)        # AED (repair vs. replacement)
+}
+
+# Precomputed lookup: row i holds the (min, max) AED range of class i, NaN for
+# ids that are not in damage_cost_map
+_cost_table = np.full((max(damage_cost_map) + 1, 2), np.nan)
+for _class_id, (_, _min_cost, _max_cost) in damage_cost_map.items():
+    _cost_table[_class_id] = (_min_cost, _max_cost)
+_class_names = [damage_cost_map[i][0] if i in damage_cost_map else None for i in range(len(_cost_table))]
+
+# Per-detection cost estimate for arrays of class ids and confidences (NaN for unknown classes)
+def estimate_costs(cls, conf):
+    cls = np.asarray(cls, dtype=np.int64)
+    conf = np.asarray(conf, dtype=np.float64)
+    costs = np.full(cls.shape, np.nan)
+    valid = (cls >= 0) & (cls < len(_cost_table))
+    ranges = _cost_table[cls[valid]]
+    costs[valid] = ranges[:, 0] + (ranges[:, 1] - ranges[:, 0]) * conf[valid]
+    return costs
+
+# Accepts Detections or the older list of {'class_id', 'confidence'} dicts
+def _as_detections(detections):
+    if isinstance(detections, Detections):
+        return detections
+    return Detections(
+        [damage.get('bbox', (0, 0, 0, 0)) for damage in detections],
+        [damage['confidence'] for damage in detections],
+        [damage['class_id'] for damage in detections],
+    )
+
+def _summarize_costs(cls, costs):
+    known = ~np.isnan(costs)
+    cost_breakdown = [
+        {"type": _class_names[class_id], "estimated_cost": estimated_cost}
+        for class_id, estimated_cost in zip(cls[known].tolist(), costs[known].tolist())
+    ]
+    return float(costs[known].sum()), cost_breakdown
+
+def estimate_cost(detections):
+    detections = _as_detections(detections)
+    return _summarize_costs(detections.cls, estimate_costs(detections.cls, detections.conf))
+
+# Estimate costs for a whole batch of per-image detections in one vectorized pass
+def estimate_cost_batch(batch_detections):
+    batch_detections = [_as_detections(d) for d in batch_detections]
+    merged = Detections.concatenate(batch_detections)
+    costs = estimate_costs(merged.cls, merged.conf)
+
+    outputs, start = [], 0
+    for detections in batch_detections:
+        end = start + len(detections)
+        outputs.append(_summarize_costs(merged.cls[start:end], costs[start:end]))
+        start = end
+    return outputs
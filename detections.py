@@ -0,0 +1,111 @@
+import numpy as np
+
+
+def box_iou(a, b):
+    """Pairwise IoU between (N, 4) and (M, 4) xyxy boxes, as an (N, M) array."""
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+def nms(detections, iou_threshold=0.5, class_agnostic=False):
+    """Greedy non-maximum suppression, highest confidence first.
+
+    Boxes of different classes never suppress each other unless
+    ``class_agnostic`` is set. Returns the kept detections sorted by
+    confidence.
+    """
+    if len(detections) == 0:
+        return detections
+    order = np.argsort(-detections.conf, kind="stable")
+    boxes = detections.xyxy[order]
+    if not class_agnostic:
+        # Shift each class to its own region of the plane so classes never overlap
+        boxes = boxes + detections.cls[order].astype(np.float32)[:, None] * (float(boxes.max()) + 1.0)
+    iou = box_iou(boxes, boxes)
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= iou[i] > iou_threshold
+    return detections[order[keep]]
+
+
+class Detections:
+    """Columnar detections for one image, backed by NumPy arrays.
+
+    ``xyxy`` is (N, 4) float32 box corners, ``conf`` (N,) float32 scores and
+    ``cls`` (N,) int64 class ids. Built from an Ultralytics result with a
+    single device-to-host copy instead of one ``.cpu()`` call per box.
+    """
+    __slots__ = ("xyxy", "conf", "cls")
+
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        self.conf = np.asarray(conf, dtype=np.float32).reshape(-1)
+        self.cls = np.asarray(cls, dtype=np.int64).reshape(-1)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int64))
+
+    @classmethod
+    def from_boxes(cls, boxes):
+        if boxes is None or len(boxes) == 0:
+            return cls.empty()
+        # boxes.data is (N, 6) [x1, y1, x2, y2, conf, cls], or (N, 7) with a
+        # track id before conf when tracking; one transfer for the whole frame
+        data = boxes.data.cpu().numpy()
+        return cls(data[:, :4], data[:, -2], data[:, -1])
+
+    @classmethod
+    def from_result(cls, result):
+        if result is None:
+            return cls.empty()
+        return cls.from_boxes(result.boxes)
+
+    @classmethod
+    def concatenate(cls, items):
+        items = list(items)
+        if not items:
+            return cls.empty()
+        return cls(np.concatenate([d.xyxy for d in items]),
+                   np.concatenate([d.conf for d in items]),
+                   np.concatenate([d.cls for d in items]))
+
+    def __len__(self):
+        return len(self.conf)
+
+    def __getitem__(self, index):
+        """Select detections with a boolean mask, index array or slice."""
+        return Detections(self.xyxy[index], self.conf[index], self.cls[index])
+
+    def to_damage_info(self):
+        """Per-box dicts in the original ``detect_damages`` format."""
+        return [
+            {"class_id": class_id, "confidence": confidence, "bbox": bbox}
+            for class_id, confidence, bbox in zip(self.cls.tolist(), self.conf.tolist(), self.xyxy)
+        ]
+
+    def to_dict(self):
+        """JSON-friendly representation."""
+        return {
+            "xyxy": self.xyxy.tolist(),
+            "conf": self.conf.tolist(),
+            "cls": self.cls.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["xyxy"], data["conf"], data["cls"])
+
+    def __repr__(self):
+        return f"Detections(n={len(self)})"
@@ -0,0 +1,187 @@
+import sys
+
+import av
+import cv2
+import numpy as np
+
+import metrics
+from detections import Detections
+
+# Allocation-free frame path for the live video tracks. Decoded yuv420p
+# frames are converted straight from their Y/U/V planes: to BGR directly
+# into a pooled output av.VideoFrame, to a letterboxed inference canvas at
+# the model's resolution, and the Y plane doubles as the grayscale frame for
+# tracking. Every frame-sized array comes from a pool and is reused, so in
+# steady state nothing frame-sized is allocated; ``allocations`` counts the
+# times a pool had to allocate (it only grows on start-up or when the
+# resolution changes). Frames in other pixel formats take a slower
+# fallback through to_ndarray(), counted in ``fallbacks``.
+
+LETTERBOX_COLOR = 114
+
+
+def _count_allocation(pool):
+    pool.allocations += 1
+    metrics.inc("frame_buffer_allocations_total")
+
+
+class BufferPool:
+    """Named arrays that are reused as long as their shape and dtype match."""
+
+    def __init__(self):
+        self._arrays = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8, fill=None):
+        shape = tuple(shape)
+        array = self._arrays.get(name)
+        if array is None or array.shape != shape or array.dtype != dtype:
+            array = self._arrays[name] = np.empty(shape, dtype)
+            if fill is not None:
+                array.fill(fill)
+            _count_allocation(self)
+        return array
+
+
+class VideoFramePool:
+    """Reused set of writable bgr24 av.VideoFrames for output.
+
+    A frame is only handed out again once nobody but the pool holds it, so a
+    consumer that keeps a returned frame around (streamlit-webrtc's async
+    mode re-sends its latest result while the next one is being processed)
+    never sees it overwritten. ``size`` frames are allocated up front; more
+    only if all of them are still held elsewhere.
+    """
+
+    def __init__(self, size=3):
+        self.size = size
+        self.allocations = 0
+        self._frames = []
+        self._next = 0
+        self._idle_refs = None  # reference count of a frame only the pool holds
+
+    @staticmethod
+    def _refs(entry):
+        return sys.getrefcount(entry[0])
+
+    def _allocate(self, width, height):
+        frame = av.VideoFrame(width, height, "bgr24")
+        plane = frame.planes[0]
+        rows = np.frombuffer(plane, np.uint8).reshape(height, plane.line_size)
+        entry = (frame, rows[:, :width * 3].reshape(height, width, 3))
+        del frame, plane, rows
+        self._frames.append(entry)
+        if self._idle_refs is None:
+            self._idle_refs = self._refs(entry)
+        _count_allocation(self)
+        return entry
+
+    def acquire(self, width, height):
+        """Return ``(frame, array)``: the array is an HxWx3 view of the frame's pixels."""
+        if self._frames and (self._frames[0][0].width, self._frames[0][0].height) != (width, height):
+            self._frames = []
+            self._next = 0
+        if len(self._frames) < self.size:
+            return self._allocate(width, height)
+        for i in range(len(self._frames)):
+            index = (self._next + i) % len(self._frames)
+            entry = self._frames[index]
+            if self._refs(entry) <= self._idle_refs:
+                self._next = (index + 1) % len(self._frames)
+                return entry
+        return self._allocate(width, height)
+
+
+class FrameConverter:
+    """Per-stream conversions from decoded av.VideoFrames into pooled buffers."""
+
+    def __init__(self, pool=None):
+        self.pool = pool or BufferPool()
+        self.fallbacks = 0
+
+    @property
+    def allocations(self):
+        return self.pool.allocations
+
+    @staticmethod
+    def _is_i420(frame):
+        return frame.format.name in ("yuv420p", "yuvj420p") and frame.width % 2 == 0 and frame.height % 2 == 0
+
+    @staticmethod
+    def _plane(frame, index, width, height):
+        plane = frame.planes[index]
+        return np.frombuffer(plane, np.uint8).reshape(-1, plane.line_size)[:height, :width]
+
+    def _fallback(self, frame):
+        self.fallbacks += 1
+        return frame.to_ndarray(format="bgr24")
+
+    def _i420(self, frame):
+        # cvtColor wants Y, U and V back to back in one array
+        w, h = frame.width, frame.height
+        buffer = self.pool.get("i420", (h * 3 // 2, w))
+        flat = buffer.reshape(-1)
+        np.copyto(buffer[:h], self._plane(frame, 0, w, h))
+        quarter = (w // 2) * (h // 2)
+        np.copyto(flat[w * h:w * h + quarter].reshape(h // 2, w // 2), self._plane(frame, 1, w // 2, h // 2))
+        np.copyto(flat[w * h + quarter:].reshape(h // 2, w // 2), self._plane(frame, 2, w // 2, h // 2))
+        return buffer
+
+    def bgr(self, frame, out=None, flip=False):
+        """BGR pixels of ``frame``, written into ``out`` (e.g. a pooled output frame) or a pooled array."""
+        shape = (frame.height, frame.width, 3)
+        if out is None:
+            out = self.pool.get("bgr", shape)
+        src = self.pool.get("bgr_unflipped", shape) if flip else out
+        if self._is_i420(frame):
+            cv2.cvtColor(self._i420(frame), cv2.COLOR_YUV2BGR_I420, dst=src)
+        else:
+            np.copyto(src, self._fallback(frame))
+        if flip:
+            cv2.flip(src, 1, dst=out)
+        return out
+
+    def luma(self, frame):
+        """Grayscale view of ``frame``: its Y plane, without a copy for yuv420p."""
+        if frame.format.name in ("yuv420p", "yuvj420p", "nv12", "gray"):
+            return self._plane(frame, 0, frame.width, frame.height)
+        return cv2.cvtColor(self._fallback(frame), cv2.COLOR_BGR2GRAY, dst=self.pool.get("gray", (frame.height, frame.width)))
+
+    def letterbox(self, frame, imgsz):
+        """Resize ``frame`` keeping aspect ratio onto a pooled imgsz x imgsz BGR canvas.
+
+        Resizing happens on the YUV planes (a quarter of the work for
+        chroma) and the colour conversion writes straight into the canvas.
+        Returns ``(canvas, r, (left, top))`` like backends.letterbox. The
+        canvas is reused by the next call.
+        """
+        w, h = frame.width, frame.height
+        r = min(imgsz / h, imgsz / w)
+        # I420 needs even sizes
+        nw, nh = max(2, int(round(w * r)) // 2 * 2), max(2, int(round(h * r)) // 2 * 2)
+        left, top = (imgsz - nw) // 2, (imgsz - nh) // 2
+        canvas = self.pool.get(("canvas", imgsz, nw, nh), (imgsz, imgsz, 3), fill=LETTERBOX_COLOR)
+        roi = canvas[top:top + nh, left:left + nw]
+
+        if not self._is_i420(frame):
+            cv2.resize(self._fallback(frame), (nw, nh), dst=roi, interpolation=cv2.INTER_LINEAR)
+            return canvas, r, (left, top)
+
+        small = self.pool.get(("i420_small", nw, nh), (nh * 3 // 2, nw))
+        flat = small.reshape(-1)
+        quarter = (nw // 2) * (nh // 2)
+        cv2.resize(self._plane(frame, 0, w, h), (nw, nh), dst=small[:nh], interpolation=cv2.INTER_LINEAR)
+        for index, offset in ((1, nw * nh), (2, nw * nh + quarter)):
+            cv2.resize(self._plane(frame, index, w // 2, h // 2), (nw // 2, nh // 2),
+                       dst=flat[offset:offset + quarter].reshape(nh // 2, nw // 2), interpolation=cv2.INTER_LINEAR)
+        cv2.cvtColor(small, cv2.COLOR_YUV2BGR_I420, dst=roi)
+        return canvas, r, (left, top)
+
+
+def unletterbox(detections, r, pad, width, height):
+    """Map boxes found on a letterboxed canvas back to the original frame."""
+    left, top = pad
+    xyxy = (detections.xyxy - np.array([left, top, left, top], dtype=np.float32)) / r
+    np.clip(xyxy[:, 0::2], 0, width, out=xyxy[:, 0::2])
+    np.clip(xyxy[:, 1::2], 0, height, out=xyxy[:, 1::2])
+    return Detections(xyxy, detections.conf, detections.cls)
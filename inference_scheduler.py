@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import metrics
+
+logger = logging.getLogger("ai-damage-backend")
+
+
+class InferenceScheduler:
+    """Collects frames from all live tracks and runs them as one batch.
+
+    Tracks call ``await scheduler.submit(peer_id, img)``. The scheduler waits
+    up to ``window_ms`` after the first pending frame (or until ``max_batch``
+    peers are waiting), runs a single batched forward pass through
+    ``infer_fn`` on its executor and resolves each peer's future with that
+    peer's result. Keyword options given to ``submit`` (e.g. a per-stream
+    ``imgsz``) are passed on to ``infer_fn``; only frames with the same
+    options share a batch.
+
+    Fairness: every peer has at most one pending slot. A newer frame from the
+    same peer replaces the older one (whose future resolves to ``None``), and
+    peers are served in the order they started waiting. A high-fps peer
+    therefore never takes more than one place in a batch or pushes others out.
+
+    ``concurrency`` (a callable, re-read before every batch) lets up to that
+    many batches run at once, on up to ``max_workers`` executor threads.
+    """
+
+    def __init__(self, infer_fn, window_ms=10.0, max_batch=8, executor=None, max_workers=1,
+                 concurrency=lambda: 1):
+        self.infer_fn = infer_fn  # list of images -> list of per-image results
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.concurrency = concurrency
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="yolo-batch")
+        self._running = set()
+        self._pending = OrderedDict()  # peer_id -> (img, options, future)
+        self._wakeup = None
+        self._full = None
+        self._task = None
+        self.batches_run = 0
+        self.frames_batched = 0
+        self.frames_superseded = 0
+        self.last_batch_size = 0
+        self.last_batch_ms = 0.0
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+
+    def submit(self, peer_id, img, **options):
+        """Queue one frame for ``peer_id`` and return a future for its result."""
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+
+        previous = self._pending.get(peer_id)
+        if previous is not None:
+            # Latest frame wins; the old one never reaches the model
+            if not previous[2].done():
+                previous[2].set_result(None)
+            self.frames_superseded += 1
+        # Assigning to an existing key keeps the peer's place in line
+        self._pending[peer_id] = (img, tuple(sorted(options.items())), fut)
+
+        self._wakeup.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return fut
+
+    def discard(self, peer_id):
+        """Forget a peer's pending frame, e.g. when its connection closes."""
+        entry = self._pending.pop(peer_id, None)
+        if entry is not None and not entry[2].done():
+            entry[2].cancel()
+
+    def queue_depth(self):
+        return len(self._pending)
+
+    def _take_batch(self):
+        # The longest-waiting peer decides the options; peers behind it with
+        # the same options join, the rest keep their place for the next batch
+        batch, options = [], None
+        for peer_id, (img, opts, fut) in list(self._pending.items()):
+            if len(batch) >= self.max_batch:
+                break
+            if fut.done():
+                del self._pending[peer_id]
+                continue
+            if options is None:
+                options = opts
+            if opts == options:
+                del self._pending[peer_id]
+                batch.append((peer_id, img, fut))
+        if not self._pending:
+            self._wakeup.clear()
+        if len(self._pending) < self.max_batch:
+            self._full.clear()
+        return batch, dict(options or ())
+
+    async def _run(self):
+        while True:
+            # Wait for a free worker before forming the next batch, so frames
+            # that arrive meanwhile can still replace older ones
+            while len(self._running) >= max(1, self.concurrency()):
+                await asyncio.wait(self._running, return_when=asyncio.FIRST_COMPLETED)
+            await self._wakeup.wait()
+
+            # Give other peers a short window to join this batch
+            if len(self._pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=self.window)
+                except asyncio.TimeoutError:
+                    pass
+
+            batch, options = self._take_batch()
+            if not batch:
+                continue
+            task = asyncio.ensure_future(self._execute(batch, options))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, batch, options):
+        loop = asyncio.get_running_loop()
+        images = [img for _, img, _ in batch]
+        start = time.perf_counter()
+        try:
+            results = await loop.run_in_executor(self._executor, partial(self.infer_fn, images, **options))
+        except Exception as e:
+            logger.error(f"Batched inference error: {e}")
+            for _, _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        elapsed = time.perf_counter() - start
+        metrics.observe("inference_batch_seconds", elapsed)
+        metrics.observe("inference_batch_size", len(batch), buckets=(1, 2, 4, 8, 16, 32))
+        self.last_batch_ms = elapsed * 1000.0
+        self.last_batch_size = len(batch)
+        self.batches_run += 1
+        self.frames_batched += len(batch)
+        for (_, _, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
@@ -0,0 +1,216 @@
+"""Loopback load test for the WebRTC server.
+
+Spins up N aiortc client peers on this machine, each sending a synthetic
+video stream, and reports per peer how long the connection took to set up
+and at what rate annotated frames come back.
+
+    python loadtest.py --peers 8 --duration 20                 # against a running main.py
+    python loadtest.py --peers 8 --url http://host:5000
+    python loadtest.py --peers 8 --in-process                  # no Flask: server.process_offer directly
+
+The default mode signals over Socket.IO exactly like the browser client
+(needs ``pip install "python-socketio[asyncio_client]"``). --in-process
+hands offers straight to the server's aiortc loop and measures the media
+path and the thread bridge without Flask or eventlet.
+"""
+import argparse
+import asyncio
+import fractions
+import json
+import statistics
+import time
+
+import numpy as np
+from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
+from av import VideoFrame
+
+CLOCK_RATE = 90000
+
+
+class SyntheticVideoTrack(VideoStreamTrack):
+    """Moving test pattern at a fixed frame rate."""
+
+    def __init__(self, width=640, height=480, fps=30, seed=0):
+        super().__init__()
+        self.fps = fps
+        rng = np.random.default_rng(seed)
+        # Smooth background plus a bright block that moves, so the server's scene gate sees change
+        base = np.linspace(0, 255, width, dtype=np.float32)[None, :, None] * rng.uniform(0.3, 1.0, 3)
+        self._base = np.broadcast_to(base, (height, width, 3)).astype(np.uint8)
+        self._block = max(16, height // 6)
+        self._count = 0
+        self._start = None
+
+    async def recv(self):
+        if self._start is None:
+            self._start = time.monotonic()
+        else:
+            wait = self._start + self._count / self.fps - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        img = self._base.copy()
+        h, w = img.shape[:2]
+        x = (self._count * 7) % (w - self._block)
+        y = (self._count * 3) % (h - self._block)
+        img[y:y + self._block, x:x + self._block] = 255
+        frame = VideoFrame.from_ndarray(img, format="bgr24")
+        frame.pts = int(self._count * CLOCK_RATE / self.fps)
+        frame.time_base = fractions.Fraction(1, CLOCK_RATE)
+        self._count += 1
+        return frame
+
+
+class SocketIOSignaling:
+    """Offer/answer over the server's /signal Socket.IO namespace."""
+
+    def __init__(self, url):
+        import socketio  # python-socketio, client side only
+        self.url = url
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self._answer = None
+
+    async def connect(self):
+        async def on_answer(message):
+            if self._answer is not None and not self._answer.done():
+                self._answer.set_result(message)
+        self.sio.on('answer', on_answer, namespace='/signal')
+        await self.sio.connect(self.url, namespaces=['/signal'], transports=['websocket'])
+
+    async def exchange(self, offer, timeout):
+        self._answer = asyncio.get_running_loop().create_future()
+        await self.sio.emit('offer', {'sdp': offer.sdp, 'type': offer.type}, namespace='/signal')
+        message = await asyncio.wait_for(self._answer, timeout)
+        return RTCSessionDescription(sdp=message['sdp'], type=message['type'])
+
+    async def close(self):
+        if self.sio.connected:
+            await self.sio.emit('bye', namespace='/signal')
+            await self.sio.disconnect()
+
+
+class InProcessSignaling:
+    """Hands the offer to server.process_offer on the server's own aiortc loop."""
+
+    _next_id = 0
+
+    def __init__(self):
+        import server
+        self.server = server
+        InProcessSignaling._next_id += 1
+        self.sid = f"loadtest-{InProcessSignaling._next_id}"
+
+    async def connect(self):
+        pass
+
+    async def exchange(self, offer, timeout):
+        future = self.server.aio.submit(self.server.process_offer(self.sid, offer))
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+    async def close(self):
+        pc = self.server.peer_map.get(self.sid)
+        if pc is not None:
+            await asyncio.wrap_future(self.server.aio.submit(self.server.close_peer(self.sid, pc)))
+
+
+async def run_peer(index, signaling, args):
+    """One client peer: connect, then count annotated frames coming back."""
+    stats = {"peer": index, "frames": 0, "error": None}
+    pc = RTCPeerConnection()
+    connected = asyncio.Event()
+    first_frame = asyncio.Event()
+    frame_times = []
+
+    @pc.on("connectionstatechange")
+    async def on_state():
+        if pc.connectionState == "connected":
+            connected.set()
+
+    @pc.on("track")
+    def on_track(track):
+        async def consume():
+            while True:
+                try:
+                    await track.recv()
+                except Exception:
+                    return
+                frame_times.append(time.monotonic())
+                first_frame.set()
+        asyncio.ensure_future(consume())
+
+    pc.addTrack(SyntheticVideoTrack(args.width, args.height, args.fps, seed=index))
+    try:
+        await signaling.connect()
+        # aiortc gathers all ICE candidates before setLocalDescription returns
+        await pc.setLocalDescription(await pc.createOffer())
+        start = time.monotonic()
+        answer = await signaling.exchange(pc.localDescription, args.timeout)
+        stats["answer_ms"] = (time.monotonic() - start) * 1000.0
+        await pc.setRemoteDescription(answer)
+        await asyncio.wait_for(connected.wait(), args.timeout)
+        stats["connect_ms"] = (time.monotonic() - start) * 1000.0
+        await asyncio.wait_for(first_frame.wait(), args.timeout)
+        stats["first_frame_ms"] = (time.monotonic() - start) * 1000.0
+        await asyncio.sleep(args.duration)
+        # Rate over the measurement window, from the first frame on
+        window = list(frame_times)
+        stats["frames"] = len(window)
+        elapsed = window[-1] - window[0] if len(window) > 1 else 0.0
+        stats["fps"] = (len(window) - 1) / elapsed if elapsed > 0 else 0.0
+    except Exception as e:
+        stats["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        await pc.close()
+        try:
+            await signaling.close()
+        except Exception:
+            pass
+    return stats
+
+
+def _summary(values):
+    if not values:
+        return "-"
+    values = sorted(values)
+    p95 = values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]
+    return f"mean {statistics.fmean(values):8.1f}  p50 {statistics.median(values):8.1f}  p95 {p95:8.1f}"
+
+
+async def main(args):
+    def signaling():
+        return InProcessSignaling() if args.in_process else SocketIOSignaling(args.url)
+
+    tasks = []
+    for index in range(args.peers):
+        tasks.append(asyncio.ensure_future(run_peer(index, signaling(), args)))
+        if args.ramp:
+            await asyncio.sleep(args.ramp)
+    results = await asyncio.gather(*tasks)
+
+    print(f"{'peer':>4} {'answer ms':>10} {'connect ms':>11} {'1st frame ms':>13} {'frames':>7} {'fps':>6}  error")
+    for r in results:
+        print(f"{r['peer']:>4} {r.get('answer_ms', float('nan')):>10.1f} {r.get('connect_ms', float('nan')):>11.1f} "
+              f"{r.get('first_frame_ms', float('nan')):>13.1f} {r['frames']:>7} {r.get('fps', 0.0):>6.1f}  {r['error'] or ''}")
+    ok = [r for r in results if r["error"] is None]
+    print(f"\n{len(ok)}/{len(results)} peers ok, sending {args.fps} fps at {args.width}x{args.height}")
+    print(f"answer ms      {_summary([r['answer_ms'] for r in ok])}")
+    print(f"connect ms     {_summary([r['connect_ms'] for r in ok])}")
+    print(f"first frame ms {_summary([r['first_frame_ms'] for r in ok])}")
+    print(f"fps            {_summary([r['fps'] for r in ok])}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "peers": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--peers", type=int, default=4)
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--in-process", action="store_true", help="Skip Socket.IO and call the server's aiortc loop directly")
+    parser.add_argument("--duration", type=float, default=15.0, help="Seconds to measure after each peer's first frame")
+    parser.add_argument("--ramp", type=float, default=0.2, help="Seconds between starting peers")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--fps", type=int, default=30)
+    parser.add_argument("--timeout", type=float, default=20.0)
+    parser.add_argument("--json", help="Also write per-peer results to this file")
+    asyncio.run(main(parser.parse_args()))
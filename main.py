@@ -1,8 +1,11 @@
 import eventlet
 import eventlet.wsgi
-from flask import Flask, render_template
+import json
+from flask import Flask, Response, jsonify, render_template, request, stream_with_context
 from flask_socketio import SocketIO
 from server import create_webrtc_app
+from worker_pool import get_pool, PoolBusy, TIMEOUT
+import metrics
 
 app = Flask(__name__, template_folder="templates", static_folder="static")
 socketio = SocketIO(app, cors_allowed_origins='*')
@@ -14,5 +17,64 @@ app.register_blueprint(webrtc_blueprint, url_prefix='/signal')
 def index():
     return render_template('index.html')
 
+# Still-image assessment. Accepts multipart uploads (any number of files) or
+# a single raw image body; answers with NDJSON, one line per image in the
+# order they finish: {"index", "filename", "total_cost", "cost_breakdown",
+# "detections", ...} or {"index", "filename", "error"}.
+# ?annotated=1 adds a base64 JPEG, ?timeout=<s> bounds the whole request,
+# ?two_pass=1|0 overrides the high-resolution mode.
+MAX_IMAGES_PER_REQUEST = 32
+
+@app.route('/api/assess', methods=['POST'])
+def assess():
+    if request.files:
+        # multi=True: several files under one field name (<input type=file multiple>) all count
+        uploads = [(f.filename, f.read()) for _, f in request.files.items(multi=True)]
+    else:
+        uploads = [(None, request.get_data())]
+    uploads = [(name, data) for name, data in uploads if data]
+    if not uploads:
+        return jsonify(error="No image in request"), 400
+    if len(uploads) > MAX_IMAGES_PER_REQUEST:
+        return jsonify(error=f"At most {MAX_IMAGES_PER_REQUEST} images per request"), 413
+
+    annotated = request.args.get('annotated', '0') == '1'
+    two_pass = {'1': True, '0': False}.get(request.args.get('two_pass'))
+    try:
+        timeout = float(request.args.get('timeout', TIMEOUT))
+    except ValueError:
+        timeout = None
+    if timeout is None or not timeout > 0:  # also rejects nan
+        return jsonify(error="timeout must be a positive number of seconds"), 400
+    timeout = min(timeout, TIMEOUT)
+
+    pool = get_pool()
+    try:
+        pool.reserve(len(uploads))
+    except PoolBusy as e:
+        metrics.inc("assess_requests_total", status="busy")
+        response = jsonify(error=f"Busy: {e}")
+        response.status_code = 429
+        response.headers['Retry-After'] = '1'
+        return response
+    metrics.inc("assess_requests_total", status="accepted")
+    job = pool.submit([data for _, data in uploads], annotated=annotated, two_pass=two_pass)
+
+    def generate():
+        # socketio.sleep yields to eventlet, so other requests are served while we wait
+        try:
+            for index, result in job.iter_results(timeout=timeout, sleep=socketio.sleep):
+                metrics.inc("assess_images_total", status="error" if "error" in result else "ok")
+                yield json.dumps({"index": index, "filename": uploads[index][0], **result}) + "\n"
+        finally:
+            job.cancel()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text exposition format
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0', port=5000)
@@ -0,0 +1,195 @@
+import bisect
+import threading
+import time
+
+# Low-overhead, Prometheus-style metrics for the Flask/Socket.IO server.
+#
+# Every thread records into its own shard of plain dicts, so the hot path
+# never takes a lock. A lock is only taken once per thread, the first time
+# it records. render() sums the shards when /metrics is scraped. Gauges are
+# either set directly or computed by callbacks at scrape time.
+
+# Latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+_gauges = {}
+_gauge_callbacks = {}
+_help = {}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _shard():
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        shard = {"counters": {}, "histograms": {}}
+        with _shards_lock:
+            _shards.append(shard)
+        _local.shard = shard
+    return shard
+
+
+def describe(name, text):
+    """Register HELP text for a metric (optional)."""
+    _help[name] = text
+
+
+def inc(name, value=1, **labels):
+    counters = _shard()["counters"]
+    key = (name, _labels_key(labels))
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    histograms = _shard()["histograms"]
+    key = (name, _labels_key(labels))
+    hist = histograms.get(key)
+    if hist is None:
+        # [bucket bounds, per-bucket counts (last one is +Inf), sum]
+        hist = histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+    hist[1][bisect.bisect_left(buckets, value)] += 1
+    hist[2] += value
+
+
+class timer:
+    """Context manager that observes the elapsed time of a block."""
+    __slots__ = ("name", "labels", "start")
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class RateMeter:
+    """Events per second, recomputed about once per ``window`` seconds."""
+    __slots__ = ("window", "rate", "_count", "_start")
+
+    def __init__(self, window=1.0):
+        self.window = window
+        self.rate = 0.0
+        self._count = 0
+        self._start = time.monotonic()
+
+    def tick(self):
+        self._count += 1
+        now = time.monotonic()
+        if now - self._start >= self.window:
+            self.rate = self._count / (now - self._start)
+            self._count = 0
+            self._start = now
+
+
+def set_gauge(name, value, **labels):
+    _gauges[(name, _labels_key(labels))] = value
+
+
+def register_gauge(name, callback):
+    """Gauge computed at scrape time.
+
+    ``callback`` returns a number, or a dict mapping label dicts (as tuples of
+    (key, value) pairs) to numbers.
+    """
+    _gauge_callbacks[name] = callback
+
+
+def forget(**labels):
+    """Drop every series carrying these labels, e.g. a peer that left."""
+    wanted = set(labels.items())
+    with _shards_lock:
+        shards = list(_shards)
+    for shard in shards:
+        for table in (shard["counters"], shard["histograms"]):
+            for key in list(table):
+                if wanted <= set(key[1]):
+                    table.pop(key, None)
+    for key in list(_gauges):
+        if wanted <= set(key[1]):
+            _gauges.pop(key, None)
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _sort_key(item):
+    (name, labels), _ = item
+    return name, str(labels)
+
+
+def render():
+    """Prometheus text exposition of all metrics."""
+    with _shards_lock:
+        shards = list(_shards)
+    counters, histograms = {}, {}
+    for shard in shards:
+        # dict() copies are atomic under the GIL, so owners can keep writing
+        for key, value in dict(shard["counters"]).items():
+            counters[key] = counters.get(key, 0) + value
+        for key, (buckets, counts, total) in dict(shard["histograms"]).items():
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = [buckets, list(counts), total]
+            else:
+                merged[1] = [a + b for a, b in zip(merged[1], counts)]
+                merged[2] += total
+
+    gauges = dict(_gauges)
+    for name, callback in list(_gauge_callbacks.items()):
+        try:
+            value = callback()
+        except Exception:
+            continue
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                gauges[(name, tuple(labels))] = v
+        else:
+            gauges[(name, ())] = value
+
+    lines = []
+    emitted = set()
+
+    def header(name, kind):
+        if name in emitted:
+            return
+        emitted.add(name)
+        described = _help.get(name)
+        if described:
+            lines.append(f"# HELP {name} {described}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in sorted(counters.items(), key=_sort_key):
+        header(name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for (name, labels), value in sorted(gauges.items(), key=_sort_key):
+        header(name, "gauge")
+        lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for (name, labels), (buckets, counts, total) in sorted(histograms.items(), key=_sort_key):
+        header(name, "histogram")
+        cumulative = 0
+        for bound, count in zip(list(buckets) + [float("inf")], counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', _format_value(bound))])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
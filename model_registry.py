@@ -0,0 +1,134 @@
+import hashlib
+import os
+import threading
+import time
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("ai-damage-backend")
+
+# Default weights shipped next to the code
+DEFAULT_WEIGHTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'best (6).pt')
+DEFAULT_IMGSZ = 640
+
+# Process-wide registry: one loaded model per (weights path, device, imgsz,
+# backend, precision, replica). Ultralytics models are not safe to call from
+# several threads at once; callers that run inference concurrently ask for
+# one replica per worker (see cpu_resources)
+_models = {}
+_load_times = {}
+_registry_lock = threading.Lock()
+_key_locks = {}
+_default_device = None
+
+
+def default_device():
+    """'cuda' when available, else 'cpu'. Imports torch on first call only."""
+    global _default_device
+    if _default_device is None:
+        import torch
+        _default_device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return _default_device
+
+
+def _resolve_device(device):
+    return device if device is not None else default_device()
+
+
+def _load_model(weights, device, imgsz, backend, precision, replica):
+    from ultralytics import YOLO
+    from backends import export_artifact
+
+    start = time.perf_counter()
+    if backend == "torch":
+        # Pre-fused checkpoint (see backends.export_fused); fuse() is then a no-op
+        model = YOLO(export_artifact(weights, backend, precision, imgsz))
+        model.fuse()
+    else:
+        # Exported once and cached next to the weights; already optimised
+        model = YOLO(export_artifact(weights, backend, precision, imgsz), task="detect")
+    loaded = time.perf_counter()
+
+    # Warm up with a dummy frame so the first real request does not pay for
+    # predictor setup, memory allocation and kernel selection
+    dummy = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+    model.predict(dummy, imgsz=imgsz, device=device, verbose=False)
+    warmed = time.perf_counter()
+
+    _load_times[(weights, device, imgsz, backend, precision, replica)] = {
+        "load_s": loaded - start,
+        "warmup_s": warmed - loaded,
+    }
+    logger.info(f"Loaded {os.path.basename(weights)} [{backend}/{precision}] on {device} (imgsz={imgsz}, replica {replica}) "
+                f"in {loaded - start:.2f}s, warm-up {warmed - loaded:.2f}s")
+    return model
+
+
+def get_model(weights=DEFAULT_WEIGHTS, device=None, imgsz=DEFAULT_IMGSZ, backend=None, precision=None, replica=0):
+    """Return the shared, fused and warmed-up YOLO model for these settings.
+
+    The model is loaded on first use and reused for the rest of the process.
+    Callers should predict with the same device and imgsz they asked for.
+    backend/precision default to DAMAGE_BACKEND/DAMAGE_PRECISION (see backends).
+    Each ``replica`` is a separate instance, for inference threads that may
+    run at the same time.
+    """
+    from backends import resolve
+
+    weights = os.path.abspath(weights)
+    device = _resolve_device(device)
+    backend, precision = resolve(backend, precision)
+    key = (weights, device, imgsz, backend, precision, replica)
+
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    with _registry_lock:
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+    # Only one thread loads a given model; others wait for it
+    with key_lock:
+        model = _models.get(key)
+        if model is None:
+            model = _load_model(weights, device, imgsz, backend, precision, replica)
+            _models[key] = model
+    return model
+
+
+def warm_replica(replica):
+    """Load ``replica`` of every model replica 0 has, so a new worker starts warm."""
+    for weights, device, imgsz, backend, precision, loaded in list(_models):
+        if loaded == 0:
+            get_model(weights, device, imgsz, backend, precision, replica=replica)
+
+
+_weights_hashes = {}
+
+
+def weights_sha256(weights=DEFAULT_WEIGHTS):
+    """SHA-256 of a weights file, cached per (path, size, mtime)."""
+    weights = os.path.abspath(weights)
+    stat = os.stat(weights)
+    key = (weights, stat.st_size, stat.st_mtime_ns)
+    digest = _weights_hashes.get(key)
+    if digest is None:
+        h = hashlib.sha256()
+        with open(weights, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        _weights_hashes[key] = digest
+    return digest
+
+
+def load_times():
+    """Load and warm-up durations (seconds) for every model loaded so far."""
+    return dict(_load_times)
+
+
+def clear():
+    """Drop all cached models (mainly useful for tests and benchmarks)."""
+    with _registry_lock:
+        _models.clear()
+        _key_locks.clear()
@@ -0,0 +1,110 @@
+import cv2
+import numpy as np
+
+# Fast in-place overlays for annotated frames. Text is the expensive part of
+# drawing (cv2.putText rasterizes glyph outlines on every call), so labels are
+# rasterized once into sprites and alpha-blitted onto the output buffer:
+# one sprite per class name and one per confidence string "(0.00)".."(1.00)".
+# Free text such as the cost banner or an FPS counter goes through a TextSlot,
+# which only re-renders when its text changes.
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+
+
+class Sprite:
+    """Pre-rendered text patch with per-pixel alpha."""
+    __slots__ = ("color", "premultiplied", "inverse_alpha", "opaque", "height", "width")
+
+    def __init__(self, color, alpha):
+        self.color = color
+        self.height, self.width = color.shape[:2]
+        self.opaque = bool((alpha == 255).all())
+        # Fixed-point blend: out = (dst * (256 - a) + src * a) >> 8
+        a = alpha.astype(np.uint16)[:, :, None] + (alpha[:, :, None] > 127)
+        self.premultiplied = color.astype(np.uint16) * a
+        self.inverse_alpha = 256 - a
+
+    @classmethod
+    def text(cls, text, scale=0.5, color=(255, 0, 0), thickness=1, background=(255, 255, 255),
+             background_alpha=1.0, pad_left=4, pad_right=4, pad_y=5, min_width=0, height=None):
+        (tw, th), baseline = cv2.getTextSize(text, FONT, scale, thickness)
+        w = max(pad_left + tw + pad_right, min_width)
+        h = height or th + baseline + 2 * pad_y
+        canvas = np.empty((h, w, 3), np.uint8)
+        canvas[:] = background if background is not None else color
+        alpha = np.full((h, w), int(round(255 * background_alpha)) if background is not None else 0, np.uint8)
+        origin = (pad_left, (h + th) // 2)
+        cv2.putText(canvas, text, origin, FONT, scale, color, thickness, cv2.LINE_AA)
+        cv2.putText(alpha, text, origin, FONT, scale, 255, thickness, cv2.LINE_AA)
+        return cls(canvas, alpha)
+
+    def blit(self, image, x, y):
+        """Draw onto ``image`` in place with the top-left corner at (x, y), clipped."""
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + self.width, image.shape[1]), min(y + self.height, image.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return
+        sx, sy = x0 - x, y0 - y
+        sw, sh = x1 - x0, y1 - y0
+        roi = image[y0:y1, x0:x1]
+        if self.opaque:
+            roi[:] = self.color[sy:sy + sh, sx:sx + sw]
+            return
+        blended = roi * self.inverse_alpha[sy:sy + sh, sx:sx + sw]
+        blended += self.premultiplied[sy:sy + sh, sx:sx + sw]
+        roi[:] = blended >> 8
+
+
+class OverlayRenderer:
+    """Draws detections and text onto frames in place.
+
+    ``class_names`` maps class ids to label text. Boxes are drawn with
+    ``cv2.rectangle``; labels ("name (0.87)") are two cached sprites placed
+    above the box, or just inside it at the top edge of the frame. Colours
+    are used as given, so they follow the channel order of the frames drawn
+    on.
+    """
+
+    def __init__(self, class_names, box_color=(255, 0, 0), text_color=(255, 0, 0),
+                 label_background=(255, 255, 255), label_alpha=1.0, scale=0.5, thickness=1, label_height=20):
+        self.box_color = box_color
+        self.label_height = label_height
+        style = dict(scale=scale, color=text_color, thickness=thickness, background=label_background,
+                     background_alpha=label_alpha, height=label_height)
+        self._names = {class_id: Sprite.text(f"{name} ", pad_right=0, **style)
+                       for class_id, name in class_names.items()}
+        self._confidences = [Sprite.text(f"({i / 100:.2f})", pad_left=0, **style) for i in range(101)]
+
+    def draw_detections(self, image, detections):
+        h = self.label_height
+        for (x_min, y_min, x_max, y_max), class_id, confidence in zip(
+                detections.xyxy.astype(int).tolist(), detections.cls.tolist(), detections.conf.tolist()):
+            name = self._names.get(class_id)
+            if name is None:
+                continue
+            cv2.rectangle(image, (x_min, y_min), (x_max, y_max), self.box_color, 2)
+            conf = self._confidences[min(max(int(round(confidence * 100)), 0), 100)]
+            y = y_min - h if y_min >= h else y_min
+            name.blit(image, x_min, y)
+            conf.blit(image, x_min + name.width, y)
+        return image
+
+
+class TextSlot:
+    """One piece of changing text (a banner, an FPS counter) at a fixed style.
+
+    The sprite is re-rasterized only when the text differs from the last
+    call. Keep one slot per stream and position.
+    """
+
+    def __init__(self, **style):
+        self.style = style  # keyword arguments of Sprite.text
+        self._text = None
+        self._sprite = None
+
+    def draw(self, image, text, x, y):
+        if text != self._text:
+            self._text = text
+            self._sprite = Sprite.text(text, **self.style)
+        self._sprite.blit(image, x, y)
+        return image
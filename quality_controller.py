@@ -0,0 +1,237 @@
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+import cv2
+
+import metrics
+
+logger = logging.getLogger("ai-damage-backend")
+
+# Per-stream feedback controller for the live paths. Each stream measures its
+# real frame latency and feeds it to a QualityController, which walks a ladder
+# of settings (inference size, keyframe interval, precision) to hold a target
+# frame rate: down a rung quickly when over budget, back up slowly when there
+# is headroom.
+
+TARGET_FPS = float(os.environ.get("TARGET_FPS", "15"))
+ADAPTIVE_QUALITY = os.environ.get("ADAPTIVE_QUALITY", "1") != "0"
+
+QualityLevel = namedtuple("QualityLevel", "imgsz keyframe_interval precision")
+
+
+def default_ladder(backend=None, int8=None):
+    """Settings from best quality to cheapest.
+
+    ``precision`` None means the configured default. The INT8 rungs are only
+    added for exported backends with a calibration folder configured, since
+    the torch backend has no INT8 path.
+    """
+    ladder = [
+        QualityLevel(640, 1, None),
+        QualityLevel(640, 2, None),
+        QualityLevel(480, 2, None),
+        QualityLevel(480, 3, None),
+        QualityLevel(320, 3, None),
+        QualityLevel(320, 5, None),
+    ]
+    if int8 is None:
+        import backends
+        int8 = (backend or backends.DEFAULT_BACKEND) != "torch" and bool(backends.CALIBRATION_DIR)
+    if int8:
+        ladder += [QualityLevel(320, 5, "int8"), QualityLevel(320, 8, "int8")]
+    else:
+        ladder.append(QualityLevel(320, 8, None))
+    return ladder
+
+
+_warming = set()
+_warming_lock = threading.Lock()
+
+
+def warm_models(ladder=None, weights=None, background=True):
+    """Load and warm up the model of every (imgsz, precision) on the ladder.
+
+    Rungs are warmed best first, so a controller starting at rung 0 has its
+    model ready soonest. Without this the first keyframe after a step to a
+    new size would include loading that model, be measured as inference
+    latency and push the stream further down the ladder. Each setting is
+    only queued once per process.
+    """
+    from model_registry import get_model, DEFAULT_WEIGHTS
+
+    weights = weights or DEFAULT_WEIGHTS
+    settings = []
+    with _warming_lock:
+        for level in ladder or default_ladder():
+            key = (os.path.abspath(weights), level.imgsz, level.precision)
+            if key not in _warming:
+                _warming.add(key)
+                settings.append((level.imgsz, level.precision))
+
+    def run():
+        for imgsz, precision in settings:
+            try:
+                get_model(weights, imgsz=imgsz, precision=precision)
+            except Exception as e:
+                logger.error(f"Warming the {imgsz}px/{precision or 'default'} model failed: {e}")
+
+    if not settings:
+        return None
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
+
+
+def fit(frame, max_side):
+    """Downscale ``frame`` so its longest side is at most ``max_side``."""
+    h, w = frame.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1.0:
+        return frame
+    return cv2.resize(frame, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_AREA)
+
+
+class QualityController:
+    """Holds a stream at ``target_fps`` by trading quality for speed.
+
+    Call ``observe(seconds)`` with each measured latency. Samples are
+    compared with a budget (one frame period by default; pass ``budget`` when
+    a sample may span several frames, e.g. an async keyframe round trip) and
+    the ratio is smoothed with an EWMA. After ``down_after`` smoothed samples
+    over budget the controller steps one rung down the ladder; after
+    ``up_after`` samples under ``headroom`` of the budget, and at least
+    ``cooldown`` seconds since the last change, it steps back up. An upgrade
+    that has to be undone right away doubles the wait before the next one, so
+    a stream sitting on the edge does not oscillate.
+
+    The first sample on a setting (imgsz, precision) not measured before is
+    dropped: it may include loading that setting's model (see warm_models).
+    """
+
+    def __init__(self, target_fps=TARGET_FPS, ladder=None, start=None, alpha=0.2, headroom=0.7,
+                 down_after=3, up_after=30, cooldown=2.0, name=None):
+        self.target_fps = target_fps
+        self.ladder = list(ladder or default_ladder())
+        self.alpha = alpha
+        self.headroom = headroom
+        self.down_after = down_after
+        self.up_after = up_after
+        self.cooldown = cooldown
+        self.name = name
+        # Start at the best rung, whose model the apps warm first, and let the measurements decide
+        self.index = 0 if start is None else start
+        self.load = None  # smoothed latency / budget
+        self.latency = None  # smoothed latency, seconds
+        self.upgrades = 0
+        self.downgrades = 0
+        self._over = 0
+        self._under = 0
+        self._up_wait = up_after
+        self._changed_at = time.monotonic()
+        self._last_upgrade_at = None
+        self._measured = set()  # (imgsz, precision) settings that have had a sample
+        self._publish()
+
+    @property
+    def level(self):
+        return self.ladder[self.index]
+
+    @property
+    def imgsz(self):
+        return self.level.imgsz
+
+    @property
+    def keyframe_interval(self):
+        return self.level.keyframe_interval
+
+    @property
+    def precision(self):
+        return self.level.precision
+
+    @property
+    def frame_budget(self):
+        return 1.0 / self.target_fps
+
+    def observe(self, seconds, budget=None):
+        """Feed one latency sample; returns True if the level changed."""
+        setting = (self.imgsz, self.precision)
+        if setting not in self._measured:
+            self._measured.add(setting)
+            return False
+        ratio = seconds / (budget or self.frame_budget)
+        if self.load is None:
+            self.load, self.latency = ratio, seconds
+        else:
+            self.load += self.alpha * (ratio - self.load)
+            self.latency += self.alpha * (seconds - self.latency)
+        if self.name is not None:
+            metrics.set_gauge("quality_load", self.load, peer=self.name)
+
+        if self.load > 1.0:
+            self._over += 1
+            self._under = 0
+        elif self.load < self.headroom:
+            self._under += 1
+            self._over = 0
+        else:
+            self._over = self._under = 0
+
+        now = time.monotonic()
+        if self._over >= self.down_after and self.index < len(self.ladder) - 1:
+            if self._last_upgrade_at is not None and now - self._last_upgrade_at < 2 * self.cooldown:
+                self._up_wait = min(self._up_wait * 2, 16 * self.up_after)
+            self._move(1, now)
+            self.downgrades += 1
+            return True
+        if (self._under >= self._up_wait and self.index > 0
+                and now - self._changed_at >= self.cooldown):
+            self._move(-1, now)
+            self.upgrades += 1
+            self._last_upgrade_at = now
+            return True
+        if self._under >= 4 * self._up_wait:
+            # Held steady at the new level for a good while: forgive earlier failed upgrades
+            self._up_wait = self.up_after
+        return False
+
+    def _move(self, step, now):
+        self.index += step
+        self._changed_at = now
+        self._over = self._under = 0
+        # The old measurements describe the old settings
+        self.load = self.latency = None
+        self._publish()
+
+    def _publish(self):
+        if self.name is None:
+            return
+        metrics.set_gauge("quality_level", self.index, peer=self.name)
+        metrics.set_gauge("quality_imgsz", self.imgsz, peer=self.name)
+        metrics.set_gauge("quality_keyframe_interval", self.keyframe_interval, peer=self.name)
+        metrics.set_gauge("quality_int8", int(self.precision == "int8"), peer=self.name)
+
+    def label(self):
+        """Short description for video overlays, e.g. '480px k3 int8 0.8x'."""
+        precision = f" {self.precision}" if self.precision else ""
+        load = "--" if self.load is None else f"{self.load:.1f}x"
+        return f"{self.imgsz}px k{self.keyframe_interval}{precision} {load}"
+
+    def stats(self):
+        return {
+            "level": self.index,
+            "levels": len(self.ladder),
+            "imgsz": self.imgsz,
+            "keyframe_interval": self.keyframe_interval,
+            "precision": self.precision,
+            "target_fps": self.target_fps,
+            "load": self.load,
+            "latency_ms": None if self.latency is None else self.latency * 1000.0,
+            "upgrades": self.upgrades,
+            "downgrades": self.downgrades,
+        }
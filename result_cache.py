@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """Content-addressed cache of assessment results.
+
+    Keys are built by ``make_key`` from the image bytes, the weights hash and
+    the inference parameters, so a re-uploaded photo hits the cache while a
+    weights or threshold change does not. Entries are small JSON-able dicts
+    (detections and costs, no pixels), kept in an in-process LRU bounded by
+    ``max_entries`` and ``max_bytes``. If ``disk_path`` is given, entries
+    are also written to a SQLite file so they survive restarts.
+    """
+
+    def __init__(self, max_entries=512, max_bytes=64 << 20, disk_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lru = OrderedDict()  # key -> (entry, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._db = None
+        if disk_path:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            self._db = sqlite3.connect(disk_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(data, weights_hash, **params):
+        h = hashlib.sha256(data)
+        h.update(weights_hash.encode())
+        h.update(json.dumps(params, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _remember(self, key, entry, size):
+        old = self._lru.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._lru[key] = (entry, size)
+        self._bytes += size
+        while self._lru and (len(self._lru) > self.max_entries or self._bytes > self.max_bytes):
+            _, (_, evicted_size) = self._lru.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            cached = self._lru.get(key)
+            if cached is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    entry = json.loads(row[0])
+                    self._remember(key, entry, len(row[0]))
+                    self.disk_hits += 1
+                    return entry
+
+            self.misses += 1
+            return None
+
+    def put(self, key, entry):
+        value = json.dumps(entry)
+        with self._lock:
+            self._remember(key, entry, len(value))
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", (key, value))
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "entries": len(self._lru),
+                "bytes": self._bytes,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
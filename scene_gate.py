@@ -0,0 +1,58 @@
+import cv2
+import numpy as np
+
+
+class SceneChangeGate:
+    """Skips work on frames that barely differ from the last processed one.
+
+    Each frame is reduced to a tiny grayscale thumbnail and compared with the
+    thumbnail of the last frame that was let through. ``changed()`` returns
+    True (and makes the frame the new reference) when the mean absolute
+    difference, in 0-255 gray levels, is at least ``threshold``. Slow drift
+    still gets through eventually, because gated frames keep being compared
+    with the same reference.
+    """
+
+    def __init__(self, threshold=3.0, size=(32, 24)):
+        self.threshold = threshold
+        self.size = size
+        self.processed = 0
+        self.gated = 0
+        self.last_score = 0.0
+        self._reference = None
+        # Thumbnail and difference buffers are reused on every frame
+        self._thumb = np.empty(size[::-1], np.uint8)
+        self._diff = np.empty(size[::-1], np.uint8)
+
+    def _thumbnail(self, frame):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        return cv2.resize(gray, self.size, dst=self._thumb, interpolation=cv2.INTER_AREA)
+
+    def changed(self, frame):
+        """True if ``frame`` (BGR or grayscale) should be processed."""
+        thumb = self._thumbnail(frame)
+        if self._reference is None:
+            self.last_score = float("inf")
+        else:
+            self.last_score = cv2.mean(cv2.absdiff(thumb, self._reference, dst=self._diff))[0]
+
+        if self.last_score >= self.threshold:
+            # The new reference's buffer takes over as scratch for the next thumbnail
+            if self._reference is None:
+                self._reference = np.empty_like(thumb)
+            self._thumb, self._reference = self._reference, thumb
+            self.processed += 1
+            return True
+        self.gated += 1
+        return False
+
+    def reset(self):
+        self._reference = None
+
+    def stats(self):
+        return {
+            "processed": self.processed,
+            "gated": self.gated,
+            "last_score": self.last_score,
+            "threshold": self.threshold,
+        }
@@ -1,16 +1,30 @@
 import asyncio
+import atexit
 import logging
+import multiprocessing
 import os
+import threading
+import time
+import weakref
 from flask import Blueprint, render_template, send_from_directory, request
 from flask_socketio import emit, SocketIO
 from aiortc import RTCPeerConnection, RTCSessionDescription, VideoStreamTrack
 from aiortc.contrib.media import MediaRelay
 from aiortc.sdp import candidate_from_sdp
-import av
-from ultralytics import YOLO
-import cv2
 import numpy as np
-import torch
+from model_registry import get_model, load_times, default_device
+from inference_scheduler import InferenceScheduler
+from detections import Detections
+from tracking import FlowTracker
+from scene_gate import SceneChangeGate
+from car_pipeline import annotate_image
+from overlay import TextSlot
+from frame_pool import BufferPool, FrameConverter, VideoFramePool, unletterbox
+from quality_controller import QualityController, QualityLevel, ADAPTIVE_QUALITY, warm_models
+from aio_loop import AioLoop
+from damage_aggregator import DamageAggregator
+from cpu_resources import get_resource_manager
+import metrics
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,54 +35,276 @@ relay = MediaRelay()
 
 # Model and device setup
 MODEL_PATH = os.path.join(os.path.dirname(__file__), 'best (6).pt')
-DEVICE = 'cuda' if torch.cuda.is_available() else 'cpu'
-model = YOLO(MODEL_PATH)
+IMGSZ = 640
+# Load and warm up the model in the background at startup instead of on the first frame
+PRELOAD_MODEL = os.environ.get("PRELOAD_MODEL", "1") == "1"
 
-# Connection management
+# Connection management. Peer connections live on the aio loop's thread;
+# the Socket.IO handlers only reach them through it. The lock guards the two
+# collections, which both sides read and update.
 pcs = set()
 peer_map = {}
+claims = {}  # sid -> DamageAggregator of the peer's video track
+final_reports = {}  # sid -> claim report of a finished call, until bye/disconnect
+_peers_lock = threading.Lock()
+
+# All aiortc work runs on one dedicated event loop thread
+aio = AioLoop(name="aiortc")
+SIGNAL_TIMEOUT = float(os.environ.get("SIGNAL_TIMEOUT", "10"))
+
+# All tracks share one micro-batching scheduler: frames from different peers
+# that arrive within BATCH_WINDOW_MS go through the model as one batch
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "10"))
+MAX_BATCH = int(os.environ.get("MAX_BATCH", "8"))
+
+# Cores are split into inference workers by the number of live peers; each
+# batch runs on one worker with that worker's torch thread budget
+resources = get_resource_manager()
+
+# Reused float32 NCHW batch per (imgsz, worker); a worker runs one batch at a time
+_batch_buffers = BufferPool()
+
+def run_batch_inference(images, imgsz=IMGSZ, precision=None):
+    """Blocking batched YOLO call, executed on one of the scheduler's threads.
+
+    ``images`` are BGR canvases already letterboxed to imgsz. They are
+    normalized into a preallocated batch that torch shares without a copy,
+    so Ultralytics skips its own letterbox/resize/normalize pass.
+    """
+    import torch  # already loaded by the registry; kept out of module import
+
+    # Registry model (loaded and warmed up once per setting); each worker slot
+    # has its own replica since concurrent predict calls are not thread-safe
+    device = default_device()
+    with resources.worker() as slot:
+        model = get_model(MODEL_PATH, device=device, imgsz=imgsz, precision=precision, replica=slot)
+        batch = _batch_buffers.get((imgsz, slot), (MAX_BATCH, 3, imgsz, imgsz), np.float32)[:len(images)]
+        for dst, img in zip(batch, images):
+            dst[...] = img[:, :, ::-1].transpose(2, 0, 1)  # BGR HWC -> RGB CHW
+        batch *= 1.0 / 255.0
+        return model(torch.from_numpy(batch), imgsz=imgsz, device=device, verbose=False)
+
+scheduler = InferenceScheduler(run_batch_inference, window_ms=BATCH_WINDOW_MS, max_batch=MAX_BATCH,
+                               max_workers=resources.max_workers, concurrency=lambda: resources.ready_workers)
+
+# Per-frame logs are sampled at debug level: one line every LOG_EVERY inferences
+LOG_EVERY = int(os.environ.get("LOG_EVERY", "100"))
+
+# Detect-then-track: the model runs on keyframes only, optical flow moves the
+# boxes in between
+KEYFRAME_INTERVAL = int(os.environ.get("KEYFRAME_INTERVAL", "5"))
+MIN_TRACK_QUALITY = float(os.environ.get("MIN_TRACK_QUALITY", "0.5"))
+# Frames whose thumbnail differs from the last processed one by less than this
+# many gray levels (mean absolute difference) reuse the previous boxes as-is
+SCENE_CHANGE_THRESHOLD = float(os.environ.get("SCENE_CHANGE_THRESHOLD", "3.0"))
+
+# With ADAPTIVE_QUALITY (default on) each track's QualityController picks
+# imgsz, keyframe interval and precision to hold TARGET_FPS; otherwise IMGSZ
+# and KEYFRAME_INTERVAL are used as-is
+def make_quality_controller(peer_id):
+    if ADAPTIVE_QUALITY:
+        return QualityController(name=peer_id)
+    return QualityController(ladder=[QualityLevel(IMGSZ, KEYFRAME_INTERVAL, None)], name=peer_id)
+
+# Live tracks, for the per-peer fps gauges
+active_tracks = weakref.WeakSet()
 
 class YoloVideoTrack(VideoStreamTrack):
-    """Real-time YOLO video processing track"""
+    """Real-time YOLO video processing track.
+
+    The detector runs every few frames (KEYFRAME_INTERVAL, or as chosen by
+    the track's QualityController), or sooner when the
+    tracker loses its points; boxes are propagated with a FlowTracker on the
+    other frames. Latest frame wins: each track has at most one keyframe
+    waiting in (or being run by) the shared scheduler. Keyframes that come
+    due meanwhile are not queued behind the model; they go out with tracked
+    boxes and are counted as dropped. Frames that barely differ from the last
+    processed one (camera held still) skip tracking and inference entirely.
+
+    Frames go through a FrameConverter: the YUV planes are converted into a
+    pooled output frame and, on keyframes, into a pooled letterboxed
+    canvas for the model, so steady state allocates no frame buffers.
+    """
     kind = "video"
     
-    def __init__(self, track):
+    def __init__(self, track, peer_id=None):
         super().__init__()
         self.track = track
+        self.peer_id = peer_id if peer_id is not None else id(self)
+        self.tracker = FlowTracker()
+        self.scene_gate = SceneChangeGate(SCENE_CHANGE_THRESHOLD)
+        self.detections = Detections.empty()
+        self._inflight = None
+        self._inflight_gray = None
+        self._inflight_letterbox = None
+        self.converter = FrameConverter()
+        self.output_frames = VideoFramePool()
+        self._inflight_start = 0.0
+        self._inflight_interval = 1
+        self.quality = make_quality_controller(self.peer_id)
+        self.status_text = TextSlot(scale=1.0, color=(0, 255, 0), thickness=2, background=None, pad_left=10)
+        # Unique damages over the whole call, updated on keyframes
+        self.claim = DamageAggregator(name=self.peer_id)
+        self.claim_text = TextSlot(scale=0.8, color=(0, 60, 230), thickness=2, background=(245, 245, 245),
+                                   background_alpha=0.8, pad_left=10, pad_right=10)
+        self._since_keyframe = None
+        self.frames_received = 0
+        self.frames_processed = 0
+        self.frames_tracked = 0
+        self.frames_dropped = 0
+        self.frames_gated = 0
+        self.fps_in = metrics.RateMeter()
+        self.fps_out = metrics.RateMeter()
+        active_tracks.add(self)
         
-    async def recv(self):
-        # Get frame from incoming track
-        frame = await self.track.recv()
-        img = frame.to_ndarray(format="bgr24")
+    def stats(self):
+        return {
+            "received": self.frames_received,
+            "processed": self.frames_processed,
+            "tracked": self.frames_tracked,
+            "dropped": self.frames_dropped,
+            "gated": self.frames_gated,
+            "quality": self.quality.stats(),
+            "buffer_allocations": self.buffer_allocations(),
+        }
         
-        # Run YOLO inference - simplified for debugging
+    def buffer_allocations(self):
+        """Frame-sized buffers allocated so far; flat once the stream is running."""
+        return self.converter.allocations + self.output_frames.allocations + self.tracker.allocations
+
+    def _collect_result(self):
+        """Pick up a finished inference and seed the tracker with it"""
+        if self._inflight is None or not self._inflight.done():
+            return False
+        inflight, self._inflight = self._inflight, None
         try:
-            # Use direct call with minimal parameters
-            results = model(img, verbose=False)
-            
-            # Use YOLO's built-in plotting for reliability
-            if results and len(results) > 0:
-                annotated_img = results[0].plot()
-                logger.info(f"YOLO detected {len(results[0].boxes) if results[0].boxes else 0} objects")
-            else:
-                annotated_img = img.copy()
-                logger.info("No YOLO results")
-                
+            result = inflight.result()
         except Exception as e:
             logger.error(f"YOLO inference error: {e}")
-            annotated_img = img.copy()
+            return False
+        if result is None:
+            # Superseded in the scheduler by a newer frame of ours
+            return False
+        # A keyframe's boxes must arrive before the next keyframe is due,
+        # so the round trip gets keyframe_interval frame periods of budget
+        self.quality.observe(time.perf_counter() - self._inflight_start,
+                             budget=self._inflight_interval * self.quality.frame_budget)
+        r, pad, width, height = self._inflight_letterbox
+        detections = unletterbox(Detections.from_result(result), r, pad, width, height)
+        self.tracker.seed(self._inflight_gray, detections)
+        self.claim.update(detections, self._inflight_gray, self.tracker.scale)
+        self.frames_processed += 1
+        metrics.inc("frames_inferred_total", peer=self.peer_id)
+        if (self.frames_processed - 1) % LOG_EVERY == 0:
+            logger.debug(f"[{self.peer_id}] YOLO detected {len(detections)} objects ({self.stats()})")
+        return True
+        
+    async def recv(self):
+        # Get frame from incoming track
+        frame = await self.track.recv()
+        start = time.perf_counter()
+        self.fps_in.tick()
+        metrics.inc("frames_in_total", peer=self.peer_id)
+        # Convert straight from the YUV planes into the pooled output frame
+        new_frame, img = self.output_frames.acquire(frame.width, frame.height)
+        self.converter.bgr(frame, out=img)
+        gray = self.tracker.prepare(self.converter.luma(frame))
+        self.frames_received += 1
+        converted = time.perf_counter()
+        metrics.observe("frame_stage_seconds", converted - start, stage="convert")
+        
+        # Move the latest boxes (possibly from a keyframe a few frames old) onto this frame
+        collected = self._collect_result()
+        if collected:
+            self._since_keyframe = 0
+        
+        gated = (not collected and self._since_keyframe is not None
+                 and not self.scene_gate.changed(gray))
+        if gated:
+            # Near-duplicate of the last processed frame: keep the previous boxes
+            self.frames_gated += 1
+            keyframe_due = False
+        else:
+            self.detections = self.tracker.step(gray)
+            if self._since_keyframe is not None:
+                self._since_keyframe += 1
+            keyframe_due = (self._since_keyframe is None
+                            or self._since_keyframe >= self.quality.keyframe_interval
+                            or self.tracker.quality < MIN_TRACK_QUALITY)
+        
+        if keyframe_due and self._inflight is None:
+            # The canvas and the gray copy stay untouched until the result is collected,
+            # since a track never has more than one keyframe in flight
+            canvas, r, pad = self.converter.letterbox(frame, self.quality.imgsz)
+            self._inflight = scheduler.submit(self.peer_id, canvas, imgsz=self.quality.imgsz,
+                                              precision=self.quality.precision)
+            self._inflight_gray = self.converter.pool.get("inflight_gray", gray.shape)
+            np.copyto(self._inflight_gray, gray)
+            self._inflight_letterbox = (r, pad, frame.width, frame.height)
+            self._inflight_start = time.perf_counter()
+            self._inflight_interval = self.quality.keyframe_interval
+        elif keyframe_due:
+            self.frames_dropped += 1
+            metrics.inc("frames_dropped_total", peer=self.peer_id)
+        elif not gated:
+            self.frames_tracked += 1
+        if gated:
+            metrics.inc("frames_gated_total", peer=self.peer_id)
+        tracked = time.perf_counter()
+        metrics.observe("frame_stage_seconds", tracked - converted, stage="track")
         
-        # Always add a processing indicator
-        cv2.putText(annotated_img, "AI Processing", (10, 30), 
-                   cv2.FONT_HERSHEY_SIMPLEX, 1.0, (0, 255, 0), 2)
+        # The model reads its own canvas, so draw straight onto the output frame
+        annotate_image(img, self.detections)
         
-        # Convert back to av.VideoFrame
-        new_frame = av.VideoFrame.from_ndarray(annotated_img, format="bgr24")
+        # Always add a processing indicator, with the current quality level
+        self.status_text.draw(img, f"AI Processing {self.quality.label()}", 0, 5)
+        self.claim_text.draw(img, f"Claim: AED {self.claim.total_cost:.0f} ({self.claim.confirmed} damages)", 0, 45)
+        annotated = time.perf_counter()
+        metrics.observe("frame_stage_seconds", annotated - tracked, stage="annotate")
+        
+        # The pixels are already in new_frame
         new_frame.pts = frame.pts
         new_frame.time_base = frame.time_base
         
+        end = time.perf_counter()
+        metrics.observe("frame_stage_seconds", end - annotated, stage="encode")
+        metrics.observe("frame_seconds", end - start)
+        metrics.inc("frames_out_total", peer=self.peer_id)
+        self.fps_out.tick()
         return new_frame
 
+# Gauges computed when /metrics is scraped
+def _peer_fps():
+    values = {}
+    for track in list(active_tracks):
+        values[(("peer", track.peer_id), ("direction", "in"))] = track.fps_in.rate
+        values[(("peer", track.peer_id), ("direction", "out"))] = track.fps_out.rate
+    return values
+
+def _model_load_seconds():
+    values = {}
+    for (weights, device, imgsz, backend, precision, replica), times in load_times().items():
+        for phase, seconds in times.items():
+            labels = (("model", os.path.basename(weights)), ("device", device), ("imgsz", imgsz),
+                      ("backend", backend), ("precision", precision), ("replica", replica),
+                      ("phase", phase[:-2]))
+            values[labels] = seconds
+    return values
+
+metrics.register_gauge("webrtc_peer_connections", lambda: len(pcs))
+metrics.register_gauge("webrtc_peers", lambda: len(peer_map))
+metrics.register_gauge("inference_queue_depth", scheduler.queue_depth)
+metrics.register_gauge("peer_fps", _peer_fps)
+metrics.register_gauge("model_load_seconds", _model_load_seconds)
+metrics.describe("frame_seconds", "Time spent in YoloVideoTrack.recv per frame, excluding the wait for the incoming frame")
+metrics.describe("frame_stage_seconds", "Per-stage time in YoloVideoTrack.recv (convert, track, annotate, encode)")
+metrics.describe("inference_batch_seconds", "Wall time of one batched forward pass in the scheduler")
+metrics.describe("inference_queue_depth", "Peers with a frame waiting for the scheduler")
+metrics.describe("model_load_seconds", "Model load and warm-up time (phase=load|warmup)")
+metrics.describe("frame_buffer_allocations_total", "Frame-sized buffers allocated by the live frame path; flat in steady state")
+metrics.describe("quality_level", "Rung of the adaptive quality ladder, 0 is the best quality")
+metrics.describe("quality_load", "Smoothed keyframe round trip as a fraction of its budget")
+
 @webrtc_blueprint.route('/client.js')
 def client_js():
     return send_from_directory('static', 'client.js')
@@ -77,44 +313,129 @@ def client_js():
 def index():
     return render_template('index.html')
 
+async def process_offer(sid, offer):
+    """Runs on the aio loop: create a peer connection for ``sid`` and answer ``offer``"""
+    pc = RTCPeerConnection()
+    with _peers_lock:
+        pcs.add(pc)
+        peer_map[sid] = pc
+    resources.set_active_streams(len(peer_map))
+    
+    @pc.on("track")
+    def on_track(track):
+        logger.info(f"Track received: {track.kind}")
+        if track.kind == "video":
+            # Add YOLO processing track
+            yolo_track = YoloVideoTrack(relay.subscribe(track), peer_id=sid)
+            with _peers_lock:
+                claims[sid] = yolo_track.claim
+            pc.addTrack(yolo_track)
+            logger.info("Added YOLO processing track")
+    
+    @pc.on("connectionstatechange")
+    async def on_connectionstatechange():
+        logger.info(f"[{sid}] Connection state: {pc.connectionState}")
+        if pc.connectionState in ("failed", "closed"):
+            await close_peer(sid, pc)
+    
+    await pc.setRemoteDescription(offer)
+    answer = await pc.createAnswer()
+    await pc.setLocalDescription(answer)
+    return pc.localDescription
+
+async def close_peer(sid, pc):
+    """Runs on the aio loop: forget and close one peer connection"""
+    with _peers_lock:
+        current = peer_map.get(sid) is pc
+        if current:
+            del peer_map[sid]
+        pcs.discard(pc)
+    if current:
+        resources.set_active_streams(len(peer_map))
+        scheduler.discard(sid)
+        finish_claim(sid)
+        metrics.forget(peer=sid)
+    await pc.close()
+
+def finish_claim(sid):
+    """Close the claim of a peer's call. The report is kept in final_reports
+    until the signaling side picks it up: the media connection may close
+    before the client's 'bye' arrives."""
+    with _peers_lock:
+        claim = claims.pop(sid, None)
+    if claim is None:
+        return
+    report = claim.report()
+    logger.info(f"[{sid}] Claim: AED {report['total_cost']:.2f} for {len(report['damages'])} damages "
+                f"over {report['keyframes']} keyframes ({report['duration_s']:.0f}s)")
+    with _peers_lock:
+        final_reports[sid] = report
+
+async def close_all_peers():
+    with _peers_lock:
+        open_pcs = list(pcs)
+        sids = list(peer_map)
+        pcs.clear()
+        peer_map.clear()
+    resources.set_active_streams(0)
+    for sid in sids:
+        scheduler.discard(sid)
+    await asyncio.gather(*(pc.close() for pc in open_pcs), return_exceptions=True)
+
+def _shutdown():
+    if pcs:
+        try:
+            aio.call(close_all_peers(), timeout=5)
+        except Exception as e:
+            logger.error(f"Error closing peer connections: {e}")
+
+atexit.register(_shutdown)
+metrics.register_gauge("aiortc_loop_lag_seconds", lambda: aio.lag)
+metrics.describe("aiortc_loop_lag_seconds", "How late the aiortc event loop's heartbeat woke up")
+metrics.describe("webrtc_setup_seconds", "Time from receiving an offer to sending the answer")
+
+def preload_model():
+    """Import torch/Ultralytics and load the models the tracks will use, off the request path."""
+    if ADAPTIVE_QUALITY:
+        # Every rung's model, best first, so quality steps never wait for a load
+        warm_models(weights=MODEL_PATH, background=False)
+        return
+    try:
+        get_model(MODEL_PATH, imgsz=IMGSZ)
+    except Exception as e:
+        logger.error(f"Model preload failed: {e}")
+
 def create_webrtc_app(socketio):
     """Create WebRTC app with socket handlers"""
+    # Spawned /api/assess workers re-run main.py (and so this) as __mp_main__;
+    # they load their own model after pinning their threads, so only the
+    # server process itself preloads
+    if PRELOAD_MODEL and multiprocessing.parent_process() is None:
+        threading.Thread(target=preload_model, name="model-preload", daemon=True).start()
     
     @socketio.on('offer', namespace='/signal')
     def on_offer(message):
         sid = request.sid
         logger.info(f"Received offer from {sid}")
+        start = time.perf_counter()
+        # A new offer from the same client replaces its old connection
+        cleanup_peer(sid)
         
         offer = RTCSessionDescription(sdp=message['sdp'], type=message['type'])
-        pc = RTCPeerConnection()
-        pcs.add(pc)
-        peer_map[sid] = pc
-        
-        @pc.on("track")
-        def on_track(track):
-            logger.info(f"Track received: {track.kind}")
-            if track.kind == "video":
-                # Add YOLO processing track
-                yolo_track = YoloVideoTrack(relay.subscribe(track))
-                pc.addTrack(yolo_track)
-                logger.info("Added YOLO processing track")
-        
-        async def process_offer():
-            try:
-                await pc.setRemoteDescription(offer)
-                answer = await pc.createAnswer()
-                await pc.setLocalDescription(answer)
-                
-                emit('answer', {
-                    'sdp': pc.localDescription.sdp,
-                    'type': pc.localDescription.type
-                }, namespace='/signal')
-                logger.info("Answer sent")
-                
-            except Exception as e:
-                logger.error(f"Error processing offer: {e}")
+        try:
+            # socketio.sleep between polls keeps the other clients served meanwhile
+            answer = aio.call(process_offer(sid, offer), timeout=SIGNAL_TIMEOUT, sleep=socketio.sleep)
+        except Exception as e:
+            logger.error(f"Error processing offer: {e!r}")
+            cleanup_peer(sid)
+            return
         
-        asyncio.ensure_future(process_offer())
+        emit('answer', {
+            'sdp': answer.sdp,
+            'type': answer.type
+        }, namespace='/signal')
+        metrics.observe("webrtc_setup_seconds", time.perf_counter() - start)
+        logger.info("Answer sent")
     
     @socketio.on('candidate', namespace='/signal')
     def on_candidate(message):
@@ -130,7 +451,7 @@ def create_webrtc_app(socketio):
             cand = candidate_from_sdp(sdp)
             cand.sdpMid = message.get('sdpMid')
             cand.sdpMLineIndex = message.get('sdpMLineIndex')
-            asyncio.ensure_future(pc.addIceCandidate(cand))
+            aio.submit(pc.addIceCandidate(cand), what="Adding ICE candidate")
         except Exception as e:
             logger.error(f"Error adding ICE candidate: {e}")
     
@@ -138,6 +459,12 @@ def create_webrtc_app(socketio):
     def on_bye():
         sid = request.sid
         logger.info(f"Bye from {sid}")
+        # The client is still connected: send it the claim for the call
+        finish_claim(sid)
+        with _peers_lock:
+            report = final_reports.pop(sid, None)
+        if report is not None:
+            emit('report', report, namespace='/signal')
         cleanup_peer(sid)
     
     @socketio.on('disconnect', namespace='/signal')
@@ -148,9 +475,11 @@ def create_webrtc_app(socketio):
     
     def cleanup_peer(sid):
         """Clean up peer connection"""
-        pc = peer_map.pop(sid, None)
+        finish_claim(sid)
+        with _peers_lock:
+            final_reports.pop(sid, None)
+        pc = peer_map.get(sid)
         if pc:
-            asyncio.ensure_future(pc.close())
-            pcs.discard(pc)
+            aio.submit(close_peer(sid, pc), what=f"Closing peer {sid}")
     
     return webrtc_blueprint
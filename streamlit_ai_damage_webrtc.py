@@ -1,9 +1,15 @@
 import streamlit as st
 from streamlit_webrtc import webrtc_streamer, VideoProcessorBase
-import cv2
-from ultralytics import YOLO
 import av
-from car_pipeline import damage_cost_map, estimate_cost
+import time
+from car_pipeline import estimate_cost, annotate_image
+from model_registry import get_model
+from detections import Detections
+from tracking import DetectThenTrack
+from quality_controller import QualityController, fit, warm_models
+from overlay import TextSlot
+from cpu_resources import get_resource_manager
+from damage_aggregator import DamageAggregator
 
 # Card-style UI header
 st.markdown("""
@@ -18,27 +24,66 @@ st.set_page_config(page_title="Live Damage Detection", page_icon="🚗")
 st.markdown('<div class="site-header">AI Car Damage Detection — Live Camera</div>', unsafe_allow_html=True)
 st.markdown('<div class="footer">Powered by <b>YOLOv8</b> + <b>Streamlit/webrtc</b> — 2024</div>', unsafe_allow_html=True)
 
-model = YOLO('best (6).pt')
+get_model()  # Load and warm up the shared model once per process
+warm_models()  # and the smaller quality rungs in the background
+resources = get_resource_manager()  # splits the cores between the sessions' model calls
 
 class DamageProcessor(VideoProcessorBase):
+    def __init__(self):
+        # YOLO on keyframes, optical flow tracking in between; the quality
+        # controller picks resolution and detection rate to hold the target FPS
+        self.quality = QualityController()
+        self.tracker = DetectThenTrack(self._detect)
+        self.banner = TextSlot(scale=0.75, color=(0,60,230), thickness=2, background=(245,245,245), pad_left=8, min_width=200, height=30)
+        self.quality_text = TextSlot(scale=0.5, color=(0,200,0), background=None, pad_left=8)
+        # Unique damages over the whole session, fed from keyframes only
+        self.claim = DamageAggregator()
+        self.scale = 1.0  # working frame / camera frame, follows the quality level
+        resources.open_stream()
+
+    def on_ended(self):
+        resources.close_stream()
+
+    def _detect(self, img):
+        with resources.worker() as slot:
+            net = get_model(imgsz=self.quality.imgsz, precision=self.quality.precision, replica=slot)
+            detections = Detections.from_result(net(img, imgsz=self.quality.imgsz, verbose=False)[0])
+        # Camera-frame coordinates, so a quality change does not make every damage look new
+        self.claim.update(Detections(detections.xyxy / self.scale, detections.conf, detections.cls), img, self.scale)
+        return detections
+
     def recv(self, frame):
+        start = time.perf_counter()
         img = frame.to_ndarray(format="bgr24")
-        img_resized = cv2.resize(img, (320, 240))
-        results = model(img_resized)
-        detections = results[0].boxes
-        damage_info = []
-        for box in detections:
-            class_id = int(box.cls.cpu().numpy())
-            confidence = float(box.conf.cpu().numpy())
-            x_min, y_min, x_max, y_max = map(int, box.xyxy[0].cpu().numpy())
-            label = f"{damage_cost_map[class_id][0].replace('_',' ').title()} ({confidence*100:.1f}%)"
-            color = (255, 0, 0)
-            cv2.rectangle(img_resized, (x_min, y_min), (x_max, y_max), color, 2)
-            cv2.putText(img_resized, label, (x_min, max(y_min - 10, 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.55, color, 1)
-            damage_info.append({'class_id': class_id, 'confidence': confidence})
-        total_cost, _ = estimate_cost(damage_info)
-        cv2.rectangle(img_resized, (0, 0), (200, 30), (245,245,245), -1)
-        cv2.putText(img_resized, f"Repair: AED {total_cost:.2f}", (8,24), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0,60,230), 2)
-        return av.VideoFrame.from_ndarray(img_resized, format="bgr24")
-
-webrtc_streamer(key="ai-damage", video_processor_factory=DamageProcessor)
+        img_resized = fit(img, self.quality.imgsz)
+        self.scale = img_resized.shape[1] / img.shape[1]
+        self.tracker.keyframe_interval = self.quality.keyframe_interval
+        detections = self.tracker(img_resized)
+        annotate_image(img_resized, detections)
+        total_cost, _ = estimate_cost(detections)
+        # Banner sprites are only re-rendered when the text changes
+        self.banner.draw(img_resized, f"Repair: AED {total_cost:.2f} | Claim: AED {self.claim.total_cost:.2f}", 0, 0)
+        self.quality_text.draw(img_resized, self.quality.label(), 0, 38)
+        out = av.VideoFrame.from_ndarray(img_resized, format="bgr24")
+        self.quality.observe(time.perf_counter() - start)
+        return out
+
+ctx = webrtc_streamer(key="ai-damage", video_processor_factory=DamageProcessor)
+
+# Refreshes the claim on its own timer; the last report stays once the stream stops
+@st.fragment(run_every=0.5)
+def claim_summary():
+    if ctx and ctx.video_processor:
+        claim = ctx.video_processor.claim
+        st.metric("Claim Estimate (AED)", f"{claim.total_cost:.2f}",
+                  help="Each damage is counted once, however many frames it appears in.")
+        st.caption(f"{claim.confirmed} unique damages")
+        st.session_state["claim_report"] = claim.report()
+    elif st.session_state.get("claim_report"):
+        report = st.session_state["claim_report"]
+        st.metric("Final Claim (AED)", f"{report['total_cost']:.2f}")
+        if report["damages"]:
+            st.dataframe([{k: d[k] for k in ("type", "hits", "confidence_mean", "estimated_cost")} for d in report["damages"]],
+                         hide_index=True)
+
+claim_summary()
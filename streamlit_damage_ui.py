@@ -1,8 +1,7 @@
 import streamlit as st
-import cv2
-from ultralytics import YOLO
-import time
-from car_pipeline import damage_cost_map, estimate_cost
+import uuid
+from capture_worker import CaptureWorker, POLL_SECONDS
+from model_registry import get_model
 
 # CSS for card UI
 st.markdown("""
@@ -26,65 +25,68 @@ st.markdown("""
 st.markdown('<div class="site-header">AI Car Damage Detection</div>', unsafe_allow_html=True)
 st.markdown('<div class="footer">Powered by <b>YOLOv8</b> + <b>Streamlit</b> &mdash; 2024</div>', unsafe_allow_html=True)
 
+# One capture/inference worker per server process, shared by all sessions
+@st.cache_resource
+def get_capture_worker():
+    get_model()  # Load and warm up the shared model once per process
+    return CaptureWorker()
+
+worker = get_capture_worker()
+
 # Session state for clean control
 if 'running' not in st.session_state:
     st.session_state['running'] = False
+if 'capture_token' not in st.session_state:
+    st.session_state['capture_token'] = uuid.uuid4().hex
+token = st.session_state['capture_token']
 status_placeholder = st.empty()
-col1, col2 = st.columns([1, 1], gap="large")
+
+# Polls the worker's latest frame without blocking reruns
+@st.fragment(run_every=POLL_SECONDS)
+def live_view():
+    worker.subscribe(token)  # also renews a subscription that expired
+    snapshot = worker.poll(token)
+    if worker.error:
+        st.error(worker.error)
+    if snapshot is None:
+        st.info("Waiting for the first frame...")
+        return
+    cost_lines = [f"<li><strong>{c['type'].replace('_',' ').title()}</strong>: AED {c['estimated_cost']:.2f}</li>" for c in snapshot.cost_breakdown]
+    col1, col2 = st.columns([1, 1], gap="large")
+    with col1:
+        st.markdown('<div class="card"><div class="video-box">', unsafe_allow_html=True)
+        st.image(snapshot.image, channels="RGB", width=380, caption=f"Webcam Feed · {snapshot.label}")
+        st.markdown('<div class="vid-label">Live Detection</div></div></div>', unsafe_allow_html=True)
+    with col2:
+        st.markdown('<div class="card"><div class="video-box">', unsafe_allow_html=True)
+        st.markdown(
+            f"""
+            <h4>Frame Repair Estimate</h4>
+            <p style='font-size:1.15em'><strong>Total (AED):</strong> <span style='color:#0d6efd;font-weight:bold;'>{snapshot.total_cost:.2f}</span></p>
+            <ul style='font-size:1em'>{''.join(cost_lines) if cost_lines else '<li>No damage detected.</li>'}</ul>
+            <p><strong>Claim so far (AED):</strong> {snapshot.claim_cost:.2f} &middot; {snapshot.claim_damages} unique damage(s)</p>
+            """, unsafe_allow_html=True)
+        st.markdown('</div></div>', unsafe_allow_html=True)
 
 if not st.session_state['running']:
     # Only render the start button when not running
     if st.button("Start Webcam Detection", key="start_button"):
         st.session_state['running'] = True
         st.rerun()
+    status_placeholder.info("Detection stopped.")
+    # Claim for the last run: each damage counted once across all frames
+    report = st.session_state.get('claim_report')
+    if report:
+        st.subheader(f"Claim estimate: AED {report['total_cost']:.2f}")
+        if report["damages"]:
+            st.dataframe([{k: d[k] for k in ("type", "hits", "confidence_mean", "estimated_cost")} for d in report["damages"]],
+                         hide_index=True)
 else:
     stop_btn = st.button("Stop Detection", key="stop_button", help="Stops webcam detection")
     if stop_btn:
         st.session_state['running'] = False
+        worker.unsubscribe(token)
+        st.session_state['claim_report'] = worker.claim.report()
         st.rerun()
     status_placeholder.success("Webcam started.")
-    cap = cv2.VideoCapture(0)
-    detection_active = True
-    while detection_active and st.session_state['running']:
-        ret, frame = cap.read()
-        if not ret:
-            status_placeholder.error("Failed to get frame from webcam.")
-            break
-        frame_resized = cv2.resize(frame, (320, 240))
-        results = YOLO('best (6).pt')(frame_resized)
-        detections = results[0].boxes
-        damage_info = []
-        for box in detections:
-            class_id = int(box.cls.cpu().numpy())
-            confidence = float(box.conf.cpu().numpy())
-            x_min, y_min, x_max, y_max = map(int, box.xyxy[0].cpu().numpy())
-            label = f"{damage_cost_map[class_id][0].replace('_',' ').title()} ({confidence*100:.1f}%)"
-            color = (255, 0, 0)
-            cv2.rectangle(frame_resized, (x_min, y_min), (x_max, y_max), color, 2)
-            cv2.putText(frame_resized, label, (x_min, max(y_min - 10, 10)), cv2.FONT_HERSHEY_SIMPLEX, 0.55, color, 1)
-            damage_info.append({'class_id': class_id, 'confidence': confidence})
-        total_cost, cost_breakdown = estimate_cost(damage_info)
-        cost_lines = [f"<li><strong>{c['type'].replace('_',' ').title()}</strong>: AED {c['estimated_cost']:.2f}</li>" for c in cost_breakdown]
-        st_image = cv2.cvtColor(frame_resized, cv2.COLOR_BGR2RGB)
-        with col1:
-            st.markdown('<div class="card"><div class="video-box">', unsafe_allow_html=True)
-            st.image(st_image, channels="RGB", width=380, caption="Webcam Feed")
-            st.markdown('<div class="vid-label">Live Detection</div></div></div>', unsafe_allow_html=True)
-        with col2:
-            st.markdown('<div class="card"><div class="video-box">', unsafe_allow_html=True)
-            st.markdown(
-                f"""
-                <h4>Frame Repair Estimate</h4>
-                <p style='font-size:1.15em'><strong>Total (AED):</strong> <span style='color:#0d6efd;font-weight:bold;'>{total_cost:.2f}</span></p>
-                <ul style='font-size:1em'>{''.join(cost_lines) if cost_lines else '<li>No damage detected.</li>'}</ul>
-                """, unsafe_allow_html=True)
-            st.markdown('</div></div>', unsafe_allow_html=True)
-        # Throttle to ~10 fps
-        time.sleep(0.10)
-        # If stop button pressed, break early
-        if not st.session_state['running']:
-            detection_active = False
-            break
-    cap.release()
-    cv2.destroyAllWindows()
-    status_placeholder.info("Detection stopped.")
+    live_view()
@@ -0,0 +1,32 @@
+import pytest
+
+from damage_aggregator import DamageAggregator
+from detections import Detections
+
+
+def _frame(*boxes):
+    """Detections of class 0 from (x0, y0, x1, y1, conf) tuples."""
+    return Detections([b[:4] for b in boxes], [b[4] for b in boxes], [0] * len(boxes))
+
+
+def test_evicted_instance_is_not_matched_later_in_the_same_update():
+    claim = DamageAggregator(max_instances=2, min_hits=2)
+    claim.update(_frame((0, 0, 10, 10, 0.5), (100, 0, 110, 10, 0.4)))
+    # The new damage fills the last slot by evicting the weaker one at x=100;
+    # the second detection overlaps that evicted instance and must not revive it
+    claim.update(_frame((200, 0, 210, 10, 0.9), (100, 0, 110, 10, 0.8)))
+
+    report = claim.report()
+    assert claim.evicted == 2
+    assert report["damages"] == []
+    assert claim.total_cost == pytest.approx(sum(d["estimated_cost"] for d in report["damages"]))
+
+
+def test_claim_total_matches_the_confirmed_damages_at_capacity():
+    claim = DamageAggregator(max_instances=2, min_hits=1)
+    claim.update(_frame((0, 0, 10, 10, 0.5), (100, 0, 110, 10, 0.4)))
+    claim.update(_frame((200, 0, 210, 10, 0.9), (100, 0, 110, 10, 0.8)))
+
+    report = claim.report()
+    assert len(report["damages"]) == 2
+    assert claim.total_cost == pytest.approx(sum(d["estimated_cost"] for d in report["damages"]))
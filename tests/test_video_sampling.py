@@ -0,0 +1,49 @@
+import av
+import numpy as np
+import pytest
+
+from video_sampling import VideoSampler
+
+
+def _write_video(path, codec, seconds, fps=25, gop=None, size=64):
+    with av.open(str(path), "w") as container:
+        stream = container.add_stream(codec, rate=fps)
+        stream.width = stream.height = size
+        stream.pix_fmt = "yuvj420p" if codec == "mjpeg" else "yuv420p"
+        if gop:
+            stream.codec_context.gop_size = gop
+            stream.codec_context.options = {"keyint_min": str(gop), "sc_threshold": "0"}
+        for i in range(int(seconds * fps)):
+            image = np.full((size, size, 3), i % 256, dtype=np.uint8)
+            for packet in stream.encode(av.VideoFrame.from_ndarray(image, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def h264_2s_gop(tmp_path_factory):
+    # 60 s at 25 fps with a keyframe every 2 s; H.264 decodes frame-threaded
+    return _write_video(tmp_path_factory.mktemp("video") / "gop.mp4", "libx264", 60, gop=50)
+
+
+def test_keyframes_respect_interval_with_frame_threaded_decoder(h264_2s_gop):
+    sampler = VideoSampler(h264_2s_gop, mode="keyframes", interval=5.0)
+    times = [frame.time for frame in sampler]
+    # Keyframes at 0, 2, 4, ... s; at least 5 s apart leaves 0, 6, 12, ..., 54
+    assert times == pytest.approx([6.0 * i for i in range(10)], abs=1e-3)
+    assert sampler.decoded == len(times)
+
+
+def test_keyframes_thin_all_intra_video(tmp_path):
+    path = _write_video(tmp_path / "intra.avi", "mjpeg", 10)
+    times = [frame.time for frame in VideoSampler(path, mode="keyframes", interval=1.0)]
+    assert times == pytest.approx([float(i) for i in range(10)], abs=1e-3)
+
+
+def test_interval_samples_stay_on_grid(h264_2s_gop):
+    frames = list(VideoSampler(h264_2s_gop, mode="interval", interval=0.2))
+    assert len(frames) == 300
+    assert [f.time for f in frames] == pytest.approx([0.2 * i for i in range(300)], abs=1e-3)
+    assert [f.index for f in frames] == list(range(300))
@@ -0,0 +1,138 @@
+import cv2
+import numpy as np
+
+from detections import Detections
+
+
+class FlowTracker:
+    """Moves boxes between keyframes with sparse Lucas-Kanade optical flow.
+
+    A small grid of points inside every box is tracked from the previous frame
+    to the current one and each box is shifted by the median displacement of
+    its points. ``quality`` is the fraction of points that were tracked; a low
+    value means the boxes can no longer be trusted and the detector should
+    run again.
+    """
+
+    def __init__(self, grid=4, scale=0.5):
+        self.grid = grid
+        self.scale = scale  # flow runs on a downscaled grayscale frame
+        self.quality = 0.0
+        self.allocations = 0
+        self._gray = None
+        self._buffers = [None, None]
+        self._detections = Detections.empty()
+        self._lk_params = dict(
+            winSize=(15, 15),
+            maxLevel=2,
+            criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03),
+        )
+        # Relative positions of the grid points along each box side
+        self._offsets = (np.arange(grid, dtype=np.float32) + 0.5) / grid
+
+    def _buffer(self, shape):
+        # Two alternating buffers: never the one holding the previous frame
+        for i, buffer in enumerate(self._buffers):
+            if buffer is not None and buffer is self._gray:
+                continue
+            if buffer is None or buffer.shape != shape:
+                buffer = self._buffers[i] = np.empty(shape, np.uint8)
+                self.allocations += 1
+            return buffer
+
+    def prepare(self, frame):
+        """Grayscale, downscaled copy of a frame for seed() and step().
+
+        ``frame`` is BGR, or already grayscale (e.g. the Y plane of a YUV
+        frame). The result is written into one of two reused buffers and
+        stays valid until the next prepare() after it was passed to step().
+        """
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        h, w = gray.shape[:2]
+        size = (int(round(w * self.scale)), int(round(h * self.scale)))
+        return cv2.resize(gray, size, dst=self._buffer((size[1], size[0])), interpolation=cv2.INTER_AREA)
+
+    def seed(self, gray, detections):
+        """Start tracking ``detections`` found on the frame ``gray`` came from."""
+        self._gray = gray
+        self._detections = detections
+        self.quality = 1.0
+
+    def step(self, gray):
+        """Propagate the current boxes to a new frame and return them."""
+        detections = self._detections
+        if self._gray is None or self._gray.shape != gray.shape:
+            self._gray = gray
+            self.quality = 0.0
+            return detections
+        if len(detections) == 0:
+            self._gray = gray
+            return detections
+
+        n, g = len(detections), self.grid
+        boxes = detections.xyxy * self.scale
+        xs = boxes[:, 0:1] + (boxes[:, 2:3] - boxes[:, 0:1]) * self._offsets
+        ys = boxes[:, 1:2] + (boxes[:, 3:4] - boxes[:, 1:2]) * self._offsets
+        points = np.stack([
+            np.broadcast_to(xs[:, :, None], (n, g, g)),
+            np.broadcast_to(ys[:, None, :], (n, g, g)),
+        ], axis=-1).reshape(-1, 1, 2).astype(np.float32)
+
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self._gray, gray, points, None, **self._lk_params)
+        ok = status.reshape(n, g * g).astype(bool)
+        shift = (moved - points).reshape(n, g * g, 2)
+
+        # Median displacement of the tracked points of each box
+        shift[~ok] = np.nan
+        lost = ~ok.any(axis=1)
+        shift[lost] = 0.0
+        median = np.nanmedian(shift, axis=1) / self.scale
+
+        height, width = gray.shape[:2]
+        xyxy = detections.xyxy + np.concatenate([median, median], axis=1)
+        xyxy[:, [0, 2]] = np.clip(xyxy[:, [0, 2]], 0, width / self.scale)
+        xyxy[:, [1, 3]] = np.clip(xyxy[:, [1, 3]], 0, height / self.scale)
+
+        self.quality = float(ok.mean())
+        self._detections = Detections(xyxy, detections.conf, detections.cls)
+        self._gray = gray
+        return self._detections
+
+
+class DetectThenTrack:
+    """Runs the detector on keyframes and the tracker in between.
+
+    ``detect`` takes a BGR frame and returns Detections. The detector runs on
+    the first frame, then every ``keyframe_interval`` frames, and also as soon
+    as tracker quality falls below ``min_quality``. Every call returns
+    Detections, so cost estimation and overlays work unchanged.
+    """
+
+    def __init__(self, detect, keyframe_interval=5, min_quality=0.5, tracker=None):
+        self.detect = detect
+        self.keyframe_interval = keyframe_interval
+        self.min_quality = min_quality
+        self.tracker = tracker or FlowTracker()
+        self.keyframes = 0
+        self.tracked_frames = 0
+        self._since_keyframe = None
+
+    def __call__(self, frame):
+        gray = self.tracker.prepare(frame)
+
+        if self._since_keyframe is not None and self._since_keyframe + 1 < self.keyframe_interval:
+            detections = self.tracker.step(gray)
+            if self.tracker.quality >= self.min_quality:
+                self._since_keyframe += 1
+                self.tracked_frames += 1
+                return detections
+
+        detections = self.detect(frame)
+        self.tracker.seed(gray, detections)
+        self._since_keyframe = 0
+        self.keyframes += 1
+        return detections
+
+    def reset(self):
+        """Force the detector to run on the next frame."""
+        self._since_keyframe = None
@@ -0,0 +1,222 @@
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from fractions import Fraction
+
+import av
+
+from car_pipeline import WEIGHTS, IMGSZ, annotate_image, estimate_cost
+from detections import Detections
+from model_registry import get_model
+
+logger = logging.getLogger("ai-damage-backend")
+
+# End-of-stream marker passed down the queues
+_DONE = object()
+
+
+class _Pipeline:
+    """Shared state for the stage threads: stop flag and the first error."""
+
+    def __init__(self):
+        self.stop = threading.Event()
+        self.error = None
+
+    def fail(self, exc):
+        if self.error is None:
+            self.error = exc
+        self.stop.set()
+
+    def put(self, q, item):
+        # Bounded put that gives up once another stage has failed
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def run(self, target, *args):
+        def wrapper():
+            try:
+                target(*args)
+            except Exception as e:
+                logger.error(f"Video pipeline stage {target.__name__} failed: {e}")
+                self.fail(e)
+        thread = threading.Thread(target=wrapper, name=target.__name__, daemon=True)
+        thread.start()
+        return thread
+
+
+def _decode_stage(pipe, container, stream, out_q):
+    for index, frame in enumerate(container.decode(stream)):
+        if not pipe.put(out_q, (index, frame)):
+            return
+    pipe.put(out_q, _DONE)
+
+
+def _preprocess_stage(pipe, in_q, out_q):
+    while True:
+        item = pipe.get(in_q)
+        if item is _DONE:
+            break
+        index, frame = item
+        timestamp = float(frame.time) if frame.time is not None else None
+        if not pipe.put(out_q, (index, timestamp, frame.to_ndarray(format="bgr24"))):
+            return
+    pipe.put(out_q, _DONE)
+
+
+def _inference_stage(pipe, in_q, out_q, batch_size, imgsz, conf):
+    model = get_model(WEIGHTS, imgsz=imgsz)
+    finished = False
+    while not finished:
+        # Block for the first frame, then take whatever else is ready
+        item = pipe.get(in_q)
+        if item is _DONE:
+            break
+        batch = [item]
+        while len(batch) < batch_size:
+            try:
+                item = in_q.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                finished = True
+                break
+            batch.append(item)
+
+        kwargs = {"imgsz": imgsz, "verbose": False}
+        if conf is not None:
+            kwargs["conf"] = conf
+        results = model([img for _, _, img in batch], **kwargs)
+        for (index, timestamp, img), result in zip(batch, results):
+            if not pipe.put(out_q, (index, timestamp, img, Detections.from_result(result))):
+                return
+    pipe.put(out_q, _DONE)
+
+
+def _annotate_stage(pipe, in_q, out_q):
+    while True:
+        item = pipe.get(in_q)
+        if item is _DONE:
+            break
+        index, timestamp, img, detections = item
+        total_cost, cost_breakdown = estimate_cost(detections)
+        annotate_image(img, detections)
+        record = {
+            "frame": index,
+            "time": timestamp,
+            "detections": detections.to_dict(),
+            "total_cost": total_cost,
+            "cost_breakdown": cost_breakdown,
+        }
+        if not pipe.put(out_q, (img, record)):
+            return
+    pipe.put(out_q, _DONE)
+
+
+def process_video(input_path, output_path, jsonl_path, batch_size=8, queue_size=16,
+                  imgsz=IMGSZ, conf=None, codec="libx264"):
+    """Annotate a recorded video and write per-frame detections as JSONL.
+
+    Decode, colour conversion, batched inference, annotation and encoding
+    each run on their own thread, linked by queues of at most ``queue_size``
+    items. Memory use does not depend on the length of the video.
+    Returns a small summary dict.
+    """
+    pipe = _Pipeline()
+    start = time.perf_counter()
+
+    in_container = av.open(input_path)
+    in_stream = in_container.streams.video[0]
+    in_stream.thread_type = "AUTO"
+    rate = in_stream.average_rate or Fraction(30, 1)
+
+    out_container = av.open(output_path, mode="w")
+    out_stream = out_container.add_stream(codec, rate=rate)
+    out_stream.width = in_stream.codec_context.width
+    out_stream.height = in_stream.codec_context.height
+    out_stream.pix_fmt = "yuv420p"
+
+    decoded, converted, inferred, annotated = (queue.Queue(maxsize=queue_size) for _ in range(4))
+    threads = [
+        pipe.run(_decode_stage, pipe, in_container, in_stream, decoded),
+        pipe.run(_preprocess_stage, pipe, decoded, converted),
+        pipe.run(_inference_stage, pipe, converted, inferred, batch_size, imgsz, conf),
+        pipe.run(_annotate_stage, pipe, inferred, annotated),
+    ]
+
+    # Encoding and the JSONL writer run on the calling thread
+    frames, peak_cost = 0, 0.0
+    try:
+        with open(jsonl_path, "w") as jsonl:
+            while True:
+                item = pipe.get(annotated)
+                if item is _DONE:
+                    break
+                img, record = item
+                out_frame = av.VideoFrame.from_ndarray(img, format="bgr24")
+                for packet in out_stream.encode(out_frame):
+                    out_container.mux(packet)
+                jsonl.write(json.dumps(record) + "\n")
+                frames += 1
+                peak_cost = max(peak_cost, record["total_cost"])
+        for packet in out_stream.encode():
+            out_container.mux(packet)
+    except Exception as e:
+        pipe.fail(e)
+    finally:
+        pipe.stop.set()
+        for thread in threads:
+            thread.join()
+        out_container.close()
+        in_container.close()
+
+    if pipe.error is not None:
+        raise pipe.error
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "frames": frames,
+        "seconds": elapsed,
+        "fps": frames / elapsed if elapsed > 0 else 0.0,
+        "peak_frame_cost": peak_cost,
+    }
+    logger.info(f"Processed {frames} frames from {input_path} in {elapsed:.1f}s ({summary['fps']:.1f} fps)")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Annotate a recorded inspection video with damage detections.")
+    parser.add_argument("input", help="input video file")
+    parser.add_argument("output", help="annotated output video file")
+    parser.add_argument("--jsonl", help="per-frame detections and costs (default: <output>.jsonl)")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--queue-size", type=int, default=16)
+    parser.add_argument("--imgsz", type=int, default=IMGSZ)
+    parser.add_argument("--conf", type=float, default=None)
+    parser.add_argument("--codec", default="libx264")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    summary = process_video(args.input, args.output, args.jsonl or args.output + ".jsonl",
+                            batch_size=args.batch_size, queue_size=args.queue_size,
+                            imgsz=args.imgsz, conf=args.conf, codec=args.codec)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
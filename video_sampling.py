@@ -0,0 +1,276 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+import av
+import cv2
+
+from car_pipeline import annotate_image, detect_damages_batch, estimate_cost_batch
+
+logger = logging.getLogger("ai-damage-backend")
+
+# Fast triage of long inspection videos. Instead of decoding every frame (at
+# low sampling rates decoding costs more CPU than inference), frames are
+# picked before or while decoding:
+#
+#   keyframes  only packets flagged as keyframes reach the decoder, and the
+#              decoder is told to drop anything else (skip_frame=NONKEY);
+#              keyframes less than ``interval`` seconds after the previous
+#              sample are skipped too (all-intra codecs such as MJPEG flag
+#              every frame as a keyframe)
+#   interval   one frame every ``interval`` seconds; when the next sample is
+#              past the next expected keyframe the demuxer seeks there
+#              instead of decoding the gap
+#
+# Either way only the chosen frames are converted, straight to a reduced
+# resolution in the same swscale pass, and codecs with a "lowres" mode
+# (MJPEG, MPEG-4 part 2, ...) also decode at a fraction of the size.
+
+MODES = ("keyframes", "interval")
+
+# Decoders that implement FFmpeg's "lowres" option, up to 1/8 of the size
+LOWRES_CODECS = {"mjpeg", "mpeg1video", "mpeg2video", "mpeg4", "h263", "msmpeg4v2", "msmpeg4v3", "wmv1", "wmv2"}
+MAX_LOWRES = 3
+
+
+def _timecode(seconds):
+    minutes, seconds = divmod(seconds, 60.0)
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+
+
+def _output_size(width, height, max_side):
+    scale = min(1.0, max_side / max(width, height)) if max_side else 1.0
+    # Even sizes keep the YUV -> BGR conversion simple
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+
+def _lowres_factor(stream, max_side):
+    # lowres=n decodes at 1/2^n of the size; only for codecs that support it
+    width, height = stream.codec_context.width, stream.codec_context.height
+    if not max_side or not width or not height or stream.codec_context.name not in LOWRES_CODECS:
+        return 0
+    factor = 0
+    while factor < MAX_LOWRES and max(width, height) >> (factor + 1) >= max_side:
+        factor += 1
+    return factor
+
+
+class SampledFrame:
+    __slots__ = ("index", "time", "keyframe", "image")
+
+    def __init__(self, index, time, keyframe, image):
+        self.index = index  # position among the sampled frames
+        self.time = time  # seconds from the start of the stream
+        self.keyframe = keyframe
+        self.image = image  # BGR, at most max_side pixels on the longest side
+
+
+class VideoSampler:
+    """Yields SampledFrames from a video file without decoding all of it.
+
+    ``mode`` is "keyframes" (at most one every ``interval`` seconds, 0 for
+    all of them) or "interval" (one frame every ``interval`` seconds).
+    ``max_side`` bounds the size of the returned images. The
+    ``decoded`` counter shows how many frames the decoder actually produced.
+    """
+
+    def __init__(self, path, mode="keyframes", interval=1.0, max_side=640, lowres=True):
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}")
+        self.path = path
+        self.mode = mode
+        self.interval = interval
+        self.max_side = max_side
+        self.lowres = lowres
+        self.decoded = 0
+        self.seeks = 0
+        self.duration = None
+
+    def _open(self):
+        container = av.open(self.path)
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+        if stream.duration is not None and stream.time_base is not None:
+            self.duration = float(stream.duration * stream.time_base)
+        elif container.duration is not None:
+            self.duration = container.duration / av.time_base
+        if self.lowres:
+            factor = _lowres_factor(stream, self.max_side)
+            if factor:
+                stream.codec_context.options = {"lowres": str(factor)}
+        return container, stream
+
+    def _convert(self, frame):
+        width, height = _output_size(frame.width, frame.height, self.max_side)
+        return frame.to_ndarray(format="bgr24", width=width, height=height)
+
+    def __iter__(self):
+        container, stream = self._open()
+        try:
+            if self.mode == "keyframes":
+                yield from self._keyframes(container, stream)
+            else:
+                yield from self._interval(container, stream)
+        finally:
+            container.close()
+
+    def _keyframes(self, container, stream):
+        stream.codec_context.skip_frame = "NONKEY"
+        time_base = stream.time_base
+        last = None  # time of the last packet let through to the decoder
+        index = 0
+        for packet in container.demux(stream):
+            # Flush packets (no data) still go through so the decoder drains
+            if packet.size:
+                if not packet.is_keyframe:
+                    continue
+                # Frame-threaded decoders return frames a few packets late, so
+                # the gap is measured between accepted packets, not frames
+                if packet.pts is not None:
+                    when = float(packet.pts * time_base)
+                    if last is not None and when < last + self.interval:
+                        continue
+                    last = when
+            for frame in packet.decode():
+                self.decoded += 1
+                if frame.time is None:
+                    continue
+                yield SampledFrame(index, float(frame.time), True, self._convert(frame))
+                index += 1
+
+    def _interval(self, container, stream):
+        time_base = stream.time_base
+        start = float(stream.start_time * time_base) if stream.start_time is not None else 0.0
+        step, target = 0, start  # samples are taken at start + step * interval
+        last_key, gop = None, None  # latest keyframe time and spacing seen so far
+        frames = container.decode(stream)
+        index = 0
+        while True:
+            # Seeking lands on the keyframe before the target; only worth it once the
+            # target is past the next keyframe we would reach by decoding on
+            if gop is not None and target >= last_key + gop:
+                container.seek(int(target / time_base), stream=stream, backward=True, any_frame=False)
+                frames = container.decode(stream)
+                self.seeks += 1
+                last_key = None  # keyframe spacing is only measured between consecutive ones
+            found = None
+            for frame in frames:
+                self.decoded += 1
+                if frame.time is None:
+                    continue
+                now = float(frame.time)
+                if frame.key_frame:
+                    if last_key is not None and now > last_key:
+                        gop = now - last_key if gop is None else max(gop, now - last_key)
+                    last_key = now
+                if now + 1e-6 >= target:
+                    found = frame
+                    break
+            if found is None:
+                return
+            now = float(found.time)
+            yield SampledFrame(index, now, bool(found.key_frame), self._convert(found))
+            index += 1
+            # Samples stay on the interval grid even if a frame landed late; the
+            # grid point is counted, not divided out, to avoid float rounding
+            while target <= now + 1e-6:
+                step += 1
+                target = start + step * self.interval
+
+
+def triage_video(input_path, jsonl_path=None, mode="keyframes", interval=1.0, max_side=640,
+                 batch_size=8, frames_dir=None, min_cost=0.0):
+    """Run damage detection on sampled frames of a video.
+
+    Each analysed frame is written as one JSONL record with its timestamp
+    ("time" in seconds and "timecode"), detections and costs. With
+    ``frames_dir``, annotated JPEGs of frames costing at least ``min_cost``
+    (and more than zero) are saved there. Returns a summary dict.
+    """
+    sampler = VideoSampler(input_path, mode=mode, interval=interval, max_side=max_side)
+    if frames_dir:
+        os.makedirs(frames_dir, exist_ok=True)
+    start = time.perf_counter()
+    sampled, flagged = 0, 0
+    peak = {"total_cost": 0.0, "time": None}
+    jsonl = open(jsonl_path, "w") if jsonl_path else None
+
+    def flush(batch):
+        nonlocal sampled, flagged
+        _, detections = detect_damages_batch([f.image for f in batch], batch_size=batch_size)
+        for frame, dets, (total_cost, cost_breakdown) in zip(batch, detections, estimate_cost_batch(detections)):
+            sampled += 1
+            record = {
+                "frame": frame.index,
+                "time": frame.time,
+                "timecode": _timecode(frame.time),
+                "keyframe": frame.keyframe,
+                "detections": dets.to_dict(),
+                "total_cost": total_cost,
+                "cost_breakdown": cost_breakdown,
+            }
+            if jsonl:
+                jsonl.write(json.dumps(record) + "\n")
+            if total_cost > peak["total_cost"]:
+                peak.update(total_cost=total_cost, time=frame.time)
+            if frames_dir and total_cost > 0 and total_cost >= min_cost:
+                flagged += 1
+                annotate_image(frame.image, dets)
+                name = f"{frame.time:09.3f}s.jpg"
+                cv2.imwrite(os.path.join(frames_dir, name), frame.image)
+
+    try:
+        batch = []
+        for frame in sampler:
+            batch.append(frame)
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+    finally:
+        if jsonl:
+            jsonl.close()
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "mode": mode,
+        "sampled_frames": sampled,
+        "decoded_frames": sampler.decoded,
+        "seeks": sampler.seeks,
+        "video_seconds": sampler.duration,
+        "seconds": elapsed,
+        "speedup": sampler.duration / elapsed if sampler.duration and elapsed > 0 else None,
+        "peak_frame_cost": peak["total_cost"],
+        "peak_time": peak["time"],
+        "flagged_frames": flagged,
+    }
+    logger.info(f"Triaged {input_path}: {sampled} frames ({sampler.decoded} decoded) in {elapsed:.1f}s")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Triage a long inspection video by analysing sampled frames only.")
+    parser.add_argument("input", help="input video file")
+    parser.add_argument("--mode", choices=MODES, default="keyframes")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between samples (keyframes mode: minimum gap, 0 keeps every keyframe)")
+    parser.add_argument("--max-side", type=int, default=640, help="longest side of the analysed frames (0: full size)")
+    parser.add_argument("--jsonl", help="per-frame detections and costs (default: <input>.triage.jsonl)")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--frames-dir", help="save annotated JPEGs of frames with damage here")
+    parser.add_argument("--min-cost", type=float, default=0.0, help="only save frames costing at least this much")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    summary = triage_video(args.input, args.jsonl or args.input + ".triage.jsonl", mode=args.mode,
+                           interval=args.interval, max_side=args.max_side, batch_size=args.batch_size,
+                           frames_dir=args.frames_dir, min_cost=args.min_cost)
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
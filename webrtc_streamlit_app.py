@@ -1,13 +1,18 @@
 import os
 import time
-import cv2
-import torch
 import av
-import numpy as np
 import streamlit as st
-from ultralytics import YOLO
 from streamlit_webrtc import webrtc_streamer, VideoTransformerBase, WebRtcMode, RTCConfiguration
-from car_pipeline import damage_cost_map, estimate_cost
+from car_pipeline import estimate_cost, annotate_image
+from model_registry import get_model, default_device
+from detections import Detections
+from tracking import DetectThenTrack
+from scene_gate import SceneChangeGate
+from quality_controller import QualityController, TARGET_FPS, warm_models
+from overlay import TextSlot
+from frame_pool import FrameConverter, VideoFramePool
+from damage_aggregator import DamageAggregator
+from cpu_resources import get_resource_manager
 
 st.set_page_config(page_title="Car Damage - WebRTC (Streamlit)", page_icon="🚗", layout="wide")
 st.markdown("""
@@ -21,8 +26,7 @@ st.markdown('<div class="site-header">AI Car Damage Detection — Live Camera</d
 st.markdown('<div class="footer">Powered by <b>YOLOv8</b> + <b>Streamlit/webrtc</b> — 2024</div>', unsafe_allow_html=True)
 
 MODEL_PATH = os.path.join(os.path.dirname(__file__), 'best (6).pt')
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-model = YOLO(MODEL_PATH)
+resources = get_resource_manager()  # splits the cores between the sessions' model calls
 
 rtc_configuration = RTCConfiguration({
     "iceServers": [{"urls": ["stun:stun.l.google.com:19302"]}],
@@ -31,37 +35,78 @@ rtc_configuration = RTCConfiguration({
 with st.sidebar:
     st.header("Settings")
     conf_thr = st.slider("Confidence threshold", 0.05, 0.75, 0.25, 0.05)
-    imgsz = st.select_slider("Inference size", options=[320, 480, 640], value=320)
+    adaptive = st.checkbox("Adaptive quality", value=True, help="Adjust inference size and detection rate to hold the target FPS.")
+    target_fps = st.slider("Target FPS", 5, 30, int(TARGET_FPS), disabled=not adaptive)
+    imgsz = st.select_slider("Inference size", options=[320, 480, 640], value=320, disabled=adaptive)
+    keyframe_interval = st.slider("Detect every N frames", 1, 10, 3, disabled=adaptive, help="Boxes are tracked with optical flow between detections.")
+    change_thr = st.slider("Scene change threshold", 0.0, 20.0, 3.0, 0.5, help="Frames that differ less than this (mean gray levels) from the last processed frame reuse its detections. 0 disables gating.")
     mirror = st.checkbox("Mirror video", value=True)
     async_mode = st.selectbox("Async Processing", [True, False], index=0, help="Try both for best FPS on your machine.")
+if adaptive:
+    warm_models(weights=MODEL_PATH)  # once per process: every rung's model, best first
 
 class DamageTransformer(VideoTransformerBase):
     def __init__(self):
         self.last_cost = 0.0
+        self.last_detections = Detections.empty()
+        self.scene_gate = SceneChangeGate(change_thr)
         self._last_time = time.time()
         self._frame_counter = 0
         self.fps = 0.0
+        self.tracker = DetectThenTrack(self._detect, keyframe_interval=keyframe_interval)
+        self.quality = QualityController(target_fps)
+        # Unique damages over the whole session, fed from keyframes only
+        self.claim = DamageAggregator()
+        # Frames are converted from YUV straight into reused output frames; a
+        # frame async mode still holds (and may re-send) is never overwritten
+        self.converter = FrameConverter()
+        self.output_frames = VideoFramePool(size=4)
+        # Overlay text is rasterized only when it changes
+        banner_style = dict(thickness=2, background=(245,245,245), height=46)
+        self.banner = TextSlot(scale=0.88, color=(0,60,230), pad_left=10, min_width=300, **banner_style)
+        self.fps_text = TextSlot(scale=0.65, color=(100,50,240), pad_left=0, min_width=130, **banner_style)
+        self.quality_text = TextSlot(scale=0.6, color=(0,200,0), thickness=2, background=None, pad_left=10)
+        resources.open_stream()
+
+    def on_ended(self):
+        resources.close_stream()
+
+    def _settings(self):
+        if adaptive:
+            return self.quality.imgsz, self.quality.keyframe_interval, self.quality.precision
+        return imgsz, keyframe_interval, None
+
+    def _detect(self, work):
+        size, _, precision = self._settings()
+        # Device lookup imports torch, so it happens on the first frame rather than at script load
+        device = default_device()
+        with resources.worker() as slot:
+            model = get_model(MODEL_PATH, device=device, imgsz=size, precision=precision, replica=slot)
+            try:
+                results = model.predict(work, conf=conf_thr, imgsz=size, device=device, verbose=False)
+            except TypeError:
+                results = model.predict(work, conf=conf_thr, imgsz=size, verbose=False)
+        detections = Detections.from_result(results[0] if len(results) else None)
+        self.claim.update(detections, work)
+        return detections
 
     def recv(self, frame: av.VideoFrame) -> av.VideoFrame:
-        img = frame.to_ndarray(format="bgr24")
-        if mirror:
-            img = cv2.flip(img, 1)
-        work = np.ascontiguousarray(img)
-        try:
-            results = model.predict(work, conf=conf_thr, imgsz=imgsz, device=DEVICE, verbose=False)
-        except TypeError:
-            results = model.predict(work, conf=conf_thr, imgsz=imgsz, verbose=False)
-        r0 = results[0] if len(results) else None
-        annotated = r0.plot() if r0 is not None else work.copy()
-        damage_info = []
-        if r0 is not None and r0.boxes is not None:
-            for box in r0.boxes:
-                cls = int(box.cls.cpu().numpy())
-                conf = float(box.conf.cpu().numpy())
-                if cls in damage_cost_map:
-                    damage_info.append({"class_id": cls, "confidence": conf})
-        total_cost, _ = estimate_cost(damage_info)
-        self.last_cost = float(total_cost)
+        start = time.perf_counter()
+        out, work = self.output_frames.acquire(frame.width, frame.height)
+        self.converter.bgr(frame, out=work, flip=mirror)
+        self.tracker.keyframe_interval = self._settings()[1]
+        self.quality.target_fps = target_fps
+        self.scene_gate.threshold = change_thr
+        if self.scene_gate.changed(work):
+            detections = self.tracker(work)
+            # Unknown class ids are skipped by estimate_cost
+            total_cost, _ = estimate_cost(detections)
+            self.last_detections = detections
+            self.last_cost = float(total_cost)
+        else:
+            # Camera held still: reuse the previous detections and cost
+            detections, total_cost = self.last_detections, self.last_cost
+        annotated = annotate_image(work, detections)
         # FPS calculation
         self._frame_counter += 1
         now = time.time()
@@ -70,12 +115,17 @@ class DamageTransformer(VideoTransformerBase):
             self._last_time = now
             self._frame_counter = 0
         # Overlay info
-        textbg = (245,245,245)
-        cv2.rectangle(annotated, (0, 0), (430, 46), textbg, -1)
         banner = f"Repair: AED {total_cost:.2f}" if total_cost > 0 else "AI: No Damage Detected"
-        cv2.putText(annotated, banner, (10,32), cv2.FONT_HERSHEY_SIMPLEX, 0.88, (0,60,230), 2)
-        cv2.putText(annotated, f"FPS: {self.fps:.1f}", (300, 32), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (100,50,240), 2)
-        return av.VideoFrame.from_ndarray(annotated, format="bgr24")
+        self.banner.draw(annotated, banner, 0, 0)
+        self.fps_text.draw(annotated, f"FPS: {self.fps:.1f}", 300, 0)
+        if adaptive:
+            self.quality_text.draw(annotated, self.quality.label(), 0, 50)
+        out.pts = frame.pts
+        out.time_base = frame.time_base
+        if adaptive:
+            # End-to-end time this frame spent in the processor
+            self.quality.observe(time.perf_counter() - start)
+        return out
 
 col1, col2 = st.columns([4,2])
 with col1:
@@ -87,11 +137,27 @@ with col1:
         video_processor_factory=DamageTransformer,
         async_processing=async_mode,
     )
+# Refreshes the stats on its own timer instead of blocking the script in a loop
+@st.fragment(run_every=0.3)
+def live_stats():
+    if ctx and ctx.video_transformer:
+        claim = ctx.video_transformer.claim
+        st.metric("Claim Estimate (AED)", f"{claim.total_cost:.2f}",
+                  help="Each damage is counted once, however many frames it appears in.")
+        st.caption(f"{claim.confirmed} unique damages · this frame: AED {ctx.video_transformer.last_cost:.2f}")
+        gate = ctx.video_transformer.scene_gate
+        st.caption(f"Frames processed: {gate.processed} · gated: {gate.gated} · last change: {gate.last_score:.1f}"
+                   f" · quality: {ctx.video_transformer.quality.label()}")
+        # Kept so the report is still there once the stream stops
+        st.session_state["claim_report"] = claim.report()
+    elif st.session_state.get("claim_report"):
+        report = st.session_state["claim_report"]
+        st.metric("Final Claim (AED)", f"{report['total_cost']:.2f}")
+        if report["damages"]:
+            st.dataframe([{k: d[k] for k in ("type", "hits", "confidence_mean", "estimated_cost")} for d in report["damages"]],
+                         hide_index=True)
+
 with col2:
-    info = st.empty()
+    live_stats()
     st.caption("Tip: For smoothest experience, use default settings or set Detection Quality to 'Fast'.")
-    while True:
-        if ctx and ctx.video_transformer:
-            info.metric("Estimated Repair Cost (AED)", f"{ctx.video_transformer.last_cost:.2f}")
-        time.sleep(0.3)
 
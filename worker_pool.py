@@ -0,0 +1,232 @@
+import atexit
+import base64
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, resource_tracker, shared_memory
+
+import cv2
+import numpy as np
+
+import metrics
+from cpu_resources import pin_process_threads
+
+logger = logging.getLogger("ai-damage-backend")
+
+# Multi-process pool behind /api/assess. Each worker process loads its own
+# model once, with torch pinned to a few threads so the workers don't fight
+# over cores. Uploaded image bytes (and annotated JPEGs on the way back) go
+# through shared memory segments; only their names cross the process pipe.
+# The number of images queued or running is bounded, so a burst gets a 429
+# instead of an ever-growing queue.
+
+WORKERS = int(os.environ.get("ASSESS_WORKERS", "0")) or None  # None: cores / threads per worker
+THREADS_PER_WORKER = int(os.environ.get("ASSESS_THREADS_PER_WORKER", "2"))
+MAX_QUEUE = int(os.environ.get("ASSESS_MAX_QUEUE", "0")) or None  # None: 4 images per worker
+TIMEOUT = float(os.environ.get("ASSESS_TIMEOUT", "60"))
+
+
+class PoolBusy(Exception):
+    """Raised when the pool has no room for more images."""
+
+
+def _open_untracked(name=None, create=False, size=0):
+    # Segments are owned (tracked and unlinked) by the server process only;
+    # a worker registering them would have them removed when it exits
+    try:
+        return shared_memory.SharedMemory(name=name, create=create, size=size, track=False)
+    except TypeError:  # Python < 3.13 has no track argument
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name, create=create, size=size)
+        finally:
+            resource_tracker.register = register
+
+
+def _init_worker(threads):
+    """Runs once in every worker process: pin thread counts and warm up the model."""
+    pin_process_threads(threads)
+
+    from car_pipeline import WEIGHTS, IMGSZ
+    from model_registry import get_model
+    get_model(WEIGHTS, device="cpu", imgsz=IMGSZ)
+
+
+def _assess(shm_name, size, annotated=False, two_pass=None):
+    """Worker side: decode the image from shared memory and run the pipeline."""
+    from car_pipeline import car_damage_pipeline_array, encode_image
+
+    start = time.perf_counter()
+    shm = _open_untracked(shm_name)
+    try:
+        data = np.frombuffer(shm.buf, np.uint8, count=size)
+        # Same pixels as PIL's Image.open(...).convert('RGB'): EXIF orientation is not applied
+        bgr = cv2.imdecode(data, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        del data
+    finally:
+        shm.close()
+    if bgr is None:
+        raise ValueError("Not a decodable image")
+    image = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+
+    result = car_damage_pipeline_array(image, inplace=True, two_pass=two_pass)
+    output = {
+        "total_cost": result["total_cost"],
+        "cost_breakdown": result["cost_breakdown"],
+        "detections": result["detections"].to_dict(),
+        "width": image.shape[1],
+        "height": image.shape[0],
+    }
+    if "roi" in result:
+        output["roi"] = result["roi"]
+    if annotated:
+        jpeg = encode_image(result["annotated_image"])
+        out = _open_untracked(create=True, size=len(jpeg))
+        out.buf[:len(jpeg)] = jpeg
+        output["annotated_shm"] = (out.name, len(jpeg))
+        out.close()
+    output["worker_ms"] = (time.perf_counter() - start) * 1000.0
+    output["worker_pid"] = os.getpid()
+    return output
+
+
+class AssessmentPool:
+    """Bounded process pool for still-image assessments.
+
+    ``reserve(n)`` claims room for ``n`` images or raises PoolBusy; the
+    room is given back as each job finishes, fails or is cancelled.
+    ``submit`` returns a Job whose results can be consumed in completion
+    order with ``iter_results``.
+    """
+
+    def __init__(self, workers=WORKERS, threads_per_worker=THREADS_PER_WORKER, max_queue=MAX_QUEUE):
+        self.threads_per_worker = max(1, threads_per_worker)
+        self.workers = workers or max(1, (os.cpu_count() or 1) // self.threads_per_worker)
+        self.max_queue = max_queue or 4 * self.workers
+        # spawn: forking a process that already runs torch threads is not safe
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn"),
+                                             initializer=_init_worker, initargs=(self.threads_per_worker,))
+        self._lock = threading.Lock()
+        self._in_flight = 0
+
+    def queue_depth(self):
+        return self._in_flight
+
+    def reserve(self, n):
+        with self._lock:
+            if self._in_flight + n > self.max_queue:
+                raise PoolBusy(f"{self._in_flight} images in flight, limit {self.max_queue}")
+            self._in_flight += n
+
+    def _release(self, n=1):
+        with self._lock:
+            self._in_flight -= n
+
+    def submit(self, blobs, annotated=False, two_pass=None):
+        """Queue reserved images (bytes) and return a Job."""
+        job = Job(len(blobs))
+        for index, data in enumerate(blobs):
+            shm = None
+            try:
+                shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+                shm.buf[:len(data)] = data
+                future = self._executor.submit(_assess, shm.name, len(data), annotated, two_pass)
+            except Exception as e:
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+                self._release(len(blobs) - index)
+                job.fail_remaining(index, e)
+                break
+            job.futures.append(future)
+            future.add_done_callback(lambda f, i=index, s=shm: self._finish(job, i, s, f))
+        return job
+
+    def _finish(self, job, index, shm, future):
+        # Runs on the executor's thread once a job is done or cancelled; the
+        # worker has let go of the input segment by then
+        shm.close()
+        shm.unlink()
+        self._release()
+        if future.cancelled():
+            return
+        try:
+            output = future.result()
+        except Exception as e:
+            job.results.put((index, {"error": str(e)}))
+            return
+        if "annotated_shm" in output:
+            name, size = output.pop("annotated_shm")
+            out = shared_memory.SharedMemory(name=name)
+            try:
+                output["annotated_image"] = base64.b64encode(bytes(out.buf[:size])).decode("ascii")
+            finally:
+                out.close()
+                out.unlink()
+        job.results.put((index, output))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class Job:
+    """Results of one request, delivered as each image finishes."""
+
+    def __init__(self, total):
+        self.total = total
+        self.futures = []
+        self.results = queue.SimpleQueue()
+
+    def fail_remaining(self, start, error):
+        for index in range(start, self.total):
+            self.results.put((index, {"error": str(error)}))
+
+    def cancel(self):
+        for future in self.futures:
+            future.cancel()
+
+    def iter_results(self, timeout=TIMEOUT, sleep=time.sleep, poll=0.02):
+        """Yield ``(index, result)`` in completion order until all are done
+        or ``timeout`` seconds pass; late images are reported as timed out.
+
+        ``sleep`` is how to wait between polls (``socketio.sleep`` under
+        eventlet, so other requests keep being served).
+        """
+        deadline = time.monotonic() + timeout
+        pending = set(range(self.total))
+        while pending:
+            try:
+                index, result = self.results.get_nowait()
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    break
+                sleep(poll)
+                continue
+            pending.discard(index)
+            yield index, result
+        if pending:
+            # Not started yet: drop them; running ones finish and free their slot
+            self.cancel()
+            for index in sorted(pending):
+                yield index, {"error": "timeout"}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Process-wide pool, started on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = AssessmentPool()
+            logger.info(f"Assessment pool: {_pool.workers} workers x {_pool.threads_per_worker} threads, "
+                        f"queue limit {_pool.max_queue}")
+            metrics.register_gauge("assess_in_flight", _pool.queue_depth)
+            atexit.register(_pool.shutdown)
+        return _pool